@@ -21,6 +21,14 @@ mkdir -p /app/media /app/staticfiles
 # user Django will have the correct UID already
 chown -R django /app/media/ /app/staticfiles/
 
+# metrics of the workers of a previous run must not be added to the new ones
+if [[ -n $prometheus_multiproc_dir ]]
+then
+    rm -rf "$prometheus_multiproc_dir"
+    mkdir -p "$prometheus_multiproc_dir"
+    chown django "$prometheus_multiproc_dir"
+fi
+
 echo Starting normal execution as django user
 echo Collecting static files
 DJANGO_DEBUG=False gosu django python manage.py collectstatic --no-input
@@ -0,0 +1,256 @@
+"""Admission control of the analysis endpoints, so bursts of uploads fail fast instead of timing out.
+
+At most `MERON_ADMISSION_SLOTS` requests are analyzed at the same time. Further requests wait in a queue of
+`MERON_ADMISSION_QUEUE_SIZE` requests for at most `MERON_ADMISSION_MAX_WAIT` seconds. Requests that find the queue
+full or time out in it get status 503 with a `Retry-After` header right away, which keeps the latency of the accepted
+requests bounded.
+
+Without `MERON_ADMISSION_DIR` the limits apply to the threads of one process. gunicorn sets it, then the limits apply
+to all workers of the host: a slot or a place in the queue is an exclusive `flock` on one of the files in that
+directory. The kernel releases the locks of a worker that dies, so slots are never leaked.
+
+Sync gunicorn workers handle one request at a time, the others wait in the listen socket where Django can't count
+them. nginx sends the time it received a request in the `X-Request-Start` header, requests that reached the worker
+more than `MERON_ADMISSION_MAX_REQUEST_AGE` seconds later are shed before their body is read.
+"""
+import fcntl
+import math
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+from django.conf import settings
+from rest_framework.exceptions import APIException
+from rest_framework.status import HTTP_503_SERVICE_UNAVAILABLE
+
+from .metrics import ADMISSION_IN_FLIGHT, ADMISSION_QUEUED, ADMISSION_REQUESTS, ADMISSION_WAIT
+
+# weight of the latest request in the moving average of the analysis time that the Retry-After header is based on
+SERVICE_TIME_WEIGHT = 0.2
+# seconds between the attempts of a queued request to lock a slot of the host
+HOST_POLL_INTERVAL = 0.01
+
+
+class Overloaded(APIException):
+    """The worker has no free slot for the request. DRF sends `wait` as Retry-After header."""
+
+    status_code = HTTP_503_SERVICE_UNAVAILABLE
+    default_detail = "The server is busy, please try again later."
+    default_code = "overloaded"
+
+    def __init__(self, wait, detail=None):
+        super().__init__(detail)
+        self.wait = wait
+
+
+class AdmissionController:
+    """Limit the number of requests of one worker that are analyzed at the same time, and of those waiting."""
+
+    def __init__(self, slots, queue_size, max_wait):
+        """`max_wait` is the longest time in seconds a request waits in the queue."""
+        self.slots = slots
+        self.queue_size = queue_size
+        self.max_wait = max_wait
+        self.in_flight = 0
+        self.queued = 0
+        self.service_time = None
+        self.condition = threading.Condition()
+
+    def retry_after(self):
+        """Return the seconds until the requests ahead of a new one are likely done, at least 1."""
+        service_time = self.service_time or 1.0
+        return max(math.ceil(service_time * (self.in_flight + self.queued) / self.slots), 1)
+
+    def shed(self, outcome):
+        ADMISSION_REQUESTS.labels(outcome).inc()
+        return Overloaded(self.retry_after())
+
+    @contextmanager
+    def admit(self):
+        """Run the block in a slot, raise Overloaded if the request can't get one in time."""
+        with self.condition:
+            if self.in_flight < self.slots and not self.queued:
+                outcome, waited = "admitted", 0.0
+            elif self.queued >= self.queue_size:
+                raise self.shed("shed")
+            else:
+                self.queued += 1
+                ADMISSION_QUEUED.inc()
+                start = time.monotonic()
+                try:
+                    has_slot = self.condition.wait_for(lambda: self.in_flight < self.slots, self.max_wait)
+                finally:
+                    self.queued -= 1
+                    ADMISSION_QUEUED.dec()
+                if not has_slot:
+                    raise self.shed("timeout")
+                outcome, waited = "queued", time.monotonic() - start
+            self.in_flight += 1
+        ADMISSION_REQUESTS.labels(outcome).inc()
+        ADMISSION_WAIT.observe(waited)
+        ADMISSION_IN_FLIGHT.inc()
+
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            ADMISSION_IN_FLIGHT.dec()
+            with self.condition:
+                self.in_flight -= 1
+                self.record_service_time(time.monotonic() - start)
+                self.condition.notify()
+
+    def record_service_time(self, duration):
+        if self.service_time is None:
+            self.service_time = duration
+        else:
+            self.service_time += SERVICE_TIME_WEIGHT * (duration - self.service_time)
+
+    def stats(self):
+        return {
+            "slots": self.slots,
+            "queue_size": self.queue_size,
+            "in_flight": self.in_flight,
+            "queued": self.queued,
+        }
+
+
+class HostAdmissionController(AdmissionController):
+    """Limit the number of requests of all workers of the host, with lock files in `directory`.
+
+    `in_flight` and `queued` count the requests of this worker, the gauges in /metrics/ add them up over the host.
+    """
+
+    def __init__(self, directory, slots, queue_size, max_wait):
+        super().__init__(slots, queue_size, max_wait)
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def retry_after(self):
+        """Return the seconds until the requests ahead of a new one are likely done, at least 1.
+
+        A request is only shed while all slots and the queue of the host are taken.
+        """
+        service_time = self.service_time or 1.0
+        return max(math.ceil(service_time * (self.slots + self.queue_size) / self.slots), 1)
+
+    def lock(self, kind, count):
+        """Lock the first free one of `count` files, return its descriptor or None if all are locked."""
+        for index in range(count):
+            fd = os.open(os.path.join(self.directory, f"{kind}-{index}.lock"), os.O_RDWR | os.O_CREAT, 0o600)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                os.close(fd)
+                continue
+            return fd
+        return None
+
+    def count(self, delta, queued=False):
+        with self.condition:
+            if queued:
+                self.queued += delta
+            else:
+                self.in_flight += delta
+        (ADMISSION_QUEUED if queued else ADMISSION_IN_FLIGHT).inc(delta)
+
+    @contextmanager
+    def admit(self):
+        """Run the block in a slot of the host, raise Overloaded if the request can't get one in time."""
+        slot = self.lock("slot", self.slots)
+        if slot is not None:
+            outcome, waited = "admitted", 0.0
+        else:
+            place = self.lock("queue", self.queue_size)
+            if place is None:
+                raise self.shed("shed")
+            self.count(1, queued=True)
+            start = time.monotonic()
+            try:
+                while slot is None and time.monotonic() - start < self.max_wait:
+                    time.sleep(HOST_POLL_INTERVAL)
+                    slot = self.lock("slot", self.slots)
+            finally:
+                os.close(place)
+                self.count(-1, queued=True)
+            if slot is None:
+                raise self.shed("timeout")
+            outcome, waited = "queued", time.monotonic() - start
+        ADMISSION_REQUESTS.labels(outcome).inc()
+        ADMISSION_WAIT.observe(waited)
+        self.count(1)
+
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            # closing the descriptor releases the lock
+            os.close(slot)
+            self.count(-1)
+            with self.condition:
+                self.record_service_time(time.monotonic() - start)
+
+    def stats(self):
+        return {**super().stats(), "directory": self.directory}
+
+
+_controller = None
+_controller_lock = threading.Lock()
+
+
+def get_admission_controller():
+    """Return the admission controller of this process, or None if admission control is disabled in the settings.
+
+    The controller limits the requests of the host if `MERON_ADMISSION_DIR` is set, else those of this process.
+    """
+    global _controller
+    if not settings.MERON_ADMISSION_CONTROL:
+        return None
+    directory = settings.MERON_ADMISSION_DIR
+    limits = (settings.MERON_ADMISSION_SLOTS, settings.MERON_ADMISSION_QUEUE_SIZE, settings.MERON_ADMISSION_MAX_WAIT)
+    with _controller_lock:
+        if (
+            _controller is None
+            or getattr(_controller, "directory", "") != directory
+            or (_controller.slots, _controller.queue_size, _controller.max_wait) != limits
+        ):
+            _controller = HostAdmissionController(directory, *limits) if directory else AdmissionController(*limits)
+    return _controller
+
+
+def request_age(request):
+    """Return the seconds since nginx received the request, or None without an `X-Request-Start: t=<time>` header."""
+    header = request.META.get("HTTP_X_REQUEST_START", "")
+    try:
+        return time.time() - float(header[2:] if header.startswith("t=") else header)
+    except ValueError:
+        return None
+
+
+def reject_stale(request):
+    """Raise Overloaded if the request waited longer than `MERON_ADMISSION_MAX_REQUEST_AGE` behind nginx.
+
+    Views call this before they read the body, a client that gave up isn't waiting for it.
+    """
+    controller = get_admission_controller()
+    max_age = settings.MERON_ADMISSION_MAX_REQUEST_AGE
+    if controller is None or not max_age:
+        return
+    age = request_age(request)
+    if age is not None and age > max_age:
+        raise controller.shed("stale")
+
+
+@contextmanager
+def admit():
+    """Run the block if the host has capacity for the request, raise Overloaded otherwise.
+
+    Only the analysis runs in the slot, views parse the body and resolve the models before.
+    """
+    controller = get_admission_controller()
+    if controller is None:
+        yield
+        return
+    with controller.admit():
+        yield
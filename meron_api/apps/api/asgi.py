@@ -0,0 +1,133 @@
+"""ASGI application that receives request bodies on an event loop and runs Django in a bounded thread pool.
+
+With sync gunicorn workers, a field device that uploads a photo over a slow connection holds a whole worker, with its
+copy of the models, until the last byte arrived. `BufferedWSGIApplication` receives the body on the event loop of an
+ASGI server (uvicorn), where thousands of slow uploads cost little more than their buffers. Only complete requests are
+handed to the Django WSGI application, in a thread pool with one thread per request that can run at the same time, so
+the models are busy with requests that are ready to be analyzed.
+
+Django 2.2 has no async views, the whole Django stack (middleware, parsers, serializers, views) runs in the pool like
+it does in a gthread worker. Requests that waited too long for a thread are shed by the admission control, see
+admission.py. Only the standard library is used here.
+"""
+import asyncio
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+
+TOO_LARGE_BODY = b'{"detail":"The upload is too large."}'
+
+
+def build_environ(scope, body):
+    """Return the WSGI environ of an ASGI HTTP request whose body was received completely."""
+    server_name, server_port = scope.get("server") or ("localhost", 80)
+    environ = {
+        "REQUEST_METHOD": scope["method"],
+        "SCRIPT_NAME": scope.get("root_path", "").encode("utf8").decode("latin1"),
+        "PATH_INFO": scope["path"].encode("utf8").decode("latin1"),
+        "QUERY_STRING": scope["query_string"].decode("ascii"),
+        "SERVER_NAME": server_name,
+        "SERVER_PORT": str(server_port),
+        "SERVER_PROTOCOL": f"HTTP/{scope['http_version']}",
+        # the body is complete, chunked requests get a Content-Length as well
+        "CONTENT_LENGTH": str(len(body)),
+        "wsgi.version": (1, 0),
+        "wsgi.url_scheme": scope.get("scheme", "http"),
+        "wsgi.input": BytesIO(body),
+        "wsgi.errors": sys.stderr,
+        "wsgi.multithread": True,
+        "wsgi.multiprocess": True,
+        "wsgi.run_once": False,
+    }
+    if scope.get("client"):
+        environ["REMOTE_ADDR"], environ["REMOTE_PORT"] = scope["client"][0], str(scope["client"][1])
+    for name, value in scope["headers"]:
+        name = name.decode("latin1").upper().replace("-", "_")
+        if name == "CONTENT_LENGTH":
+            continue
+        key = name if name == "CONTENT_TYPE" else f"HTTP_{name}"
+        value = value.decode("latin1")
+        environ[key] = f"{environ[key]},{value}" if key in environ else value
+    return environ
+
+
+def run_wsgi(application, environ):
+    """Call a WSGI application and return the status code, the headers and the body of the response."""
+    response = {}
+
+    def start_response(status, headers, exc_info=None):
+        response["status"] = int(status.split(" ", 1)[0])
+        response["headers"] = [(name.encode("latin1"), value.encode("latin1")) for name, value in headers]
+
+    result = application(environ, start_response)
+    try:
+        body = b"".join(result)
+    finally:
+        if hasattr(result, "close"):
+            result.close()
+    return response["status"], response["headers"], body
+
+
+class BufferedWSGIApplication:
+    """Serve a WSGI application over ASGI, receiving the body first and then running the application in a thread.
+
+    `threads` requests run in the application at the same time, the others wait on the event loop. Bodies larger
+    than `max_body_size` bytes are rejected with status 413 while they are received.
+    """
+
+    def __init__(self, application, threads, max_body_size):
+        self.application = application
+        self.max_body_size = max_body_size
+        self.executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix="meron-asgi")
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            await self.lifespan(receive, send)
+            return
+        if scope["type"] != "http":
+            raise ValueError(f"Unsupported ASGI scope type {scope['type']!r}")
+
+        body = await self.receive_body(scope, receive)
+        if body is None:
+            await self.send_response(send, 413, [(b"content-type", b"application/json")], TOO_LARGE_BODY)
+            return
+        if body is False:
+            # the client went away before it sent the whole body
+            return
+        loop = asyncio.get_event_loop()
+        status, headers, response_body = await loop.run_in_executor(
+            self.executor, run_wsgi, self.application, build_environ(scope, body)
+        )
+        await self.send_response(send, status, headers, response_body)
+
+    async def receive_body(self, scope, receive):
+        """Return the request body, None if it is too large or False if the client disconnected."""
+        for name, value in scope["headers"]:
+            if name.lower() == b"content-length" and value.isdigit() and int(value) > self.max_body_size:
+                return None
+        chunks, size = [], 0
+        while True:
+            message = await receive()
+            if message["type"] == "http.disconnect":
+                return False
+            chunk = message.get("body", b"")
+            size += len(chunk)
+            if size > self.max_body_size:
+                return None
+            chunks.append(chunk)
+            if not message.get("more_body", False):
+                return b"".join(chunks)
+
+    async def send_response(self, send, status, headers, body):
+        await send({"type": "http.response.start", "status": status, "headers": headers})
+        await send({"type": "http.response.body", "body": body})
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                self.executor.shutdown(wait=True)
+                await send({"type": "lifespan.shutdown.complete"})
+                return
@@ -0,0 +1,168 @@
+"""Dynamic micro-batching of the VGGFace forward pass.
+
+Concurrent requests handled by the threads of one worker each need the embedding of one or a few faces. Instead of
+running the network once per request, the requests put their face crops on a queue. A dedicated thread collects the
+crops until either `MERON_MICRO_BATCH_MAX_SIZE` faces are waiting or the oldest one waited
+`MERON_MICRO_BATCH_MAX_WAIT_MS`, runs one batched prediction and hands each request its embeddings.
+
+This only batches requests of the same process, so it pays off with the `threaded` and `async` topologies, whose
+workers handle several requests at the same time. A single threaded worker (the `per-core` topology,
+`MERON_REQUEST_THREADS = 1`) never has a second request to batch with, the batcher would only add its wait time to
+every request, so it stays disabled there even if `MERON_MICRO_BATCHING` is set.
+"""
+import logging
+import os
+import queue
+import threading
+import time
+from collections import Counter
+
+import numpy as np
+from django.conf import settings
+
+from .metrics import MICRO_BATCH_SIZE, MICRO_BATCH_WAIT
+
+logger = logging.getLogger(__name__)
+
+
+class PendingEmbedding:
+    """Face crops of one request waiting for their embeddings."""
+
+    def __init__(self, embedder, faces):
+        self.embedder = embedder
+        self.faces = faces
+        self.enqueued = time.monotonic()
+        self.done = threading.Event()
+        self.embeddings = None
+        self.error = None
+
+
+class MicroBatcher:
+    """Collect face crops from concurrent requests and embed them together."""
+
+    def __init__(self, embed, max_batch_size, max_wait):
+        """`embed(embedder, faces)` calculates the embeddings of a list of face crops, `max_wait` is in seconds."""
+        self.embed = embed
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+        self._stats_lock = threading.Lock()
+        self.batch_sizes = Counter()
+        self.requests = 0
+        self.queue_wait_total = 0.0
+        self.queue_wait_max = 0.0
+
+    def submit(self, embedder, faces):
+        """Return the embeddings of `faces`, calculated in a batch together with other requests."""
+        self._ensure_thread()
+        pending = PendingEmbedding(embedder, faces)
+        self._queue.put(pending)
+        pending.done.wait()
+        if pending.error is not None:
+            raise pending.error
+        return pending.embeddings
+
+    def stats(self):
+        """Return the batch size distribution and queue wait times since the process started."""
+        with self._stats_lock:
+            return {
+                "batches": sum(self.batch_sizes.values()),
+                "requests": self.requests,
+                "batch_sizes": dict(sorted(self.batch_sizes.items())),
+                "queue_wait_mean_ms": 1000 * self.queue_wait_total / self.requests if self.requests else None,
+                "queue_wait_max_ms": 1000 * self.queue_wait_max,
+            }
+
+    def _ensure_thread(self):
+        # threads don't survive a fork, so a worker forked from a process that used the batcher needs its own thread
+        with self._lock:
+            if self._pid != os.getpid():
+                self._pid = os.getpid()
+                self._queue = queue.Queue()
+                self._thread = None
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="meron-micro-batcher", daemon=True)
+                self._thread.start()
+
+    def _collect(self):
+        """Block until a request arrives, then collect more until the batch is full or the wait time is over."""
+        batch = [self._queue.get()]
+        size = len(batch[0].faces)
+        deadline = batch[0].enqueued + self.max_wait
+        while size < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                pending = self._queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            batch.append(pending)
+            size += len(pending.faces)
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            started = time.monotonic()
+            # requests that arrived during a model swap can use different embedders, those are run separately
+            by_embedder = {}
+            for pending in batch:
+                by_embedder.setdefault(id(pending.embedder), []).append(pending)
+            for group in by_embedder.values():
+                self._embed_group(group)
+            self._record(batch, started)
+
+    def _embed_group(self, group):
+        faces = [face for pending in group for face in pending.faces]
+        try:
+            embeddings = np.asarray(self.embed(group[0].embedder, faces))
+        except Exception as exc:
+            logger.exception("Batched embedding of %s faces failed", len(faces))
+            for pending in group:
+                pending.error = exc
+                pending.done.set()
+            return
+        start = 0
+        for pending in group:
+            pending.embeddings = embeddings[start:start + len(pending.faces)]
+            start += len(pending.faces)
+            pending.done.set()
+
+    def _record(self, batch, started):
+        size = sum(len(pending.faces) for pending in batch)
+        waits = [started - pending.enqueued for pending in batch]
+        with self._stats_lock:
+            self.batch_sizes[size] += 1
+            self.requests += len(batch)
+            self.queue_wait_total += sum(waits)
+            self.queue_wait_max = max(self.queue_wait_max, *waits)
+        MICRO_BATCH_SIZE.observe(size)
+        for wait in waits:
+            MICRO_BATCH_WAIT.observe(wait)
+        logger.debug("Embedded a batch of %s faces from %s requests, max queue wait %.1f ms",
+                     size, len(batch), 1000 * max(waits))
+
+
+_batcher = None
+_batcher_lock = threading.Lock()
+
+
+def get_batcher():
+    """Return the micro-batcher of this process, or None if micro-batching is disabled or can't batch anything."""
+    global _batcher
+    if not settings.MERON_MICRO_BATCHING or settings.MERON_REQUEST_THREADS == 1:
+        return None
+    with _batcher_lock:
+        if _batcher is None:
+            from .inference import embed_faces
+
+            _batcher = MicroBatcher(
+                embed_faces,
+                settings.MERON_MICRO_BATCH_MAX_SIZE,
+                settings.MERON_MICRO_BATCH_MAX_WAIT_MS / 1000,
+            )
+    return _batcher
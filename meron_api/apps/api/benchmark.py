@@ -0,0 +1,238 @@
+"""Benchmark the API end to end and stage by stage, see the `benchmark_api` management command.
+
+The requests go through the whole Django stack in process (middleware, parsers, serializers, view), with the same
+multipart and base64 payloads the clients send. The stage benchmark runs the steps of the analysis of one upload one
+by one: decoding, face detection, alignment (cropping and scaling the face), embedding and the score and
+classification heads. The HTTP benchmark loads a running server, see the `benchmark_topology` management command.
+All use synthetic images, so no photos of children are needed to run them. Only the face detector benchmark (see the
+`benchmark_detectors` management command) needs photos, synthetic faces don't tell whether a detector finds faces.
+"""
+import base64
+import json
+import resource
+import sys
+import threading
+import time
+import urllib.error
+import urllib.request
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+
+import numpy as np
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.test import Client
+from PIL import Image, ImageDraw
+
+from .fields import Base64ImageField
+from .inference import build_features, crop_face, detect_face, embed_faces, load_pixels, predict_heads
+from .registry import registry
+
+MODES = ("multipart", "base64")
+STAGES = ("decode", "detect", "align", "embed", "heads")
+CONTENT_TYPES = {"jpeg": "image/jpeg", "png": "image/png"}
+
+
+def synthetic_face_image(size, image_format, seed=0):
+    """Return the encoded bytes of an image with a face-colored ellipse in front of a noisy background.
+
+    The noise makes the files about as large as photos of the same size, a flat image would compress far better.
+    """
+    width, height = size
+    rng = np.random.RandomState(seed)
+    background = rng.randint(40, 200, size=(height, width, 3), dtype=np.uint8)
+    img = Image.fromarray(background)
+    draw = ImageDraw.Draw(img)
+    side = min(width, height)
+    left, top = (width - side * 0.5) / 2, (height - side * 0.6) / 2
+    draw.ellipse((left, top, left + side * 0.5, top + side * 0.6), fill=(224, 172, 105))
+    image_file = BytesIO()
+    img.save(image_file, format=image_format.upper())
+    return image_file.getvalue()
+
+
+def summarize(durations):
+    """Return the mean and the 50th, 95th and 99th percentile of durations in seconds, in milliseconds."""
+    if not durations:
+        return {"mean_ms": None, "p50_ms": None, "p95_ms": None, "p99_ms": None}
+    milliseconds = np.asarray(durations) * 1000
+    p50, p95, p99 = np.percentile(milliseconds, [50, 95, 99])
+    return {"mean_ms": float(milliseconds.mean()), "p50_ms": float(p50), "p95_ms": float(p95), "p99_ms": float(p99)}
+
+
+def peak_rss_mb():
+    """Return the highest resident set size of this process so far, in MiB."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak / (1024 * 1024 if sys.platform == "darwin" else 1024)
+
+
+def request_kwargs(image_bytes, image_format, mode, age=30, gender="m"):
+    """Return the keyword arguments of Client.post for an upload as multipart/form-data or base64 in JSON."""
+    if mode == "multipart":
+        upload = SimpleUploadedFile(f"face.{image_format}", image_bytes, CONTENT_TYPES.get(image_format))
+        return {"data": {"image": upload, "age": age, "gender": gender}}
+    body = {"image": base64.b64encode(image_bytes).decode(), "age": age, "gender": gender}
+    return {"data": json.dumps(body), "content_type": "application/json"}
+
+
+def benchmark_requests(image_bytes, image_format, mode, requests, concurrency=1, path="/"):
+    """POST the image `requests` times from `concurrency` threads and return latency and throughput.
+
+    Every thread has its own client. Responses other than 201 are counted as errors, `error_statuses` counts them by
+    status code (e.g. 413 for images larger than `MERON_MAX_UPLOAD_SIZE`).
+    """
+    latencies, errors = [], []
+    lock = threading.Lock()
+    counter = iter(range(requests))
+
+    def worker():
+        client = Client()
+        while True:
+            with lock:
+                if next(counter, None) is None:
+                    return
+            kwargs = request_kwargs(image_bytes, image_format, mode)
+            start = time.perf_counter()
+            response = client.post(path, **kwargs)
+            duration = time.perf_counter() - start
+            with lock:
+                latencies.append(duration)
+                if response.status_code != 201:
+                    errors.append(response.status_code)
+
+    threads = [threading.Thread(target=worker) for _ in range(max(concurrency, 1))]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    return dict(
+        summarize(latencies),
+        requests=len(latencies),
+        errors=len(errors),
+        error_statuses=dict(Counter(errors)),
+        requests_per_second=len(latencies) / elapsed if elapsed else None,
+        peak_rss_mb=peak_rss_mb(),
+    )
+
+
+def benchmark_stages(image_bytes, image_format, repeat, age=30, gender="m"):
+    """Run the analysis of the image stage by stage `repeat` times and return the timings of every stage.
+
+    `peak_rss_mb` of a stage is the peak memory of the process after the stage ran. It only ever grows, so the stage
+    at which it jumps is the one that needs the memory.
+    """
+    models = registry.get()
+    field = Base64ImageField()
+    durations = {stage: [] for stage in STAGES}
+    peaks = {}
+    start = None
+
+    def record(stage):
+        nonlocal start
+        durations[stage].append(time.perf_counter() - start)
+        peaks[stage] = peak_rss_mb()
+        start = time.perf_counter()
+
+    for _ in range(repeat):
+        start = time.perf_counter()
+        image = field.to_internal_value(SimpleUploadedFile(f"face.{image_format}", image_bytes))
+        record("decode")
+        pixels = load_pixels(image)
+        box = detect_face(models.detector, pixels)
+        record("detect")
+        face = crop_face(image, pixels, box)
+        record("align")
+        embeddings = embed_faces(models.embedder, [face])
+        record("embed")
+        request = {"age": age, "gender": gender, "score": True, "classification": True}
+        predict_heads(models, build_features(embeddings[0], age, gender), [request])
+        record("heads")
+
+    return {stage: dict(summarize(durations[stage]), peak_rss_mb=peaks[stage]) for stage in STAGES}
+
+
+def benchmark_detectors(images, detectors, repeat=1):
+    """Run every detector over the images `repeat` times and return its latency and detection rate.
+
+    `images` are RGB arrays, `detectors` maps names to detectors. The detection rate is the share of the images in
+    which the detector found at least one face, on photos that all show a face it is the recall. `faces` is the number
+    of faces found in all images.
+    """
+    results = {}
+    for name, detector in detectors.items():
+        durations, detected, faces = [], 0, 0
+        for pixels in images:
+            for _ in range(repeat):
+                start = time.perf_counter()
+                rects = detector(pixels)
+                durations.append(time.perf_counter() - start)
+            detected += bool(rects)
+            faces += len(rects)
+        results[name] = dict(
+            summarize(durations), detection_rate=detected / len(images) if images else None, faces=faces
+        )
+    return results
+
+
+def post_json(url, body, timeout=600):
+    """POST a JSON body over HTTP and return the status code."""
+    request = urllib.request.Request(
+        url,
+        data=body,
+        # the production settings redirect requests that didn't arrive over HTTPS at nginx
+        headers={"Content-Type": "application/json", "X-Forwarded-Proto": "https"},
+    )
+    try:
+        with urllib.request.urlopen(request, timeout=timeout) as response:
+            response.read()
+            return response.status
+    except urllib.error.HTTPError as exc:
+        return exc.code
+
+
+def wait_until_ready(health_url, timeout, process=None):
+    """Poll the health endpoint until it answers with status 200.
+
+    Fails if `process` exits, the health check answers with an error other than 503, or it takes too long.
+    """
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process is not None and process.poll() is not None:
+            raise RuntimeError(f"The server exited with status {process.returncode}")
+        try:
+            with urllib.request.urlopen(health_url, timeout=5) as response:
+                if response.status == 200:
+                    return
+        except urllib.error.HTTPError as exc:
+            # 503 while the models are loading, anything else won't go away by waiting
+            if exc.code != 503:
+                raise RuntimeError(f"The health check answered with status {exc.code}")
+        except (urllib.error.URLError, ConnectionError):
+            pass
+        time.sleep(0.5)
+    raise RuntimeError(f"The server wasn't ready after {timeout} seconds")
+
+
+def benchmark_http(url, body, requests, concurrency):
+    """POST `body` `requests` times with `concurrency` parallel connections and return latency and throughput."""
+
+    def timed_post(_):
+        start = time.perf_counter()
+        status = post_json(url, body)
+        return time.perf_counter() - start, status
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(timed_post, range(requests)))
+    elapsed = time.perf_counter() - start
+    errors = [status for _, status in results if status != 201]
+    return dict(
+        summarize([duration for duration, _ in results]),
+        requests=len(results),
+        errors=len(errors),
+        error_statuses=dict(Counter(errors)),
+        requests_per_second=len(results) / elapsed,
+    )
@@ -0,0 +1,240 @@
+"""Score archives of photos offline, see the `score_bulk` management command.
+
+The photos are listed by a CSV manifest (an `image` column with the path of each photo relative to the manifest, and
+the `age` and `gender` columns, optionally `id`, `score` and `classification`) or are all images in a directory. A
+pool of processes validates and decodes the images and detects and crops the faces, each with its own face detector.
+The main process embeds the faces in batches and runs the score and classification models.
+
+Every row goes through `FaceDetectionInputSerializer` and the results through `FaceDetectionOutputSerializer`, so the
+same rows are rejected and the results are the same as with the API. The results are written in the order of the
+input, one batch at a time, to a CSV or JSON Lines file. Rows that are in the output file already are skipped, so an
+interrupted run continues where it stopped. Rows are identified by the `id` column of the manifest (the row number if
+there is none) or the path of the image in the directory.
+"""
+import csv
+import json
+import multiprocessing
+import os
+from collections import deque
+from itertools import islice
+from types import SimpleNamespace
+
+import django
+import numpy as np
+from django.core.files import File
+
+from .embedding_store import record_embeddings
+from .inference import ImageAnalysis, NoFaceDetected, build_features, embed_faces, predict_heads
+from .registry import build_detector, registry
+from .serializers import FaceDetectionInputSerializer, FaceDetectionOutputSerializer
+
+FORMATS = ("csv", "jsonl")
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".gif", ".bmp", ".tif", ".tiff", ".webp")
+INPUT_FIELDS = ("age", "gender", "score", "classification")
+OUTPUT_FIELDS = ("id", "image", "age", "gender", "score", "classification", "errors")
+# batches of rows the workers prepare ahead of the batch being embedded, the face crops of more rows aren't kept
+PREPARE_AHEAD_BATCHES = 2
+
+# face detector of a worker process, built by init_worker
+_detector = None
+
+
+def read_manifest(path):
+    """Return `(row_id, image, image_path, data)` for every row of a CSV manifest."""
+    base_dir = os.path.dirname(os.path.abspath(path))
+    with open(path, newline="") as manifest:
+        reader = csv.DictReader(manifest)
+        if "image" not in (reader.fieldnames or ()):
+            raise ValueError(f"The manifest {path} has no image column")
+        items = []
+        for number, row in enumerate(reader, start=1):
+            # empty cells are treated like missing fields, so the defaults of the serializer apply
+            data = {field: row[field] for field in INPUT_FIELDS if row.get(field) not in (None, "")}
+            row_id = row.get("id") or str(number)
+            items.append((row_id, row["image"], os.path.join(base_dir, row["image"]), data))
+    return items
+
+
+def read_directory(path, age=None, gender=None):
+    """Yield `(row_id, image, image_path, data)` for the images in a directory and its subdirectories.
+
+    The row id and image are the path relative to the directory, `age` and `gender` are used for all images.
+    """
+    data = {field: value for field, value in (("age", age), ("gender", gender)) if value is not None}
+    for directory, subdirectories, file_names in os.walk(path):
+        subdirectories.sort()
+        for file_name in sorted(file_names):
+            if file_name.lower().endswith(IMAGE_EXTENSIONS):
+                image_path = os.path.join(directory, file_name)
+                image = os.path.relpath(image_path, path)
+                yield image, image, image_path, dict(data)
+
+
+def init_worker():
+    """Set up Django and build the face detector in a worker process."""
+    global _detector
+    django.setup()
+    _detector = build_detector()
+
+
+def prepare_row(item):
+    """Validate a row like the API does, detect the face and crop it. Runs in the worker processes.
+
+    Returns the row id, the analysis request without the image, the face crop (None if no head was requested) and
+    the validation errors (None for valid rows).
+    """
+    row_id, image, image_path, data = item
+    prepared = {"id": row_id, "image": image, "hash": None, "request": None, "face": None, "errors": None}
+    try:
+        image_file = open(image_path, "rb")
+    except OSError as exc:
+        prepared["errors"] = {"image": [f"The file could not be read: {exc.strerror}."]}
+        return prepared
+
+    with image_file:
+        serializer = FaceDetectionInputSerializer(data={**data, "image": File(image_file, name=image)})
+        if not serializer.is_valid():
+            errors = serializer.errors
+            prepared["errors"] = {field: [str(error) for error in errors[field]] for field in errors}
+            return prepared
+        request = serializer.get_analysis_request(serializer.validated_data)
+        prepared["hash"] = request["image"].content_hash
+        analysis = ImageAnalysis(request, SimpleNamespace(detector=_detector))
+        try:
+            if analysis.needs_embedding:
+                prepared["face"] = analysis.faces[0]
+            else:
+                # the face is detected even if no head was requested, like in the API
+                analysis.boxes
+        except NoFaceDetected as exc:
+            prepared["errors"] = {"image": [str(exc)]}
+            return prepared
+    prepared["request"] = {key: value for key, value in request.items() if key not in ("image", "models")}
+    return prepared
+
+
+def prepare_rows(pool, items, window):
+    """Yield the prepared rows of the items in order, with at most `window` rows submitted to the pool at a time.
+
+    `Pool.imap` submits all items right away, the face crops of a large archive would pile up in memory while the
+    main process embeds them.
+    """
+    items = iter(items)
+    pending = deque(pool.apply_async(prepare_row, (item,)) for item in islice(items, window))
+    while pending:
+        prepared = pending.popleft().get()
+        for item in islice(items, 1):
+            pending.append(pool.apply_async(prepare_row, (item,)))
+        yield prepared
+
+
+def score_batch(prepared_rows, models):
+    """Embed the faces of prepared rows in one forward pass, run the heads and return a result per row."""
+    with_faces = [prepared for prepared in prepared_rows if prepared["face"] is not None]
+    head_results = iter(())
+    if with_faces:
+        embeddings = embed_faces(models.embedder, [prepared["face"] for prepared in with_faces])
+        features = np.vstack([
+            build_features(embedding, prepared["request"]["age"], prepared["request"]["gender"])
+            for embedding, prepared in zip(embeddings, with_faces)
+        ])
+        head_results = iter(predict_heads(models, features, [prepared["request"] for prepared in with_faces]))
+        record_embeddings(
+            [prepared["hash"] for prepared in with_faces],
+            embeddings,
+            [prepared["request"]["age"] for prepared in with_faces],
+            [prepared["request"]["gender"] for prepared in with_faces],
+            [prepared["request"].get("profile", "default") for prepared in with_faces],
+            models.version,
+        )
+
+    results = []
+    for prepared in prepared_rows:
+        if prepared["errors"] is not None:
+            results.append({"id": prepared["id"], "image": prepared["image"], "errors": prepared["errors"]})
+            continue
+        if prepared["face"] is not None:
+            result = next(head_results)
+        else:
+            result = {"age": prepared["request"]["age"], "gender": prepared["request"]["gender"]}
+        output = FaceDetectionOutputSerializer(result).data
+        results.append({"id": prepared["id"], "image": prepared["image"], **output})
+    return results
+
+
+def score_rows(items, workers, batch_size, models=None):
+    """Yield the results of `(row_id, image, image_path, data)` items batch by batch, in the order of the items.
+
+    `workers` processes prepare the rows, 0 prepares them in this process. `batch_size` is the number of faces
+    embedded together.
+    """
+    if workers:
+        # the pool is started before the models are loaded, the workers don't need TensorFlow
+        pool = multiprocessing.Pool(workers, initializer=init_worker)
+        prepared_rows = prepare_rows(pool, items, max(PREPARE_AHEAD_BATCHES * batch_size, 2 * workers))
+    else:
+        pool = None
+        init_worker()
+        prepared_rows = map(prepare_row, items)
+
+    try:
+        models = models or registry.get()
+        batch, faces = [], 0
+        for prepared in prepared_rows:
+            batch.append(prepared)
+            faces += prepared["face"] is not None
+            if faces >= batch_size:
+                yield score_batch(batch, models)
+                batch, faces = [], 0
+        if batch:
+            yield score_batch(batch, models)
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+
+
+def completed_rows(path, output_format):
+    """Return the ids of the rows in an output file of an earlier run.
+
+    A line that was cut off when the run was interrupted is removed from the file.
+    """
+    if not os.path.exists(path):
+        return set()
+    with open(path, "rb+") as output:
+        content = output.read()
+        complete = content.rfind(b"\n") + 1
+        if complete < len(content):
+            output.truncate(complete)
+    lines = content[:complete].decode().splitlines()
+    if output_format == "csv":
+        return {row["id"] for row in csv.DictReader(lines)}
+    return {json.loads(line)["id"] for line in lines if line.strip()}
+
+
+class ResultWriter:
+    """Append results to a CSV or JSON Lines file, the rows of earlier runs are in `completed`."""
+
+    def __init__(self, path, output_format):
+        if output_format not in FORMATS:
+            raise ValueError(f"Unknown output format {output_format!r}, expected one of {', '.join(FORMATS)}")
+        self.output_format = output_format
+        self.completed = completed_rows(path, output_format)
+        self.file = open(path, "a", newline="")
+        if output_format == "csv":
+            self.writer = csv.DictWriter(self.file, OUTPUT_FIELDS)
+            if not self.file.tell():
+                self.writer.writeheader()
+
+    def write(self, results):
+        for result in results:
+            if self.output_format == "csv":
+                errors = result.get("errors")
+                self.writer.writerow({**result, "errors": json.dumps(errors) if errors else ""})
+            else:
+                self.file.write(json.dumps(result) + "\n")
+        # only the last line can be cut off if the run is interrupted, the next run removes it
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
@@ -0,0 +1,43 @@
+"""Cache of analysis results, keyed by the content of the image and the request parameters.
+
+Mobile clients retry uploads on flaky connections, so the same photo often arrives several times. The results are
+stored in the Django cache `MERON_RESULT_CACHE_ALIAS` (see `CACHES` in the settings), which is a per-worker LRU cache
+by default and can point to a file based or shared backend instead.
+"""
+from django.conf import settings
+from django.core.cache import caches
+
+from .registry import registry
+
+
+def get_result_cache():
+    """Return the result cache, or None if caching is disabled."""
+    if not settings.MERON_RESULT_CACHE:
+        return None
+    return caches[settings.MERON_RESULT_CACHE_ALIAS]
+
+
+def key_value(value):
+    """Return a value of the request, or a list of values per face, without the spaces memcached doesn't allow."""
+    if isinstance(value, list):
+        return ",".join(str(item) for item in value)
+    return value
+
+
+def result_cache_key(analysis_request):
+    """Return the cache key for the keyword arguments of analyze_image.
+
+    The image is identified by the SHA-256 hash of its content, all other arguments and the model version are part of
+    the key as well.
+    """
+    models = analysis_request.get("models")
+    return "meron:result:{}:{}:{}:{}:{:d}:{:d}:{:d}:{}".format(
+        models.version if models is not None else registry.version,
+        analysis_request["image"].content_hash,
+        key_value(analysis_request["age"]),
+        key_value(analysis_request["gender"]),
+        bool(analysis_request["score"]),
+        bool(analysis_request["classification"]),
+        bool(analysis_request.get("all_faces")),
+        analysis_request.get("profile", "default"),
+    )
@@ -0,0 +1,112 @@
+"""How the cores of the machine are divided between gunicorn workers and the thread pools of the inference libraries.
+
+TensorFlow, onnxruntime, OpenCV and the BLAS/OpenMP libraries each start a thread pool with one thread per core by
+default. With several workers per machine that oversubscribes the cores many times over. The topology decides the
+number of workers and the number of threads each worker's libraries may use:
+
+- `per-core`: one single threaded worker per core. Requests don't compete for cores, which gives the highest
+  throughput under load, but every request is computed on one core.
+- `threaded`: few workers (one by default) whose libraries use all cores, each worker handles several requests at
+  the same time with threads. Single requests are faster, which is better under low load, and concurrent requests can
+  be embedded in one batch (`MERON_MICRO_BATCHING`).
+- `async`: like `threaded`, but the worker is an ASGI server (uvicorn) running meron_api/asgi.py. Request bodies are
+  received on the event loop, so slow uploads don't hold a thread, and only complete requests are run by the threads.
+
+Only the standard library is used here, gunicorn imports this module before Django is set up.
+"""
+import math
+import os
+
+TOPOLOGIES = ("per-core", "threaded", "async")
+# gunicorn worker class of the async topology
+ASGI_WORKER_CLASS = "uvicorn.workers.UvicornWorker"
+
+# environment variables that limit the thread pools of OpenMP, the BLAS libraries behind numpy and scikit-learn, and
+# TensorFlow. They have to be set before the libraries are imported.
+THREAD_VARIABLES = (
+    "OMP_NUM_THREADS",
+    "OPENBLAS_NUM_THREADS",
+    "MKL_NUM_THREADS",
+    "NUMEXPR_NUM_THREADS",
+    "TF_NUM_INTRAOP_THREADS",
+)
+
+
+def cgroup_cpu_quota():
+    """Return the number of cores the CPU quota of the container allows (can be fractional), or None."""
+    try:
+        # cgroup v2
+        with open("/sys/fs/cgroup/cpu.max") as cpu_max:
+            quota, period = cpu_max.read().split()
+        return None if quota == "max" else int(quota) / int(period)
+    except (OSError, ValueError):
+        pass
+    try:
+        # cgroup v1
+        with open("/sys/fs/cgroup/cpu/cpu.cfs_quota_us") as quota_file:
+            quota = int(quota_file.read())
+        with open("/sys/fs/cgroup/cpu/cpu.cfs_period_us") as period_file:
+            period = int(period_file.read())
+        return quota / period if quota > 0 else None
+    except (OSError, ValueError):
+        return None
+
+
+def available_cores():
+    """Return the number of cores this process can use, respecting the CPU affinity and the container's quota."""
+    try:
+        cores = len(os.sched_getaffinity(0))
+    except AttributeError:
+        cores = os.cpu_count() or 1
+    quota = cgroup_cpu_quota()
+    if quota is not None:
+        cores = min(cores, max(math.floor(quota), 1))
+    return cores
+
+
+def topology(mode, cores, workers=0, threads=0, inference_threads=0):
+    """Return the number of workers, their class and threads, and the threads of the inference libraries per worker.
+
+    Values that are not 0 override the defaults of the mode.
+    """
+    if mode == "per-core":
+        workers = workers or cores
+        threads = threads or 1
+    elif mode in ("threaded", "async"):
+        workers = workers or 1
+        threads = threads or 4
+    else:
+        raise ValueError(f"Unknown topology {mode!r}, expected one of {', '.join(TOPOLOGIES)}")
+    if mode == "async":
+        worker_class = ASGI_WORKER_CLASS
+    else:
+        worker_class = "gthread" if threads > 1 else "sync"
+    return {
+        "workers": workers,
+        "worker_class": worker_class,
+        "threads": threads,
+        "inference_threads": inference_threads or max(cores // workers, 1),
+    }
+
+
+def limit_thread_pools(threads):
+    """Set the environment variables that limit the thread pools of the libraries, unless they are set already."""
+    for variable in THREAD_VARIABLES:
+        os.environ.setdefault(variable, str(threads))
+    # TensorFlow runs the independent operations of the graph in a separate pool, the embedding network has few
+    os.environ.setdefault("TF_NUM_INTEROP_THREADS", "1")
+
+
+def configure_tensorflow(threads):
+    """Limit TensorFlow's thread pools, this has to happen before TensorFlow runs the first operation."""
+    import tensorflow as tf
+
+    tf.config.threading.set_intra_op_parallelism_threads(threads)
+    tf.config.threading.set_inter_op_parallelism_threads(1)
+
+
+def configure_opencv(threads):
+    """Limit OpenCV's thread pool, which the opencv-dnn face detector uses."""
+    import cv2
+
+    cv2.setNumThreads(threads)
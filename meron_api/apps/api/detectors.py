@@ -0,0 +1,180 @@
+"""Face detectors that find the faces the embedding network analyzes.
+
+A detector is called with an RGB uint8 array and returns the faces as rectangles with the interface of
+dlib.rectangle (`left()`, `top()`, `right()`, `bottom()`). The backends trade accuracy for speed:
+
+- `dlib-hog`: dlib's HOG detector, the one the models were trained with. Each upsampling level doubles the image size
+  and finds faces half as large, at about four times the cost.
+- `dlib-cnn`: dlib's MMOD CNN detector, more robust to rotated and partly covered faces, but much slower on a CPU.
+- `opencv-dnn`: OpenCV's ResNet-10 SSD face detector, fast and robust. Upsampling doubles the input of the network.
+
+The deployment picks a backend for the `default` profile and one for the `fast` profile (`MERON_DETECTOR` and
+`MERON_FAST_DETECTOR`), requests choose the profile. Faces smaller than the minimum face size of the profile are
+ignored. The libraries are only imported when a detector is built.
+
+The model files of `dlib-cnn` and `opencv-dnn` aren't part of the repository, `MODEL_FILES` lists where to download
+them. Building a detector whose files are missing raises ImproperlyConfigured.
+"""
+import os
+import threading
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+
+BACKENDS = ("dlib-hog", "dlib-cnn", "opencv-dnn")
+PROFILES = ("default", "fast")
+# the settings with the paths of the model files each backend needs, and where to download them
+MODEL_FILES = {
+    "dlib-cnn": (
+        ("MERON_DLIB_CNN_MODEL", "http://dlib.net/files/mmod_human_face_detector.dat.bz2 (decompress it)"),
+    ),
+    "opencv-dnn": (
+        (
+            "MERON_OPENCV_DNN_CONFIG",
+            "https://raw.githubusercontent.com/opencv/opencv/master/samples/dnn/face_detector/deploy.prototxt",
+        ),
+        (
+            "MERON_OPENCV_DNN_MODEL",
+            "https://raw.githubusercontent.com/opencv/opencv_3rdparty/dnn_samples_face_detector_20170830/"
+            "res10_300x300_ssd_iter_140000.caffemodel",
+        ),
+    ),
+}
+
+
+class FaceRect:
+    """Rectangle with the interface of dlib.rectangle, for detectors that don't return dlib's own."""
+
+    def __init__(self, left, top, right, bottom):
+        self._box = (left, top, right, bottom)
+
+    def left(self):
+        return self._box[0]
+
+    def top(self):
+        return self._box[1]
+
+    def right(self):
+        return self._box[2]
+
+    def bottom(self):
+        return self._box[3]
+
+
+def large_enough(rects, min_face_size):
+    """Return the rectangles whose shorter side is at least `min_face_size` pixels."""
+    return [
+        rect for rect in rects if min(rect.right() - rect.left(), rect.bottom() - rect.top()) >= min_face_size
+    ]
+
+
+class DlibHOGDetector:
+    """dlib's frontal face detector, a HOG feature pyramid with a linear classifier."""
+
+    def __init__(self, upsample=1, min_face_size=0):
+        # the heavy libraries are imported here, so importing this module stays cheap
+        import dlib
+
+        self.upsample = upsample
+        self.min_face_size = min_face_size
+        self.detector = dlib.get_frontal_face_detector()
+
+    def __call__(self, pixels):
+        return large_enough(self.detector(pixels, self.upsample), self.min_face_size)
+
+
+class DlibCNNDetector:
+    """dlib's MMOD CNN face detector, `model_path` is the file `mmod_human_face_detector.dat`."""
+
+    def __init__(self, model_path, upsample=1, min_face_size=0):
+        import dlib
+
+        self.upsample = upsample
+        self.min_face_size = min_face_size
+        self.detector = dlib.cnn_face_detection_model_v1(model_path)
+
+    def __call__(self, pixels):
+        detections = self.detector(pixels, self.upsample)
+        return large_enough([detection.rect for detection in detections], self.min_face_size)
+
+
+class OpenCVDNNDetector:
+    """OpenCV's SSD face detector, `config_path` is its `deploy.prototxt` and `model_path` its caffemodel."""
+
+    # the network was trained on 300x300 BGR images with these channel means subtracted
+    INPUT_SIZE = 300
+    MEAN = (104.0, 177.0, 123.0)
+
+    def __init__(self, config_path, model_path, upsample=0, min_face_size=0, confidence=0.5):
+        import cv2
+
+        self.cv2 = cv2
+        self.input_size = self.INPUT_SIZE * 2 ** upsample
+        self.min_face_size = min_face_size
+        self.confidence = confidence
+        self.network = cv2.dnn.readNetFromCaffe(config_path, model_path)
+        # the input of the network is set before each forward pass, threads must not interleave them
+        self._lock = threading.Lock()
+
+    def __call__(self, pixels):
+        height, width = pixels.shape[:2]
+        blob = self.cv2.dnn.blobFromImage(
+            pixels, 1.0, (self.input_size, self.input_size), self.MEAN, swapRB=True, crop=False
+        )
+        with self._lock:
+            self.network.setInput(blob)
+            # one row per detection: image id, class, confidence and the box relative to the image size
+            detections = self.network.forward()[0, 0]
+        rects = [
+            FaceRect(int(left * width), int(top * height), int(right * width), int(bottom * height))
+            for _, _, confidence, left, top, right, bottom in detections
+            if confidence >= self.confidence
+        ]
+        return large_enough(rects, self.min_face_size)
+
+
+def check_model_files(backend):
+    """Raise ImproperlyConfigured if a model file the backend needs doesn't exist."""
+    for setting, source in MODEL_FILES.get(backend, ()):
+        path = getattr(settings, setting)
+        if not os.path.isfile(path):
+            raise ImproperlyConfigured(
+                f"The {backend} face detector needs the file {path} ({setting}), download it from {source}"
+            )
+
+
+def create_detector(backend, upsample=0, min_face_size=0):
+    """Build a detector of one of the BACKENDS, with the model files configured in the settings.
+
+    Raises ImproperlyConfigured for unknown backends and missing model files.
+    """
+    if backend not in BACKENDS:
+        raise ImproperlyConfigured(f"Unknown face detector {backend!r}, expected one of {', '.join(BACKENDS)}")
+    check_model_files(backend)
+    if backend == "dlib-hog":
+        return DlibHOGDetector(upsample, min_face_size)
+    if backend == "dlib-cnn":
+        return DlibCNNDetector(settings.MERON_DLIB_CNN_MODEL, upsample, min_face_size)
+    # opencv-dnn
+    from .cpu import configure_opencv
+
+    if settings.MERON_INFERENCE_THREADS:
+        configure_opencv(settings.MERON_INFERENCE_THREADS)
+    return OpenCVDNNDetector(
+        settings.MERON_OPENCV_DNN_CONFIG,
+        settings.MERON_OPENCV_DNN_MODEL,
+        upsample,
+        min_face_size,
+        settings.MERON_OPENCV_DNN_CONFIDENCE,
+    )
+
+
+def profile_options(profile):
+    """Return the backend, upsampling level and minimum face size of a profile."""
+    if profile == "fast":
+        return (
+            settings.MERON_FAST_DETECTOR,
+            settings.MERON_FAST_DETECTOR_UPSAMPLE,
+            settings.MERON_FAST_DETECTOR_MIN_FACE_SIZE,
+        )
+    return settings.MERON_DETECTOR, settings.MERON_DETECTOR_UPSAMPLE, settings.MERON_DETECTOR_MIN_FACE_SIZE
@@ -0,0 +1,49 @@
+"""Networks that turn face crops into the embeddings the score and classification models were trained on.
+
+An embedder has a single method, `embed(faces)`, that takes a float32 array of shape (n, size, size, 3) with RGB
+values in the range 0-255 and returns an array with one embedding per face. Preprocessing the crops the way the
+network expects is up to the embedder.
+"""
+import numpy as np
+
+# mean BGR values subtracted by keras_vggface.utils.preprocess_input, version 1 is used for vgg16, version 2 for
+# resnet50 and senet50
+VGGFACE_MEANS = {
+    1: np.array([93.5940, 104.7624, 129.1863], dtype="float32"),
+    2: np.array([91.4953, 103.8827, 131.0912], dtype="float32"),
+}
+
+
+def vggface_preprocess(faces, model_name):
+    """Convert RGB face crops to the input of the VGGFace network, like keras_vggface.utils.preprocess_input.
+
+    Implemented with numpy, so the ONNX runtime doesn't need keras_vggface.
+    """
+    version = 1 if model_name == "vgg16" else 2
+    return np.asarray(faces, dtype="float32")[..., ::-1] - VGGFACE_MEANS[version]
+
+
+class VGGFaceEmbedder:
+    """VGGFace network without its classification layers, the output of the average pooling is the embedding.
+
+    `weights` are the arrays of `Model.get_weights()`, e.g. memory-mapped by weights.load_weights. By default
+    keras_vggface loads its own weight file.
+    """
+
+    def __init__(self, model_name, face_size, weights=None):
+        # the heavy libraries are imported here, so importing this module stays cheap
+        from keras_vggface.vggface import VGGFace
+
+        self.model_name = model_name
+        self.network = VGGFace(
+            model=model_name,
+            include_top=False,
+            input_shape=(face_size, face_size, 3),
+            pooling="avg",
+            weights="vggface" if weights is None else None,
+        )
+        if weights is not None:
+            self.network.set_weights(weights)
+
+    def embed(self, faces):
+        return self.network.predict(vggface_preprocess(faces, self.model_name))
@@ -0,0 +1,246 @@
+"""Store of the face embeddings calculated by the API and by bulk scoring.
+
+Face detection and the embedding network take nearly all of the time of an analysis, the score and classification
+models on top are cheap. When new versions of those models are trained, the `rescore_embeddings` management command
+runs them over the stored embeddings, which takes seconds instead of analyzing all images again.
+
+The store is a directory with three files, shared by all processes of a host:
+
+- `embeddings.f32`: the embeddings as raw 32 bit floats, one row per record, read as a memory-mapped numpy array
+- `index.bin`: a fixed-size record per row with the SHA-256 hash of the image, the age and gender, the version of the
+  models and the detector profile that calculated the embedding and the time it was recorded
+- `meta.json`: the size of the embeddings, the embedding network that calculated them and the format of the index
+
+Records are only appended. The embedding is written before its index record, so a process that is killed while
+writing leaves no partial records behind. Every image is stored once per age, gender, model version and profile it was
+analyzed with. Each process remembers the keys of the last `MERON_EMBEDDING_STORE_MAX_KEYS` records it has seen, an
+image analyzed again after that many others is stored again.
+"""
+import fcntl
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+import numpy as np
+from django.conf import settings
+
+from .metrics import stage_timer
+
+logger = logging.getLogger(__name__)
+
+EMBEDDINGS_FILE = "embeddings.f32"
+INDEX_FILE = "index.bin"
+META_FILE = "meta.json"
+LOCK_FILE = "lock"
+EMBEDDING_DTYPE = np.dtype("<f4")
+# the hash is stored as raw bytes, "S32" would strip trailing zero bytes
+INDEX_DTYPE = np.dtype([
+    ("hash", "u1", (32,)),
+    ("age", "<i4"),
+    ("gender", "S1"),
+    ("version", "S32"),
+    ("profile", "S8"),
+    ("recorded", "<f8"),
+])
+# stores written with another layout of the index can't be read
+INDEX_FORMAT = 2
+
+
+def record_key(record):
+    return (record["hash"].tobytes(), int(record["age"]), record["gender"], record["version"], record["profile"])
+
+
+class EmbeddingStore:
+    """Append-only store of embeddings keyed by the content hash of the image, age, gender, model version and profile.
+
+    `max_keys` is the number of keys of recent records kept in memory to skip images that are stored already.
+    """
+
+    def __init__(self, directory, model_name, max_keys=100000):
+        self.directory = directory
+        self.model_name = model_name
+        self.max_keys = max_keys
+        # the keys of the records this process has seen last, updated from the index before every write
+        self._keys = OrderedDict()
+        self._rows = 0
+        self._lock = threading.Lock()
+
+    def path(self, name):
+        return os.path.join(self.directory, name)
+
+    @contextmanager
+    def locked(self):
+        """Hold the lock of the store, which serializes writes of all processes on the host."""
+        os.makedirs(self.directory, exist_ok=True)
+        with self._lock, open(self.path(LOCK_FILE), "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def meta(self):
+        """Return the size of the embeddings and the network that calculated them, None for an empty store.
+
+        Raises ValueError if the index has another format.
+        """
+        try:
+            with open(self.path(META_FILE)) as meta_file:
+                meta = json.load(meta_file)
+        except FileNotFoundError:
+            return None
+        if meta.get("format", 1) != INDEX_FORMAT:
+            raise ValueError(
+                f"The store {self.directory} was written by an older version of the API, move it away to start a "
+                "new one"
+            )
+        return meta
+
+    def __len__(self):
+        try:
+            return os.path.getsize(self.path(INDEX_FILE)) // INDEX_DTYPE.itemsize
+        except FileNotFoundError:
+            return 0
+
+    def add(self, hashes, embeddings, ages, genders, profiles, version):
+        """Record the embeddings of images with their hex SHA-256 hashes, ages, genders and detector profiles, and the
+        version of the models that calculated them. Returns the rows added.
+
+        Embeddings of a network with a different output size than the stored ones are rejected with a ValueError.
+        """
+        embeddings = np.atleast_2d(np.asarray(embeddings, dtype=EMBEDDING_DTYPE))
+        records = np.zeros(len(hashes), dtype=INDEX_DTYPE)
+        records["hash"] = [np.frombuffer(bytes.fromhex(content_hash), dtype="u1") for content_hash in hashes]
+        records["age"] = ages
+        records["gender"] = [gender.encode() for gender in genders]
+        records["version"] = version.encode()
+        records["profile"] = [profile.encode() for profile in profiles]
+        records["recorded"] = time.time()
+
+        with self.locked():
+            meta = self.meta()
+            if meta is None:
+                meta = {"dim": embeddings.shape[1], "model": self.model_name, "format": INDEX_FORMAT}
+                with open(self.path(META_FILE), "w") as meta_file:
+                    json.dump(meta, meta_file)
+            if meta["dim"] != embeddings.shape[1]:
+                raise ValueError(
+                    f"The store {self.directory} holds embeddings of size {meta['dim']} ({meta['model']}), "
+                    f"not {embeddings.shape[1]}"
+                )
+            self._read_new_keys()
+            new = []
+            for row, record in enumerate(records):
+                key = record_key(record)
+                if key in self._keys:
+                    self._keys.move_to_end(key)
+                else:
+                    self._remember(key)
+                    new.append(row)
+            if not new:
+                return 0
+
+            with open(self.path(EMBEDDINGS_FILE), "ab") as embeddings_file:
+                # a process killed between the two writes leaves an embedding without index record, it is overwritten
+                embeddings_file.truncate(self._rows * meta["dim"] * EMBEDDING_DTYPE.itemsize)
+                embeddings_file.write(embeddings[new].tobytes())
+            with open(self.path(INDEX_FILE), "ab") as index_file:
+                index_file.write(records[new].tobytes())
+            self._rows += len(new)
+        return len(new)
+
+    def _remember(self, key):
+        self._keys[key] = None
+        while len(self._keys) > self.max_keys:
+            self._keys.popitem(last=False)
+
+    def _read_new_keys(self):
+        """Add the keys of the records other processes appended since the last write of this process.
+
+        Only the last `max_keys` records are read, older keys would be dropped right away.
+        """
+        rows = len(self)
+        if rows > self._rows:
+            index = np.memmap(self.path(INDEX_FILE), dtype=INDEX_DTYPE, mode="r", shape=(rows,))
+            for record in index[max(self._rows, rows - self.max_keys):]:
+                self._remember(record_key(record))
+            self._rows = rows
+
+    def load(self):
+        """Return the index records and the embeddings as read-only memory-mapped arrays."""
+        rows = len(self)
+        meta = self.meta()
+        dim = meta["dim"] if meta else 0
+        if not rows:
+            return np.zeros(0, dtype=INDEX_DTYPE), np.zeros((0, dim), dtype=EMBEDDING_DTYPE)
+        index = np.memmap(self.path(INDEX_FILE), dtype=INDEX_DTYPE, mode="r", shape=(rows,))
+        embeddings = np.memmap(self.path(EMBEDDINGS_FILE), dtype=EMBEDDING_DTYPE, mode="r", shape=(rows, dim))
+        return index, embeddings
+
+
+def rescore(store, score_model, classification_model, chunk_size=10000):
+    """Run the score and classification models over all stored embeddings, chunk by chunk.
+
+    Yields a result dict per record with the hash of the image, its age and gender, the model version and profile
+    that calculated the embedding and when it was recorded.
+    """
+    # imported here, inference imports this module
+    from .inference import GENDER_CODES
+
+    index, embeddings = store.load()
+    for start in range(0, len(index), chunk_size):
+        records = index[start:start + chunk_size]
+        genders = [gender.decode() for gender in records["gender"]]
+        features = np.column_stack([
+            embeddings[start:start + chunk_size],
+            records["age"],
+            [GENDER_CODES[gender] for gender in genders],
+        ])
+        scores = score_model.predict(features)
+        classifications = classification_model.predict(features)
+        for record, gender, score, classification in zip(records, genders, scores, classifications):
+            yield {
+                "hash": record["hash"].tobytes().hex(),
+                "age": int(record["age"]),
+                "gender": gender,
+                "model_version": record["version"].decode(),
+                "profile": record["profile"].decode(),
+                "recorded": float(record["recorded"]),
+                "score": float(score),
+                "classification": str(classification),
+            }
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_embedding_store():
+    """Return the embedding store of this process, or None if storing embeddings is disabled in the settings."""
+    global _store
+    if not settings.MERON_EMBEDDING_STORE:
+        return None
+    with _store_lock:
+        if _store is None or _store.directory != settings.MERON_EMBEDDING_STORE_DIR:
+            _store = EmbeddingStore(
+                settings.MERON_EMBEDDING_STORE_DIR,
+                settings.MERON_VGGFACE_MODEL,
+                settings.MERON_EMBEDDING_STORE_MAX_KEYS,
+            )
+    return _store
+
+
+def record_embeddings(hashes, embeddings, ages, genders, profiles, version):
+    """Add embeddings to the store if it is enabled. Failing to store them is logged, the analysis goes on."""
+    store = get_embedding_store()
+    if store is None or not len(hashes):
+        return
+    try:
+        with stage_timer("store"):
+            store.add(hashes, embeddings, ages, genders, profiles, version)
+    except (OSError, ValueError):
+        logger.exception("Storing the embeddings failed")
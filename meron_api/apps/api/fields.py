@@ -1,16 +1,72 @@
 """Module that contains Base64ImageField and possibly other custom serializer fields."""
+import hashlib
 import logging
 import uuid
 import base64
 from io import BytesIO
 
-from django.core.files.base import ContentFile
-from PIL import Image
+import numpy as np
+from django.conf import settings
+from django.core.files.base import File
+from django.core.files.uploadedfile import UploadedFile
 from rest_framework import serializers
+from rest_framework.fields import empty
+from rest_framework.utils import html
+
+from .metrics import stage_timer
+from .preprocessing import ImageTooLarge, crop_array, crop_from_file, open_for_detection
 
 logger = logging.getLogger(__name__)
 
 
+class Base64UploadedFile(UploadedFile):
+    """Uploaded file that holds an image which was base64 decoded while the request body was parsed."""
+
+
+class RawUploadedFile(UploadedFile):
+    """Uploaded file that holds an image that was sent as the raw request body, see RawImageParser."""
+
+
+class DecodedImageFile(File):
+    """File that carries the decoded image, so later stages don't have to decode the file again.
+
+    It wraps the file object of the upload instead of copying its content.
+
+    - `image_format`: lower case PIL format name, e.g. `jpeg`
+    - `width` and `height`: dimensions of the original image in pixels
+    - `pixels`: RGB uint8 array of shape (height, width, 3), at most `MERON_DETECTION_MAX_SIDE` pixels wide and high
+    - `content_hash`: SHA-256 hash of the file content
+    """
+
+    def __init__(self, file, name, image, original_size, image_format):
+        super().__init__(file, name=name)
+        self.image_format = image_format.lower()
+        self.width, self.height = original_size
+        self.pixels = np.asarray(image if image.mode == "RGB" else image.convert("RGB"))
+        # calculated right away, Django closes uploaded files at the end of the request
+        with stage_timer("hash"):
+            digest = hashlib.sha256()
+            for chunk in self.chunks():
+                digest.update(chunk)
+            self.content_hash = digest.hexdigest()
+
+    def crop_face(self, box, size):
+        """Crop `box` (in coordinates of `pixels`) and resize it to `size` x `size` pixels.
+
+        If the face is smaller than `size` in `pixels`, the face is cropped from a higher resolution decode of the
+        file instead. That needs the file, so faces have to be cropped before the upload is closed at the end of the
+        request. Raises ValueError otherwise, instead of returning a crop of lower resolution.
+        """
+        left, top, right, bottom = box
+        small_face = min(right - left, bottom - top) < size
+        downscaled = self.pixels.shape[:2] != (self.height, self.width)
+        if small_face and downscaled:
+            if self.file.closed:
+                raise ValueError("The upload was closed before the face was cropped.")
+            return crop_from_file(self.file, box, (self.pixels.shape[1], self.pixels.shape[0]), size)
+        return crop_array(self.pixels, box, size)
+
+
 class Base64ImageField(serializers.ImageField):
     """A Django REST framework field for handling image-uploads through raw post data.
 
@@ -23,21 +79,45 @@ class Base64ImageField(serializers.ImageField):
     header. The field defined here allows to just include the base64 string without any special header. It uses PIL to
     determine the image format. The `imghdr` package from the standard library was tried but it failed to detect the
     format of a valid JPEG file in our tests.
+
+    Every upload is decoded exactly once, at the resolution used for face detection. The validated value is a
+    `DecodedImageFile` that holds the format, dimensions and pixels, so neither the base class nor the model have to
+    open the image again.
+
+    Images with more than `MERON_MAX_IMAGE_SIDE` pixels per side are rejected before they are decoded.
     """
 
-    def get_file_extension(self, file_name, decoded_file):
-        """Use PIL to detect the image format."""
-        # The image file has be opened again after img.verify() is used:
-        # http://pillow.readthedocs.io/en/4.2.x/reference/Image.html#PIL.Image.Image.verify
-        img = Image.open(decoded_file)
-        return img.format.lower()
+    default_error_messages = {
+        "too_large": "The image is {width}x{height} pixels, at most {max_side} pixels per side are accepted. "
+        "Downscale it before uploading it.",
+    }
+
+    def decode_image(self, image_file):
+        """Decode the image for face detection and return it with its original size and format.
+
+        Fails with `too_large` for images larger than `MERON_MAX_IMAGE_SIDE` and with `invalid_image` for files that
+        can't be decoded.
+        """
+        try:
+            with stage_timer("decode"):
+                img, original_size = open_for_detection(
+                    image_file, settings.MERON_DETECTION_MAX_SIDE, settings.MERON_MAX_IMAGE_SIDE
+                )
+        except ImageTooLarge as exc:
+            self.fail("too_large", width=exc.size[0], height=exc.size[1], max_side=exc.max_side)
+        except Exception:
+            # PIL raises a variety of exceptions for invalid files (OSError, SyntaxError, ValueError,
+            # DecompressionBombError, ...), Django's ImageField catches all of them as well.
+            logger.exception('No valid image file could be decoded')
+            self.fail('invalid_image')
+        return img, original_size, img.format
 
     def to_internal_value(self, data):
-        """Check if we are dealing with a base64 encoded file.
+        """Check if we are dealing with a base64 encoded file, then decode the image once.
 
-        If yes, this is converted to a regular file and then passed to the `to_internal_value` method of the
-        baseclass.
-        When the `file` payload is not a base64 encoded string, it is passed to the base class as is.
+        When the `file` payload is a string it is base64 decoded. Otherwise it is an uploaded file, which has to pass
+        the checks of `FileField` (name, empty file, ...). The JSON parser base64 decodes images while it reads the
+        request, those arrive as `Base64UploadedFile`. Either way the image is decoded into a `DecodedImageFile`.
         """
         # Check if this is an image file. If not, we might be dealing with a base64 encoded image. We could also use
         # content negotation to check whether we are dealing with `application/json` or `multipart/form-data`, but it
@@ -45,22 +125,53 @@ class Base64ImageField(serializers.ImageField):
         if isinstance(data, str):
             # Try to b64decode the file. Return validation error if it fails.
             try:
-                decoded_string = base64.b64decode(data)
-                decoded_file = BytesIO(decoded_string)
-                img = Image.open(decoded_file)
-                img.verify()
-            except (OSError, base64.binascii.Error):
+                content = base64.b64decode(data)
+            except base64.binascii.Error:
                 logger.exception('No valid image file could be decoded')
                 self.fail('invalid_image')
 
-            # Generate file name:
-            file_name = str(uuid.uuid4())[:12]  # 12 characters are more than enough.
-            # Get the file name extension:
-            file_extension = self.get_file_extension(file_name, decoded_file)
+            data = Base64UploadedFile(BytesIO(content), name='image', size=len(content))
+
+        # we skip ImageField.to_internal_value, it would open and verify the image another time
+        uploaded_file = serializers.FileField.to_internal_value(self, data)
+        img, original_size, image_format = self.decode_image(uploaded_file.file)
+        file_name = uploaded_file.name
+        if isinstance(uploaded_file, (Base64UploadedFile, RawUploadedFile)):
+            # Generate file name, 12 characters are more than enough.
+            file_name = f'{str(uuid.uuid4())[:12]}.{image_format.lower()}'
+            logger.info('Generated filename for base64 encoded file: %s', file_name)
+        return DecodedImageFile(uploaded_file.file, file_name, img, original_size, image_format)
+
 
-            complete_file_name = f'{file_name}.{file_extension}'
-            logger.info('Generated filename for base64 encoded file: %s', complete_file_name)
+class PerFaceField(serializers.Field):
+    """A field that takes a single value, or a list with a value per face for requests that analyze all faces.
 
-            data = ContentFile(decoded_string, name=complete_file_name)
+    Every value is validated by `child`. Form data passes a list by repeating the field, e.g. `age=30&age=12`.
+    """
+
+    default_error_messages = {"empty": "This list may not be empty."}
+
+    def __init__(self, child, **kwargs):
+        self.child = child
+        super().__init__(**kwargs)
+        self.child.bind(field_name="", parent=self)
+
+    def get_value(self, dictionary):
+        if html.is_html_input(dictionary):
+            values = dictionary.getlist(self.field_name)
+            if not values:
+                return empty
+            return values if len(values) > 1 else values[0]
+        return dictionary.get(self.field_name, empty)
+
+    def to_internal_value(self, data):
+        if isinstance(data, list):
+            if not data:
+                self.fail("empty")
+            return [self.child.run_validation(value) for value in data]
+        return self.child.run_validation(data)
 
-        return super(Base64ImageField, self).to_internal_value(data)
+    def to_representation(self, value):
+        if isinstance(value, list):
+            return [self.child.to_representation(item) for item in value]
+        return self.child.to_representation(value)
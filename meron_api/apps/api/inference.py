@@ -0,0 +1,326 @@
+"""Run the malnutrition models on an image, using the models owned by the registry."""
+from io import BytesIO
+
+import numpy as np
+from django.conf import settings
+from django.utils.functional import cached_property
+from PIL import Image
+
+from .batching import get_batcher
+from .embedding_store import record_embeddings
+from .metrics import stage_timer
+from .preprocessing import crop_array
+from .registry import registry
+
+GENDER_CODES = {"f": 0, "m": 1}
+
+
+class AnalysisError(ValueError):
+    """Raised when an image can't be analyzed, `field` names the input that is at fault."""
+
+    field = "image"
+
+
+class NoFaceDetected(AnalysisError):
+    """Raised when the face detector doesn't find a face in the image."""
+
+
+class UnknownGender(AnalysisError):
+    """Raised when a head was requested for a face whose gender isn't one the models were trained with."""
+
+    field = "gender"
+
+    def __init__(self, gender):
+        super().__init__(f"The models need the gender of the face ({' or '.join(GENDER_CODES)}), got {gender!r}.")
+
+
+class FaceCountMismatch(AnalysisError):
+    """Raised when the list of ages or genders of a request with `all_faces` doesn't match the number of faces."""
+
+    def __init__(self, field, values, faces):
+        super().__init__(f"Got {values} values for the {faces} faces detected in the image.")
+        self.field = field
+
+
+def load_pixels(image):
+    """Return the image as an RGB uint8 array.
+
+    `image` can be an array that was decoded already (returned as is), a `DecodedImageFile` from `Base64ImageField`
+    (its cached pixels are returned), the encoded bytes or a file object. Nothing is written to disk.
+    """
+    if isinstance(image, np.ndarray):
+        return image
+    if getattr(image, "pixels", None) is not None:
+        return image.pixels
+    if isinstance(image, (bytes, bytearray, memoryview)):
+        image = BytesIO(image)
+    elif hasattr(image, "seek"):
+        # validating the upload reads the file, so we have to rewind it
+        image.seek(0)
+    with Image.open(image) as img:
+        return np.asarray(img.convert("RGB"))
+
+
+def detect_faces(detector, pixels):
+    """Return the bounding boxes (left, top, right, bottom) of all faces in the image, from left to right."""
+    rects = detector(pixels)
+    if not rects:
+        raise NoFaceDetected("No face could be detected in the image.")
+    height, width = pixels.shape[:2]
+    boxes = [(max(r.left(), 0), max(r.top(), 0), min(r.right(), width), min(r.bottom(), height)) for r in rects]
+    return sorted(boxes)
+
+
+def detect_face(detector, pixels):
+    """Return the bounding box (left, top, right, bottom) of the largest face in the image."""
+    return max(detect_faces(detector, pixels), key=lambda box: (box[2] - box[0]) * (box[3] - box[1]))
+
+
+def crop_face(image, pixels, box):
+    """Crop the face and resize it to the input size of the embedding network.
+
+    Validated uploads were decoded at reduced resolution for the detection, they crop the face at the resolution the
+    network needs themselves.
+    """
+    if hasattr(image, "crop_face"):
+        return image.crop_face(box, settings.MERON_FACE_SIZE)
+    return crop_array(pixels, box, settings.MERON_FACE_SIZE)
+
+
+def embed_faces(embedder, faces):
+    """Calculate the embeddings for a batch of face crops."""
+    return embedder.embed(np.stack(faces))
+
+
+def build_features(embeddings, age, gender):
+    """Append age (months) and gender to the embeddings, the way the score and classification models were trained.
+
+    The layout must stay that of the upstream pipeline, `python manage.py check_upstream_parity` compares the results.
+    Raises UnknownGender instead of guessing a gender the heads would score differently.
+    """
+    if gender not in GENDER_CODES:
+        raise UnknownGender(gender)
+    embeddings = np.atleast_2d(embeddings)
+    extra = np.tile([age, GENDER_CODES[gender]], (embeddings.shape[0], 1))
+    return np.hstack([embeddings, extra])
+
+
+def predict_heads(models, features, requests):
+    """Run the score and classification models over the feature rows of several requests at once.
+
+    Each model runs once, over the rows of the requests that asked for it. A model no request asked for doesn't run.
+    """
+    results = [{"age": request.get("age"), "gender": request.get("gender", "")} for request in requests]
+    heads = (("score", models.score_model, float), ("classification", models.classification_model, str))
+    for key, model, convert in heads:
+        rows = [index for index, request in enumerate(requests) if request.get(key, True)]
+        if rows:
+            with stage_timer(key):
+                predictions = model.predict(features[rows])
+            for index, prediction in zip(rows, predictions):
+                results[index][key] = convert(prediction)
+    return results
+
+
+class ImageAnalysis:
+    """The stages of the analysis of one image: detect, align, embed and the heads.
+
+    Every stage runs at most once, when its result is needed first, and later stages reuse it. Both heads share the
+    detection and the embedding, and the embedding is only calculated if at least one head was requested. Requests
+    with `all_faces` analyze every face in the image, the others only the largest one.
+    """
+
+    def __init__(self, request, models):
+        self.request = request
+        self.models = models
+        self.image = request["image"]
+        self.all_faces = bool(request.get("all_faces"))
+        # set by embed_analyses, which embeds the faces of several images in one batch, one row per face
+        self.embeddings = None
+
+    @property
+    def needs_embedding(self):
+        return bool(self.request.get("score", True) or self.request.get("classification", True))
+
+    @cached_property
+    def pixels(self):
+        return load_pixels(self.image)
+
+    @property
+    def detector(self):
+        """The face detector of the profile of the request, see detectors.py."""
+        if self.request.get("profile") == "fast":
+            return self.models.fast_detector
+        return self.models.detector
+
+    @cached_property
+    def boxes(self):
+        """Bounding boxes of the faces that are analyzed, raises NoFaceDetected if there is none."""
+        with stage_timer("detect"):
+            if self.all_faces:
+                return detect_faces(self.detector, self.pixels)
+            return [detect_face(self.detector, self.pixels)]
+
+    @cached_property
+    def faces(self):
+        """Face crops scaled to the input size of the embedding network."""
+        with stage_timer("align"):
+            return [crop_face(self.image, self.pixels, box) for box in self.boxes]
+
+    @cached_property
+    def face_requests(self):
+        """Age, gender and the requested heads for each face.
+
+        Requests with `all_faces` can pass a list with the age or gender of every face, from left to right. Raises
+        FaceCountMismatch if a list doesn't have a value for every face, and UnknownGender if a head was requested
+        for a face without a known gender.
+        """
+        values = {}
+        for field, default in (("age", None), ("gender", "")):
+            value = self.request.get(field, default)
+            if not isinstance(value, list):
+                value = [value] * len(self.boxes)
+            elif len(value) != len(self.boxes):
+                raise FaceCountMismatch(field, len(value), len(self.boxes))
+            values[field] = value
+        if self.needs_embedding:
+            for gender in values["gender"]:
+                if gender not in GENDER_CODES:
+                    raise UnknownGender(gender)
+        return [
+            {
+                "age": age,
+                "gender": gender,
+                "score": self.request.get("score", True),
+                "classification": self.request.get("classification", True),
+            }
+            for age, gender in zip(values["age"], values["gender"])
+        ]
+
+    @cached_property
+    def features(self):
+        return np.vstack([
+            build_features(embedding, face_request["age"], face_request["gender"])
+            for embedding, face_request in zip(self.embeddings, self.face_requests)
+        ])
+
+    def original_box(self, box):
+        """Return a bounding box in pixels of the uploaded image, large images are downscaled for face detection."""
+        height, width = self.pixels.shape[:2]
+        scale_x = getattr(self.image, "width", width) / width
+        scale_y = getattr(self.image, "height", height) / height
+        left, top, right, bottom = box
+        return {
+            "left": round(left * scale_x),
+            "top": round(top * scale_y),
+            "right": round(right * scale_x),
+            "bottom": round(bottom * scale_y),
+        }
+
+    def result(self, face_results):
+        """Return the result of the image: that of its face, or with `all_faces` the results and boxes of all faces."""
+        if not self.all_faces:
+            return face_results[0]
+        return {
+            "faces": [dict(result, box=self.original_box(box)) for box, result in zip(self.boxes, face_results)]
+        }
+
+
+def embed_analyses(analyses, models):
+    """Embed the faces of several analyses with one batched forward pass of the embedding network."""
+    faces = [face for analysis in analyses for face in analysis.faces]
+    if not faces:
+        return
+    batcher = get_batcher()
+    with stage_timer("embed"):
+        if batcher is not None:
+            # the faces are embedded together with the faces of other requests handled by this process, the stage
+            # includes the time spent waiting for the batch
+            embeddings = batcher.submit(models.embedder, faces)
+        else:
+            embeddings = embed_faces(models.embedder, faces)
+    start = 0
+    for analysis in analyses:
+        analysis.embeddings = embeddings[start:start + len(analysis.faces)]
+        start += len(analysis.faces)
+
+    # validated uploads know the hash of their content, images passed in directly aren't stored. The store keeps one
+    # embedding per image and age, so only the faces of single face requests are stored.
+    stored = [
+        analysis
+        for analysis in analyses
+        if not analysis.all_faces and getattr(analysis.image, "content_hash", None)
+    ]
+    record_embeddings(
+        [analysis.image.content_hash for analysis in stored],
+        [analysis.embeddings[0] for analysis in stored],
+        [analysis.request.get("age") for analysis in stored],
+        [analysis.request.get("gender", "") for analysis in stored],
+        [analysis.request.get("profile", "default") for analysis in stored],
+        models.version,
+    )
+
+
+def analyze_images(requests, models=None):
+    """Analyze several images with one batched forward pass of the embedding network.
+
+    `requests` is a list of dicts with the arguments of `analyze_image`. The returned list has the same order, it
+    contains the result dict for each image, or the `AnalysisError` for images that can't be analyzed, e.g.
+    `NoFaceDetected`. The faces are detected even if no head was requested, so images without a face are rejected
+    either way.
+    """
+    models = models or registry.get()
+    results = [None] * len(requests)
+    analyses = {}
+    for index, request in enumerate(requests):
+        analysis = ImageAnalysis(request, models)
+        try:
+            analysis.face_requests
+        except AnalysisError as exc:
+            results[index] = exc
+        else:
+            analyses[index] = analysis
+
+    embedded = [analysis for analysis in analyses.values() if analysis.needs_embedding]
+    embed_analyses(embedded, models)
+    if embedded:
+        features = np.vstack([analysis.features for analysis in embedded])
+        face_requests = [face_request for analysis in embedded for face_request in analysis.face_requests]
+        face_results = iter(predict_heads(models, features, face_requests))
+    for index, analysis in analyses.items():
+        if analysis.needs_embedding:
+            results[index] = analysis.result([next(face_results) for _ in analysis.face_requests])
+        else:
+            results[index] = analysis.result([
+                {"age": face_request["age"], "gender": face_request["gender"]}
+                for face_request in analysis.face_requests
+            ])
+    return results
+
+
+def analyze_image(
+    image, score=True, classification=True, age=None, gender="", all_faces=False, profile="default", models=None
+):
+    """Return the score and/or classification for the face in `image`.
+
+    `image` is anything `load_pixels` accepts: a decoded RGB array, a validated upload, the encoded bytes or a file
+    object. With `all_faces` every face in the image is analyzed and the result is `{"faces": [...]}` with the result
+    and the bounding box of each face, from left to right. `age` and `gender` can then be lists with a value per face.
+    `profile` selects the face detector, `fast` trades accuracy for speed (see detectors.py).
+
+    `models` defaults to the process-wide registry, which is loaded on first use if the wsgi module didn't load it
+    already.
+    """
+    request = {
+        "image": image,
+        "score": score,
+        "classification": classification,
+        "age": age,
+        "gender": gender,
+        "all_faces": all_faces,
+        "profile": profile,
+    }
+    result = analyze_images([request], models=models)[0]
+    if isinstance(result, AnalysisError):
+        raise result
+    return result
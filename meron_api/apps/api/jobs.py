@@ -0,0 +1,413 @@
+"""Asynchronous analysis jobs.
+
+A job is created for a validated request and answered with its id right away. The job store in `MERON_JOB_DIR` keeps
+one JSON file per job with its state, so every worker on the host can answer the polling requests. Until the job is
+finished, the store also keeps the uploaded image and the parameters of the analysis, so the job doesn't depend on
+the worker that accepted it:
+
+- `<id>.json`: the state of the job, returned to the clients that poll it
+- `<id>.image` and `<id>.input`: the image and the parameters, deleted when the job is finished
+- `<id>.claim`: created by the worker that runs the job, with its host, pid and the time it claimed the job. The
+  worker touches it every poll interval while the job runs.
+
+The job threads of all workers claim queued jobs from the store, the oldest first. A claim is created exclusively, so
+every job runs in one worker. If a worker dies or restarts while it runs a job (gunicorn's `max_requests`, a timeout,
+a deploy), its claim becomes stale: the process is gone (for workers on this host), or the claim wasn't touched for
+`MERON_JOB_STALE_AFTER` seconds (for workers on other hosts sharing the directory). Slow jobs of live workers are
+never run twice. The job threads requeue jobs with stale claims when they start and while they poll, a job that was
+interrupted `MERON_JOB_MAX_ATTEMPTS` times fails, and the idle job threads delete finished jobs `MERON_JOB_TTL` seconds
+after their last update. At most `MERON_JOB_QUEUE_SIZE` jobs wait or run at the same time, further submissions get
+status 503. The jobs are counted and the new job is stored under the lock of the store, like jobs are recovered.
+"""
+import fcntl
+import json
+import logging
+import os
+import socket
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from io import BytesIO
+
+from django.conf import settings
+from rest_framework.exceptions import ValidationError
+
+from .admission import Overloaded
+from .fields import RawUploadedFile
+from .registry import UnknownModelVersion, registry
+from .serializers import FaceDetectionInputSerializer, FaceDetectionOutputSerializer
+
+logger = logging.getLogger(__name__)
+
+STATUS_QUEUED = "queued"
+STATUS_RUNNING = "running"
+STATUS_DONE = "done"
+STATUS_FAILED = "failed"
+
+# suffixes of the files of a job besides its state
+INPUT_SUFFIX = ".input"
+IMAGE_SUFFIX = ".image"
+CLAIM_SUFFIX = ".claim"
+# seconds clients are asked to wait before they submit again when the queue is full
+QUEUE_FULL_RETRY_AFTER = 30
+# Seconds between two purges of expired jobs by the job threads of a worker
+PURGE_INTERVAL = 60
+
+
+def process_alive(pid):
+    """Return False if no process with `pid` exists on this host."""
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        # the process exists, but belongs to another user
+        return True
+    return True
+
+
+class JobStore:
+    """Store the state, the input and the claims of jobs as files in a directory."""
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def path(self, job_id, suffix=".json"):
+        return os.path.join(self.directory, f"{job_id}{suffix}")
+
+    def get(self, job_id):
+        """Return the job as dict, or None if it doesn't exist (anymore)."""
+        try:
+            with open(self.path(job_id)) as job_file:
+                return json.load(job_file)
+        except FileNotFoundError:
+            return None
+
+    def write(self, path, content):
+        """Write a file atomically, readers never see a partially written file."""
+        os.makedirs(self.directory, exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as tmp_file:
+            tmp_file.write(content)
+        os.replace(tmp_path, path)
+
+    def save(self, job):
+        self.write(self.path(job["id"]), json.dumps(job).encode())
+
+    def update(self, job_id, **fields):
+        job = self.get(job_id)
+        if job is None:
+            # the job expired and was purged in the meantime
+            return None
+        job.update(fields, updated=time.time())
+        self.save(job)
+        return job
+
+    @contextmanager
+    def locked(self):
+        """Hold the lock of the store, which the workers take to check and change the jobs of all workers at once."""
+        os.makedirs(self.directory, exist_ok=True)
+        with open(os.path.join(self.directory, ".lock"), "w") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            yield
+
+    def enqueue(self, job, job_input, content, max_unfinished=None):
+        """Store a new job with the parameters of its analysis and the image. The job can be claimed afterwards.
+
+        Returns False without storing the job if `max_unfinished` jobs are queued or running already.
+        """
+        image_path = self.path(job["id"], IMAGE_SUFFIX)
+        self.write(image_path, content)
+        with self.locked():
+            if max_unfinished is not None and len(self.unfinished()) >= max_unfinished:
+                os.remove(image_path)
+                return False
+            self.save(job)
+            # written last, job threads only claim jobs that have their input
+            self.write(self.path(job["id"], INPUT_SUFFIX), json.dumps(job_input).encode())
+        return True
+
+    def unfinished(self):
+        """Return the ids of the jobs that are queued or running, the oldest first."""
+        if not os.path.isdir(self.directory):
+            return []
+        entries = [entry for entry in os.scandir(self.directory) if entry.name.endswith(INPUT_SUFFIX)]
+        entries.sort(key=lambda entry: entry.stat().st_mtime)
+        return [entry.name[:-len(INPUT_SUFFIX)] for entry in entries]
+
+    def claim(self, job_id):
+        """Claim a job for this process, return False if another thread or worker claimed it already."""
+        claim = {"host": socket.gethostname(), "pid": os.getpid(), "claimed": time.time()}
+        try:
+            fd = os.open(self.path(job_id, CLAIM_SUFFIX), os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            return False
+        with os.fdopen(fd, "w") as claim_file:
+            json.dump(claim, claim_file)
+        return True
+
+    def claim_next(self):
+        """Claim the oldest queued job and return its id, or None if there is none."""
+        for job_id in self.unfinished():
+            if not os.path.exists(self.path(job_id, CLAIM_SUFFIX)) and self.claim(job_id):
+                # the job may have been finished between listing and claiming it
+                if os.path.exists(self.path(job_id, INPUT_SUFFIX)):
+                    return job_id
+                self.remove(job_id, CLAIM_SUFFIX)
+        return None
+
+    def load_input(self, job_id):
+        """Return the parameters of the analysis of a job and its image."""
+        with open(self.path(job_id, INPUT_SUFFIX)) as input_file:
+            job_input = json.load(input_file)
+        with open(self.path(job_id, IMAGE_SUFFIX), "rb") as image_file:
+            return job_input, image_file.read()
+
+    def remove(self, job_id, *suffixes):
+        for suffix in suffixes:
+            try:
+                os.remove(self.path(job_id, suffix))
+            except FileNotFoundError:
+                pass
+
+    def finish(self, job_id, **fields):
+        """Store the outcome of a job and delete its input and claim."""
+        job = self.update(job_id, **fields)
+        self.remove(job_id, INPUT_SUFFIX, IMAGE_SUFFIX, CLAIM_SUFFIX)
+        return job
+
+    def touch_claim(self, job_id):
+        """Mark the claim of a job as held by a live worker."""
+        try:
+            os.utime(self.path(job_id, CLAIM_SUFFIX))
+        except FileNotFoundError:
+            pass
+
+    def recover(self, stale_after, max_attempts):
+        """Requeue the jobs whose claim is stale, or fail them if they were interrupted `max_attempts` times.
+
+        Claims of workers on this host are stale once their process is gone. The liveness of workers on other hosts
+        can't be checked, their claims are stale when they weren't touched for `stale_after` seconds.
+
+        Returns the ids of the jobs that were requeued or failed.
+        """
+        if not os.path.isdir(self.directory):
+            return []
+        recovered = []
+        host = socket.gethostname()
+        # one worker at a time, so no claim is removed after another worker replaced it
+        with self.locked():
+            for entry in os.scandir(self.directory):
+                if not entry.name.endswith(CLAIM_SUFFIX):
+                    continue
+                job_id = entry.name[:-len(CLAIM_SUFFIX)]
+                try:
+                    with open(entry.path) as claim_file:
+                        claim = json.load(claim_file)
+                    touched = entry.stat().st_mtime
+                except (FileNotFoundError, ValueError):
+                    # finished in the meantime, or the claim is still being written
+                    continue
+                if claim["host"] == host:
+                    stale = not process_alive(claim["pid"])
+                else:
+                    stale = time.time() - touched >= stale_after
+                if not stale:
+                    continue
+                job = self.get(job_id) or {}
+                attempts = job.get("attempts", 0) + 1
+                if attempts >= max_attempts:
+                    logger.warning("Job %s was interrupted %s times, giving up", job_id, attempts)
+                    self.finish(
+                        job_id,
+                        status=STATUS_FAILED,
+                        attempts=attempts,
+                        errors={"non_field_errors": ["The analysis was interrupted."]},
+                    )
+                else:
+                    logger.warning("Requeueing job %s, its worker (pid %s) stopped running it", job_id, claim["pid"])
+                    self.update(job_id, status=STATUS_QUEUED, attempts=attempts)
+                    self.remove(job_id, CLAIM_SUFFIX)
+                recovered.append(job_id)
+        return recovered
+
+    def purge(self, max_age):
+        """Delete finished jobs that weren't updated for `max_age` seconds.
+
+        Queued and running jobs are kept however old they are. Inputs, images and claims of jobs whose state is gone
+        are deleted once they are `max_age` seconds old.
+        """
+        if not os.path.isdir(self.directory):
+            return
+        cutoff = time.time() - max_age
+        suffixes = (".json", INPUT_SUFFIX, IMAGE_SUFFIX, CLAIM_SUFFIX)
+        entries = {}
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(suffixes) and not entry.name.startswith("."):
+                job_id, suffix = os.path.splitext(entry.name)
+                entries.setdefault(job_id, {})[suffix] = entry
+        for job_id, files in entries.items():
+            if ".json" in files:
+                # the input of a job is deleted when it is finished
+                old = [files[".json"]] if INPUT_SUFFIX not in files else []
+            else:
+                old = list(files.values())
+            for entry in old:
+                try:
+                    if entry.stat().st_mtime < cutoff:
+                        os.remove(entry.path)
+                except FileNotFoundError:
+                    pass
+
+
+def get_job_store():
+    return JobStore(settings.MERON_JOB_DIR)
+
+
+class JobRunner:
+    """Threads of one worker that claim queued jobs from the store and run them."""
+
+    def __init__(self, store, threads, poll_interval):
+        self.store = store
+        self.threads = threads
+        self.poll_interval = poll_interval
+        self._wakeup = threading.Event()
+        self._started = False
+        self._lock = threading.Lock()
+        # the jobs the threads of this runner are running, their claims are touched every poll interval
+        self._running = set()
+        self._purged = 0
+
+    def start(self):
+        """Requeue the jobs of dead workers and start the job threads and the thread that touches their claims."""
+        with self._lock:
+            if self._started:
+                return
+            self._started = True
+        self.recover()
+        for index in range(self.threads):
+            threading.Thread(target=self._run, name=f"meron-job-{index}", daemon=True).start()
+        threading.Thread(target=self._touch_claims, name="meron-job-claims", daemon=True).start()
+
+    def wake(self):
+        """Make the job threads look for queued jobs right away."""
+        self._wakeup.set()
+
+    def recover(self):
+        return self.store.recover(settings.MERON_JOB_STALE_AFTER, settings.MERON_JOB_MAX_ATTEMPTS)
+
+    def purge(self):
+        """Delete expired jobs, unless the threads of this runner did so in the last `PURGE_INTERVAL` seconds."""
+        with self._lock:
+            if time.time() - self._purged < PURGE_INTERVAL:
+                return
+            self._purged = time.time()
+        self.store.purge(settings.MERON_JOB_TTL)
+
+    def run_pending(self):
+        """Run queued jobs until there are none left, return the number of jobs that were run."""
+        count = 0
+        job_id = self.store.claim_next()
+        while job_id is not None:
+            with self._lock:
+                self._running.add(job_id)
+            try:
+                run_job(self.store, job_id)
+            finally:
+                with self._lock:
+                    self._running.discard(job_id)
+            count += 1
+            job_id = self.store.claim_next()
+        return count
+
+    def _touch_claims(self):
+        while True:
+            time.sleep(self.poll_interval)
+            with self._lock:
+                running = list(self._running)
+            for job_id in running:
+                self.store.touch_claim(job_id)
+
+    def _run(self):
+        while True:
+            try:
+                self.run_pending()
+                if not self._wakeup.wait(self.poll_interval):
+                    self.recover()
+                    self.purge()
+                self._wakeup.clear()
+            except Exception:
+                logger.exception("The job thread failed to claim a job")
+                time.sleep(self.poll_interval)
+
+
+_runner = None
+_runner_pid = None
+_runner_lock = threading.Lock()
+
+
+def get_job_runner():
+    """Return the job runner of this process, threads don't survive a fork so every worker creates its own.
+
+    The job threads are started when the runner is created, unless `MERON_JOB_WORKERS` is 0.
+    """
+    global _runner, _runner_pid
+    with _runner_lock:
+        if _runner is None or _runner_pid != os.getpid():
+            _runner = JobRunner(get_job_store(), settings.MERON_JOB_WORKERS, settings.MERON_JOB_POLL_INTERVAL)
+            _runner_pid = os.getpid()
+            if settings.MERON_JOB_WORKERS:
+                _runner.start()
+    return _runner
+
+
+def submit_job(input_serializer, model_version=None):
+    """Queue a job for a validated FaceDetectionInputSerializer and return the job.
+
+    `model_version` is the version the request pinned, None for the version that is current when the job runs.
+    Raises Overloaded if the queue is full.
+    """
+    request = input_serializer.get_analysis_request(input_serializer.validated_data)
+    image = request.pop("image")
+    request.pop("models")
+    now = time.time()
+    job = {"id": uuid.uuid4().hex, "status": STATUS_QUEUED, "created": now, "updated": now}
+    job_input = {"request": request, "model_version": model_version}
+    # the job runs from the uploaded bytes, like the request it was submitted with
+    content = b"".join(image.chunks())
+    if not get_job_store().enqueue(job, job_input, content, settings.MERON_JOB_QUEUE_SIZE):
+        raise Overloaded(QUEUE_FULL_RETRY_AFTER, "Too many jobs are waiting, please try again later.")
+    get_job_runner().wake()
+    return job
+
+
+def run_job(store, job_id):
+    """Run the analysis of a claimed job and store the result or the errors."""
+    try:
+        job_input, content = store.load_input(job_id)
+    except FileNotFoundError:
+        # purged or finished by another worker after the claim went stale
+        store.remove(job_id, CLAIM_SUFFIX)
+        return
+    store.update(job_id, status=STATUS_RUNNING)
+    try:
+        models = registry.get(job_input["model_version"])
+        data = {**job_input["request"], "image": RawUploadedFile(BytesIO(content), name="image", size=len(content))}
+        input_serializer = FaceDetectionInputSerializer(data=data, context={"models": models})
+        input_serializer.is_valid(raise_exception=True)
+        result = input_serializer.save()
+    except UnknownModelVersion as exc:
+        store.finish(job_id, status=STATUS_FAILED, errors={"model_version": [str(exc)]})
+    except ValidationError as exc:
+        store.finish(job_id, status=STATUS_FAILED, errors=exc.detail)
+    except Exception:
+        logger.exception("Job %s failed", job_id)
+        store.finish(job_id, status=STATUS_FAILED, errors={"non_field_errors": ["The analysis failed."]})
+    else:
+        store.finish(
+            job_id,
+            status=STATUS_DONE,
+            result=FaceDetectionOutputSerializer(result).data,
+            model_version=models.version,
+        )
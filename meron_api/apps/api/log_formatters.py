@@ -0,0 +1,28 @@
+"""Log formatters for the `LOGGING` setting."""
+import json
+import logging
+
+# attributes every LogRecord has, everything else was passed in `extra`
+RECORD_ATTRIBUTES = frozenset(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime"}
+
+
+class JSONFormatter(logging.Formatter):
+    """Format records as one JSON object per line, with the fields passed in `extra` as top-level keys.
+
+    The request log of TimingMiddleware passes the durations of the stages of every request this way, so log
+    collectors (fluentd) get them as fields instead of having to parse the message.
+    """
+
+    def format(self, record):
+        entry = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "process": record.process,
+            "thread": record.thread,
+            "message": record.getMessage(),
+        }
+        entry.update((key, value) for key, value in vars(record).items() if key not in RECORD_ATTRIBUTES)
+        if record.exc_info:
+            entry["exc_info"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
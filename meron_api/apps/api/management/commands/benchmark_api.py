@@ -0,0 +1,114 @@
+"""Management command that benchmarks the API with synthetic images."""
+import json
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.test import override_settings
+
+from ...benchmark import MODES, benchmark_requests, benchmark_stages, synthetic_face_image
+from ...registry import registry
+
+
+def parse_size(value):
+    try:
+        width, height = (int(side) for side in value.lower().split("x"))
+    except ValueError:
+        raise CommandError(f"Invalid image size {value!r}, expected WIDTHxHEIGHT, e.g. 1920x1080")
+    return width, height
+
+
+class Command(BaseCommand):
+    help = (
+        "Benchmark the API with synthetic images: latency percentiles, requests per second and peak memory of "
+        "multipart and base64 uploads, and the time every stage of the analysis takes."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--sizes", default="640x480,1920x1080,4032x3024", help="Comma separated image sizes, WIDTHxHEIGHT"
+        )
+        parser.add_argument("--formats", default="jpeg,png", help="Comma separated image formats")
+        parser.add_argument("--modes", default=",".join(MODES), help="Comma separated upload modes")
+        parser.add_argument("--requests", type=int, default=20, help="Requests per image, format and mode")
+        parser.add_argument("--concurrency", type=int, default=1, help="Number of threads sending requests")
+        parser.add_argument("--stage-repeat", type=int, default=5, help="Runs of the stage benchmark per image")
+        parser.add_argument(
+            "--stub", action="store_true", help="Use the deterministic stub models, no model files are needed"
+        )
+        parser.add_argument(
+            "--embed-delay-ms",
+            type=float,
+            default=0,
+            help="Time a forward pass of the stub embedder takes, to simulate the real network",
+        )
+        parser.add_argument(
+            "--cache", action="store_true", help="Keep the result cache enabled, repeated uploads are cache hits"
+        )
+        parser.add_argument("--json", action="store_true", help="Print the results as JSON")
+
+    def handle(self, *args, **options):
+        sizes = [parse_size(size) for size in options["sizes"].split(",")]
+        formats = options["formats"].lower().split(",")
+        modes = options["modes"].lower().split(",")
+        unknown_modes = set(modes) - set(MODES)
+        if unknown_modes:
+            raise CommandError(f"Unknown modes: {', '.join(sorted(unknown_modes))}")
+
+        overrides = {
+            "ALLOWED_HOSTS": list(settings.ALLOWED_HOSTS) + ["testserver"],
+            "MERON_RESULT_CACHE": settings.MERON_RESULT_CACHE and options["cache"],
+        }
+        if options["stub"]:
+            if registry.ready and not settings.MERON_STUB_MODELS:
+                raise CommandError("The real models are loaded already, the stub models can't be used.")
+            overrides["MERON_STUB_MODELS"] = True
+
+        with override_settings(**overrides):
+            registry.get()
+            if options["stub"]:
+                registry.embedder.delay = options["embed_delay_ms"] / 1000
+            results = {"requests": [], "stages": []}
+            for size in sizes:
+                for image_format in formats:
+                    image_bytes = synthetic_face_image(size, image_format)
+                    image = {"size": "{}x{}".format(*size), "format": image_format, "bytes": len(image_bytes)}
+                    stages = benchmark_stages(image_bytes, image_format, options["stage_repeat"])
+                    results["stages"].append(dict(image, stages=stages))
+                    for mode in modes:
+                        row = benchmark_requests(
+                            image_bytes, image_format, mode, options["requests"], options["concurrency"]
+                        )
+                        results["requests"].append(dict(image, mode=mode, **row))
+
+        if options["json"]:
+            self.stdout.write(json.dumps(results, indent=2))
+        else:
+            self.write_tables(results)
+
+    def write_tables(self, results):
+        def number(value, digits=1):
+            return "-" if value is None else f"{value:.{digits}f}"
+
+        self.stdout.write("Requests")
+        self.stdout.write(
+            f"{'size':>10} {'format':>6} {'mode':>9} {'req':>5} {'err':>4} {'req/s':>7} "
+            f"{'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'RSS MiB':>8}"
+        )
+        for row in results["requests"]:
+            self.stdout.write(
+                f"{row['size']:>10} {row['format']:>6} {row['mode']:>9} {row['requests']:>5} {row['errors']:>4} "
+                f"{number(row['requests_per_second']):>7} {number(row['p50_ms']):>8} {number(row['p95_ms']):>8} "
+                f"{number(row['p99_ms']):>8} {number(row['peak_rss_mb']):>8}"
+            )
+
+        self.stdout.write("\nStages")
+        self.stdout.write(
+            f"{'size':>10} {'format':>6} {'stage':>7} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'RSS MiB':>8}"
+        )
+        for row in results["stages"]:
+            for stage, timings in row["stages"].items():
+                self.stdout.write(
+                    f"{row['size']:>10} {row['format']:>6} {stage:>7} {number(timings['p50_ms'], 2):>8} "
+                    f"{number(timings['p95_ms'], 2):>8} {number(timings['p99_ms'], 2):>8} "
+                    f"{number(timings['peak_rss_mb']):>8}"
+                )
@@ -0,0 +1,70 @@
+"""Management command that compares the face detector backends on a set of photos."""
+import json
+import os
+
+import numpy as np
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from ...benchmark import benchmark_detectors
+from ...bulk import read_directory
+from ...detectors import BACKENDS, create_detector
+from ...preprocessing import open_for_detection
+
+
+class Command(BaseCommand):
+    help = (
+        "Run the face detector backends over the photos in a directory and report the latency percentiles and the "
+        "detection rate (share of the photos with a face found) of each. Use photos that all show a face."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("images", help="Directory of photos, e.g. a fixed set of photos from the field")
+        parser.add_argument("--backends", default=",".join(BACKENDS), help="Comma separated detector backends")
+        parser.add_argument(
+            "--upsample", type=int, default=settings.MERON_DETECTOR_UPSAMPLE, help="Upsampling level of all backends"
+        )
+        parser.add_argument(
+            "--min-face-size", type=int, default=settings.MERON_DETECTOR_MIN_FACE_SIZE, help="Minimum face size"
+        )
+        parser.add_argument("--repeat", type=int, default=1, help="Runs per photo and backend")
+        parser.add_argument("--json", action="store_true", help="Print the results as JSON")
+
+    def handle(self, *args, **options):
+        backends = options["backends"].split(",")
+        unknown = set(backends) - set(BACKENDS)
+        if unknown:
+            raise CommandError(f"Unknown backends: {', '.join(sorted(unknown))}")
+        if not os.path.isdir(options["images"]):
+            raise CommandError(f"{options['images']} is not a directory")
+
+        images = []
+        for _, _, image_path, _ in read_directory(options["images"]):
+            # decoded like uploads to the API, at the resolution used for the face detection
+            with open(image_path, "rb") as image_file:
+                img, _ = open_for_detection(image_file, settings.MERON_DETECTION_MAX_SIDE)
+                images.append(np.asarray(img.convert("RGB")))
+        if not images:
+            raise CommandError(f"There are no photos in {options['images']}")
+
+        detectors = {}
+        for backend in backends:
+            try:
+                detectors[backend] = create_detector(backend, options["upsample"], options["min_face_size"])
+            except Exception as exc:
+                # e.g. a missing model file, the other backends can still be compared
+                self.stderr.write(f"Skipping {backend}, it could not be built: {exc}")
+        results = benchmark_detectors(images, detectors, options["repeat"])
+
+        if options["json"]:
+            self.stdout.write(json.dumps(results, indent=2))
+            return
+        self.stdout.write(f"{len(images)} photos, upsampling level {options['upsample']}")
+        self.stdout.write(
+            f"{'backend':>10} {'mean ms':>8} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'detected':>9} {'faces':>6}"
+        )
+        for backend, row in results.items():
+            self.stdout.write(
+                f"{backend:>10} {row['mean_ms']:>8.1f} {row['p50_ms']:>8.1f} {row['p95_ms']:>8.1f} "
+                f"{row['p99_ms']:>8.1f} {row['detection_rate']:>9.1%} {row['faces']:>6}"
+            )
@@ -0,0 +1,106 @@
+"""Management command that compares the gunicorn worker topologies under load."""
+import base64
+import json
+import os
+import subprocess
+import sys
+from tempfile import TemporaryFile
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from ...benchmark import benchmark_http, post_json, synthetic_face_image, wait_until_ready
+from ...cpu import TOPOLOGIES, available_cores, topology
+from .benchmark_api import parse_size
+
+
+class Command(BaseCommand):
+    help = (
+        "Start gunicorn with every topology in turn (see meron_api/gunicorn_config.py), send concurrent requests over "
+        "HTTP and compare latency and throughput."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--topologies", default=",".join(TOPOLOGIES), help="Comma separated topologies")
+        parser.add_argument("--requests", type=int, default=200, help="Requests per topology")
+        parser.add_argument(
+            "--concurrency", type=int, default=0, help="Parallel connections, twice the number of cores by default"
+        )
+        parser.add_argument("--size", default="1280x960", help="Size of the synthetic image, WIDTHxHEIGHT")
+        parser.add_argument("--format", default="jpeg", help="Format of the synthetic image")
+        parser.add_argument("--port", type=int, default=8765, help="Port gunicorn listens on, on 127.0.0.1")
+        parser.add_argument(
+            "--startup-timeout", type=int, default=600, help="Seconds to wait for the models to load"
+        )
+        parser.add_argument("--stub", action="store_true", help="Use the deterministic stub models")
+        parser.add_argument("--json", action="store_true", help="Print the results as JSON")
+
+    def handle(self, *args, **options):
+        modes = options["topologies"].split(",")
+        unknown = set(modes) - set(TOPOLOGIES)
+        if unknown:
+            raise CommandError(f"Unknown topologies: {', '.join(sorted(unknown))}")
+        cores = available_cores()
+        concurrency = options["concurrency"] or 2 * cores
+        image_bytes = synthetic_face_image(parse_size(options["size"]), options["format"])
+        body = json.dumps({"image": base64.b64encode(image_bytes).decode(), "age": 30, "gender": "m"}).encode()
+        base_url = f"http://127.0.0.1:{options['port']}"
+
+        results = []
+        for mode in modes:
+            self.stderr.write(f"Benchmarking topology {mode}")
+            with TemporaryFile() as log:
+                process = self.start_server(mode, options, log)
+                try:
+                    wait_until_ready(f"{base_url}/health/", options["startup_timeout"], process)
+                    # the first requests of every worker are slower
+                    for _ in range(concurrency):
+                        post_json(f"{base_url}/", body)
+                    row = benchmark_http(f"{base_url}/", body, options["requests"], concurrency)
+                except RuntimeError as exc:
+                    log.seek(0)
+                    self.stderr.write(log.read().decode(errors="replace")[-5000:])
+                    raise CommandError(f"Topology {mode}: {exc}")
+                finally:
+                    process.terminate()
+                    process.wait(timeout=60)
+            results.append(dict(row, topology=mode, cores=cores, concurrency=concurrency, **topology(mode, cores)))
+
+        if options["json"]:
+            self.stdout.write(json.dumps(results, indent=2))
+            return
+        self.stdout.write(
+            f"{'topology':>9} {'workers':>7} {'threads':>7} {'inf.thr':>7} {'req/s':>7} "
+            f"{'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'err':>4}"
+        )
+        for row in results:
+            self.stdout.write(
+                f"{row['topology']:>9} {row['workers']:>7} {row['threads']:>7} {row['inference_threads']:>7} "
+                f"{row['requests_per_second']:>7.1f} {row['p50_ms']:>8.1f} {row['p95_ms']:>8.1f} "
+                f"{row['p99_ms']:>8.1f} {row['errors']:>4}"
+            )
+        best = max(results, key=lambda row: row["requests_per_second"])
+        self.stdout.write(f"\nHighest throughput with MERON_TOPOLOGY={best['topology']}")
+
+    def start_server(self, mode, options, log):
+        env = dict(
+            os.environ,
+            MERON_TOPOLOGY=mode,
+            MERON_BIND=f"127.0.0.1:{options['port']}",
+            # every request has to be computed
+            MERON_RESULT_CACHE="False",
+        )
+        allowed_hosts = env.get("DJANGO_ALLOWED_HOSTS")
+        env["DJANGO_ALLOWED_HOSTS"] = f"{allowed_hosts},127.0.0.1" if allowed_hosts else "127.0.0.1"
+        if options["stub"]:
+            env["MERON_STUB_MODELS"] = "True"
+        # what the gunicorn script does, with the Python of this process
+        command = [
+            sys.executable,
+            "-c",
+            "from gunicorn.app.wsgiapp import run; run()",
+            "-c",
+            "python:meron_api.gunicorn_config",
+            "meron_api.asgi" if mode == "async" else "meron_api.wsgi",
+        ]
+        return subprocess.Popen(command, env=env, cwd=str(settings.ROOT_DIR - 1), stdout=log, stderr=log)
@@ -0,0 +1,58 @@
+"""Management command that compares the results of the API with those of the upstream pipeline."""
+import os
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from ...bulk import read_directory
+from ...registry import registry
+from ...upstream import compare_with_upstream
+
+
+class Command(BaseCommand):
+    help = (
+        "Analyze photos of faces with the models of the API and with analyze_image of the meron_production "
+        "submodule and fail if the scores or classifications differ."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "images",
+            nargs="*",
+            help="Photos of faces or directories with photos, default: the photos in MERON_PARITY_IMAGES_DIR",
+        )
+        parser.add_argument("--age", type=int, default=24, help="Age in months passed for every face")
+        parser.add_argument("--gender", choices=("f", "m"), default="f", help="Gender passed for every face")
+        parser.add_argument("--tolerance", type=float, default=1e-4, help="Largest allowed score difference")
+
+    def handle(self, *args, **options):
+        paths = options["images"]
+        if not paths and settings.MERON_PARITY_IMAGES_DIR:
+            paths = [settings.MERON_PARITY_IMAGES_DIR]
+        image_paths = []
+        for path in paths:
+            if os.path.isdir(path):
+                image_paths.extend(image_path for _, _, image_path, _ in read_directory(path))
+            else:
+                image_paths.append(path)
+        if not image_paths:
+            raise CommandError("No photos to compare on, pass them or set MERON_PARITY_IMAGES_DIR")
+        try:
+            parity = compare_with_upstream(image_paths, registry.get(), options["age"], options["gender"])
+        except ImportError as exc:
+            raise CommandError(f"The meron_production submodule can't be imported: {exc}")
+
+        self.stdout.write(
+            f"{parity['images']} photos: largest score difference {parity['max_score_difference']:.6f}, "
+            f"same classification for {100 * parity['classification_agreement']:.1f}%"
+        )
+        for path in parity["mismatches"]:
+            self.stderr.write(f"Only one of the pipelines found a face in {path}")
+        if not parity["images"]:
+            raise CommandError("Neither pipeline found a face in the photos")
+        if (
+            parity["mismatches"]
+            or parity["max_score_difference"] > options["tolerance"]
+            or parity["classification_agreement"] < 1
+        ):
+            raise CommandError("The API gives other results than the upstream pipeline")
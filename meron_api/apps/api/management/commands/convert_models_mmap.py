@@ -0,0 +1,127 @@
+"""Management command that converts the models to files the keras runtime memory-maps."""
+import os
+import shutil
+import tempfile
+from types import SimpleNamespace
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.test import override_settings
+
+from ...embedders import VGGFaceEmbedder
+from ...onnx_models import compare_models, parity_faces
+from ...registry import ModelRegistry, version_directory
+from ...weights import EMBEDDER_DIR, load_head, load_weights, save_head, save_weights
+
+
+def head_files():
+    """Return the file names of the score and classification models."""
+    return settings.MERON_SCORE_MODEL, settings.MERON_CLASSIFICATION_MODEL
+
+
+class Command(BaseCommand):
+    help = (
+        "Write the weights of the embedding network as .npy files and the score and classification models as "
+        "uncompressed joblib files, which the workers memory-map when MERON_MMAP_DIR is set, and compare the results "
+        "of the converted models with the original ones. With MERON_MODEL_VERSIONS_DIR the models of the current "
+        "version are converted in its directory, where the registry loads them from. Nothing is replaced unless the "
+        "converted models pass the comparison."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--output-dir", default=settings.MERON_MMAP_DIR, help="Directory for the converted models"
+        )
+        parser.add_argument(
+            "--source-dir",
+            default=settings.MERON_MODEL_DIR,
+            help="Directory of the score and classification models without MERON_MODEL_VERSIONS_DIR",
+        )
+        parser.add_argument(
+            "--parity-faces",
+            type=int,
+            default=8,
+            help="Number of synthetic faces the converted models are compared on, 0 skips the comparison",
+        )
+
+    def handle(self, *args, **options):
+        output_dir = options["output_dir"]
+        if not output_dir:
+            raise CommandError("Set MERON_MMAP_DIR or pass --output-dir")
+        os.makedirs(output_dir, exist_ok=True)
+
+        original_settings = {
+            "MERON_INFERENCE_RUNTIME": "keras",
+            "MERON_STUB_MODELS": False,
+            "MERON_MMAP_DIR": "",
+            "MERON_MODEL_DIR": options["source_dir"],
+        }
+        with override_settings(**original_settings):
+            reference = ModelRegistry().load()
+        # the registry loads the heads of a version from its directory, also when they are memory-mapped
+        version_dir = version_directory(reference.version)
+        heads_dir = version_dir or output_dir
+        if version_dir and not options["parity_faces"]:
+            raise CommandError(
+                f"The models of version {reference.version} are replaced in {version_dir}, they have to be compared "
+                "with the converted ones, --parity-faces can't be 0"
+            )
+
+        # the files are converted next to their targets and only moved there once they passed the comparison, so a
+        # failed conversion never replaces the models the workers load
+        staging_dirs = [tempfile.mkdtemp(prefix=".convert-", dir=output_dir)]
+        if heads_dir != output_dir:
+            staging_dirs.append(tempfile.mkdtemp(prefix=".convert-", dir=heads_dir))
+        weights_staging, heads_staging = staging_dirs[0], staging_dirs[-1]
+        try:
+            self.convert(reference, weights_staging, heads_staging)
+            if options["parity_faces"]:
+                self.check_parity(reference, weights_staging, heads_staging, options["parity_faces"])
+
+            weights_dir = os.path.join(output_dir, EMBEDDER_DIR)
+            if os.path.isdir(weights_dir):
+                # a directory can't replace another one, the previous weights are removed with the staging directory
+                os.replace(weights_dir, os.path.join(weights_staging, "previous"))
+            os.replace(os.path.join(weights_staging, EMBEDDER_DIR), weights_dir)
+            for file_name in head_files():
+                os.replace(os.path.join(heads_staging, file_name), os.path.join(heads_dir, file_name))
+        finally:
+            for staging_dir in staging_dirs:
+                shutil.rmtree(staging_dir, ignore_errors=True)
+        self.stdout.write(
+            f"Wrote the weights of the embedding network to {weights_dir} and the score and classification models "
+            f"to {heads_dir}"
+        )
+
+    def convert(self, reference, weights_staging, heads_staging):
+        self.stdout.write("Converting the weights of the embedding network")
+        save_weights(
+            reference.embedder.network.get_weights(),
+            os.path.join(weights_staging, EMBEDDER_DIR),
+            settings.MERON_VGGFACE_MODEL,
+        )
+        for model, file_name in zip((reference.score_model, reference.classification_model), head_files()):
+            self.stdout.write(f"Converting {file_name}")
+            save_head(model, os.path.join(heads_staging, file_name))
+
+    def check_parity(self, reference, weights_staging, heads_staging, count):
+        """Compare the converted models in the staging directories with the original ones.
+
+        Raises CommandError if they diverge.
+        """
+        model_name = settings.MERON_VGGFACE_MODEL
+        weights = load_weights(os.path.join(weights_staging, EMBEDDER_DIR), model_name)
+        score_file, classification_file = head_files()
+        candidate = SimpleNamespace(
+            embedder=VGGFaceEmbedder(model_name, settings.MERON_FACE_SIZE, weights),
+            score_model=load_head(os.path.join(heads_staging, score_file)),
+            classification_model=load_head(os.path.join(heads_staging, classification_file)),
+        )
+        faces = parity_faces(reference, settings.MERON_FACE_SIZE, count)
+        parity = compare_models(reference, candidate, faces)
+        self.stdout.write(
+            f"Largest score difference {parity['max_score_difference']:.6f}, "
+            f"same classification for {100 * parity['classification_agreement']:.1f}% of {parity['faces']} faces"
+        )
+        if parity["max_score_difference"] > 1e-4 or parity["classification_agreement"] < 1:
+            raise CommandError("The converted models give other results than the original ones, nothing was replaced")
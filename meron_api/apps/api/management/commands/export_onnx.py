@@ -0,0 +1,123 @@
+"""Management command that exports the models to ONNX files for the onnx runtime."""
+import os
+import shutil
+import tempfile
+from types import SimpleNamespace
+
+import numpy as np
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.test import override_settings
+
+from ...onnx_models import (
+    CLASSIFICATION_MODEL_FILE,
+    PARITY_TOLERANCES,
+    PRECISIONS,
+    SCORE_MODEL_FILE,
+    compare_models,
+    convert_to_fp16,
+    embedder_file,
+    export_embedder,
+    export_head,
+    load_onnx_models,
+    parity_faces,
+    quantize_to_int8,
+)
+from ...registry import ModelRegistry
+
+
+class Command(BaseCommand):
+    help = (
+        "Export the embedding network and the score and classification models to ONNX, optionally with 16 bit float "
+        "or 8 bit integer weights, and compare the results of the exported models with the Keras models. The output "
+        "directory is only changed if all exported models pass the comparison."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--output-dir", default=settings.MERON_ONNX_DIR, help="Directory for the ONNX files")
+        parser.add_argument(
+            "--precision",
+            action="append",
+            choices=PRECISIONS,
+            help="Precision of the exported embedding network, can be repeated. Default: all of them",
+        )
+        parser.add_argument("--opset", type=int, default=13, help="ONNX opset version")
+        parser.add_argument(
+            "--parity-faces",
+            type=int,
+            default=32,
+            help="Number of synthetic faces the exported models are compared on, 0 skips the comparison",
+        )
+        parser.add_argument(
+            "--parity-images", nargs="*", default=[], help="Photos of faces to compare the exported models on as well"
+        )
+
+    def handle(self, *args, **options):
+        precisions = options["precision"] or list(PRECISIONS)
+        output_dir = options["output_dir"]
+        os.makedirs(output_dir, exist_ok=True)
+
+        with override_settings(MERON_INFERENCE_RUNTIME="keras", MERON_STUB_MODELS=False):
+            reference = ModelRegistry().load()
+        # the models are exported next to the output and only moved there if they pass the comparison, so a failed
+        # export never replaces working models
+        export_dir = tempfile.mkdtemp(prefix=".export-", dir=output_dir)
+        try:
+            self.export(reference, export_dir, precisions, options["opset"])
+            if options["parity_faces"] or options["parity_images"]:
+                self.check_parity(reference, export_dir, precisions, options)
+            for file_name in os.listdir(export_dir):
+                os.replace(os.path.join(export_dir, file_name), os.path.join(output_dir, file_name))
+        finally:
+            shutil.rmtree(export_dir, ignore_errors=True)
+        self.stdout.write(f"Exported the models to {output_dir}")
+
+    def export(self, reference, export_dir, precisions, opset):
+        face_size = settings.MERON_FACE_SIZE
+        n_features = reference.embedder.embed(np.zeros((1, face_size, face_size, 3), dtype="float32")).shape[1] + 2
+
+        fp32_path = os.path.join(export_dir, embedder_file("fp32"))
+        self.stdout.write("Exporting the embedding network")
+        export_embedder(reference.embedder, face_size, fp32_path, opset)
+        for model, file_name in (
+            (reference.score_model, SCORE_MODEL_FILE),
+            (reference.classification_model, CLASSIFICATION_MODEL_FILE),
+        ):
+            self.stdout.write(f"Exporting {file_name}")
+            export_head(model, n_features, os.path.join(export_dir, file_name), opset)
+        if "fp16" in precisions:
+            self.stdout.write("Converting the embedding network to 16 bit floats")
+            convert_to_fp16(fp32_path, os.path.join(export_dir, embedder_file("fp16")))
+        if "int8" in precisions:
+            self.stdout.write("Quantizing the embedding network to 8 bit integers")
+            quantize_to_int8(fp32_path, os.path.join(export_dir, embedder_file("int8")))
+
+    def check_parity(self, reference, export_dir, precisions, options):
+        """Compare the exported models with the Keras models, raise CommandError if one of them diverges."""
+        faces = parity_faces(reference, settings.MERON_FACE_SIZE, options["parity_faces"], options["parity_images"])
+        if not len(faces):
+            raise CommandError("No faces to compare the exported models on")
+        diverged = []
+        for precision in precisions:
+            embedder, score_model, classification_model = load_onnx_models(
+                export_dir, settings.MERON_VGGFACE_MODEL, precision, settings.MERON_ONNX_THREADS
+            )
+            candidate = SimpleNamespace(
+                embedder=embedder, score_model=score_model, classification_model=classification_model
+            )
+            parity = compare_models(reference, candidate, faces)
+            self.stdout.write(
+                f"{precision}: largest score difference {parity['max_score_difference']:.4f}, "
+                f"same classification for {100 * parity['classification_agreement']:.1f}% of {parity['faces']} faces"
+            )
+            max_score_difference, min_agreement = PARITY_TOLERANCES[precision]
+            if (
+                parity["max_score_difference"] > max_score_difference
+                or parity["classification_agreement"] < min_agreement
+            ):
+                diverged.append(precision)
+        if diverged:
+            raise CommandError(
+                f"The exported {', '.join(diverged)} models diverge from the Keras models, nothing was written to "
+                f"{options['output_dir']}"
+            )
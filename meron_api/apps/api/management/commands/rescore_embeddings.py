@@ -0,0 +1,88 @@
+"""Management command that runs the score and classification models over the stored embeddings."""
+import csv
+import json
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from ...embedding_store import EmbeddingStore, rescore
+from ...registry import ModelRegistry, build_heads, version_directory
+
+FIELDS = ("hash", "age", "gender", "model_version", "profile", "recorded", "score", "classification")
+
+
+def load_model(path):
+    # imported here, so the command doesn't need scikit-learn unless it loads a model
+    import joblib
+
+    return joblib.load(path)
+
+
+class Command(BaseCommand):
+    help = (
+        "Run the score and classification models over the embeddings in the embedding store and write the results "
+        "to a CSV or JSON Lines file, e.g. to re-score all analyzed images with a new version of the models."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("output", help="CSV or JSON Lines (.jsonl) file the results are written to")
+        parser.add_argument("--store-dir", default=settings.MERON_EMBEDDING_STORE_DIR, help="Embedding store")
+        parser.add_argument("--score-model", help="joblib file of a score model, default: the configured model")
+        parser.add_argument(
+            "--classification-model", help="joblib file of a classification model, default: the configured model"
+        )
+        parser.add_argument(
+            "--model-version",
+            help="Version in MERON_MODEL_VERSIONS_DIR whose models are used by default, default: the current version",
+        )
+        parser.add_argument("--chunk-size", type=int, default=10000, help="Embeddings passed to the models at once")
+
+    def handle(self, *args, **options):
+        store = EmbeddingStore(options["store_dir"], settings.MERON_VGGFACE_MODEL)
+        try:
+            meta = store.meta()
+        except ValueError as exc:
+            raise CommandError(str(exc))
+        if meta is None:
+            raise CommandError(f"There are no embeddings in {options['store_dir']}")
+        if meta["model"] != settings.MERON_VGGFACE_MODEL:
+            self.stderr.write(
+                f"The embeddings were calculated by {meta['model']}, the models are configured for "
+                f"{settings.MERON_VGGFACE_MODEL}"
+            )
+
+        if options["score_model"] and options["classification_model"]:
+            # the configured models aren't needed
+            score_model = classification_model = None
+        else:
+            # the models of the version the API serves, in the same directory the registry loads it from
+            versions = ModelRegistry().available_versions()
+            if not versions:
+                raise CommandError(f"There are no model versions in {settings.MERON_MODEL_VERSIONS_DIR}")
+            version = options["model_version"] or versions[-1]
+            if version not in versions:
+                raise CommandError(f"Unknown model version {version!r}, available: {', '.join(versions)}")
+            score_model, classification_model = build_heads(version_directory(version))
+        if options["score_model"]:
+            score_model = load_model(options["score_model"])
+        if options["classification_model"]:
+            classification_model = load_model(options["classification_model"])
+
+        start = time.monotonic()
+        rows = 0
+        results = rescore(store, score_model, classification_model, options["chunk_size"])
+        with open(options["output"], "w", newline="") as output:
+            if options["output"].endswith(".jsonl"):
+                for result in results:
+                    output.write(json.dumps(result) + "\n")
+                    rows += 1
+            else:
+                writer = csv.DictWriter(output, FIELDS)
+                writer.writeheader()
+                for result in results:
+                    writer.writerow(result)
+                    rows += 1
+        self.stdout.write(
+            f"Scored {rows} embeddings in {time.monotonic() - start:.1f} s. Results in {options['output']}"
+        )
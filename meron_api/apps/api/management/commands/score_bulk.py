@@ -0,0 +1,68 @@
+"""Management command that scores a directory or a CSV manifest of photos offline."""
+import os
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from ...bulk import FORMATS, ResultWriter, read_directory, read_manifest, score_rows
+from ...cpu import available_cores
+
+
+class Command(BaseCommand):
+    help = (
+        "Score the photos in a directory or listed in a CSV manifest (columns image, age, gender and optionally score "
+        "and classification) and write the results to a CSV or JSON Lines file. Rows that are in the output file "
+        "already are skipped, so an interrupted run can be continued by running the same command again."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("source", help="Directory of photos or CSV manifest")
+        parser.add_argument("output", help="CSV or JSON Lines (.jsonl) file the results are appended to")
+        parser.add_argument(
+            "--format", choices=FORMATS, help="Format of the output file, by default derived from its extension"
+        )
+        parser.add_argument("--age", help="Age in months of all photos in a directory")
+        parser.add_argument("--gender", help="Gender (m or f) of all photos in a directory")
+        parser.add_argument(
+            "--workers",
+            type=int,
+            default=available_cores(),
+            help="Processes that decode the photos and detect the faces, 0 does it in this process. Default: one "
+            "per core",
+        )
+        parser.add_argument("--batch-size", type=int, default=32, help="Faces embedded in one forward pass")
+
+    def handle(self, *args, **options):
+        source = options["source"]
+        if os.path.isdir(source):
+            items = read_directory(source, options["age"], options["gender"])
+        elif os.path.isfile(source):
+            if options["age"] is not None or options["gender"] is not None:
+                raise CommandError("--age and --gender only apply to directories, add them to the manifest")
+            try:
+                items = read_manifest(source)
+            except ValueError as exc:
+                raise CommandError(str(exc))
+        else:
+            raise CommandError(f"{source} is neither a directory nor a file")
+        output_format = options["format"] or ("jsonl" if options["output"].endswith(".jsonl") else "csv")
+
+        writer = ResultWriter(options["output"], output_format)
+        if writer.completed:
+            self.stdout.write(f"Skipping the {len(writer.completed)} rows in {options['output']}")
+        items = (item for item in items if item[0] not in writer.completed)
+        scored = failed = 0
+        start = time.monotonic()
+        try:
+            for results in score_rows(items, options["workers"], options["batch_size"]):
+                writer.write(results)
+                failed += sum("errors" in result for result in results)
+                scored += sum("errors" not in result for result in results)
+                if options["verbosity"] > 1:
+                    self.stdout.write(f"{scored + failed} rows, {time.monotonic() - start:.1f} s")
+        finally:
+            writer.close()
+        self.stdout.write(
+            f"Scored {scored} photos, {failed} rows failed, in {time.monotonic() - start:.1f} s. "
+            f"Results in {options['output']}"
+        )
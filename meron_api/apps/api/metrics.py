@@ -0,0 +1,105 @@
+"""Latency histograms of the requests and of the stages of the analysis, in the Prometheus text format.
+
+Every gunicorn worker records its own metrics. When the environment variable `prometheus_multiproc_dir` points to an
+empty directory before the server starts, prometheus_client writes the metrics of all workers to files in that
+directory and `/metrics/` reports the sum over all workers, no matter which worker answers the scrape.
+
+`stage_timer` measures one stage of a request (parsing the body, decoding the image, face detection, ...). The
+durations of the stages of the current request are also collected for the request log, see `TimingMiddleware`.
+"""
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+from prometheus_client import REGISTRY, CollectorRegistry, Counter, Gauge, Histogram, generate_latest, multiprocess
+
+# from 1 ms (hash of a small image) to 30 s (a large batch without micro-batching)
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+REQUEST_DURATION = Histogram(
+    "meron_request_duration_seconds",
+    "Time from receiving the request in Django to returning the response.",
+    ["method", "view", "status"],
+    buckets=BUCKETS,
+)
+STAGE_DURATION = Histogram(
+    "meron_stage_duration_seconds",
+    "Time spent in one stage of handling a request, summed over the images of batch requests.",
+    ["stage"],
+    buckets=BUCKETS,
+)
+MICRO_BATCH_SIZE = Histogram(
+    "meron_micro_batch_size",
+    "Faces embedded in one forward pass of the micro-batcher.",
+    buckets=(1, 2, 4, 8, 16, 32, 64, 128),
+)
+MICRO_BATCH_WAIT = Histogram(
+    "meron_micro_batch_wait_seconds",
+    "Time the requests waited for their micro-batch to be run.",
+    buckets=BUCKETS,
+)
+ADMISSION_REQUESTS = Counter(
+    "meron_admission_requests",
+    "Requests to the analysis endpoints by admission outcome: admitted, queued (admitted after waiting), shed (queue "
+    "full), timeout (waited too long in the queue) or stale (waited too long before reaching the worker).",
+    ["outcome"],
+)
+ADMISSION_WAIT = Histogram(
+    "meron_admission_wait_seconds",
+    "Time admitted requests waited in the queue for a slot.",
+    buckets=BUCKETS,
+)
+# the sum over the live workers is the number of requests of the host
+ADMISSION_IN_FLIGHT = Gauge(
+    "meron_admission_in_flight",
+    "Requests that are being analyzed.",
+    multiprocess_mode="livesum",
+)
+ADMISSION_QUEUED = Gauge(
+    "meron_admission_queued",
+    "Requests waiting for a slot.",
+    multiprocess_mode="livesum",
+)
+
+_request_stages = threading.local()
+
+
+def start_request():
+    """Start collecting the stage durations of the request handled by this thread."""
+    _request_stages.durations = {}
+
+
+def finish_request():
+    """Stop collecting and return the stage durations of the request, in seconds."""
+    durations = getattr(_request_stages, "durations", None) or {}
+    _request_stages.durations = None
+    return durations
+
+
+@contextmanager
+def stage_timer(stage):
+    """Measure the duration of the block, stages that run several times per request are added up."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        duration = time.perf_counter() - start
+        STAGE_DURATION.labels(stage).observe(duration)
+        durations = getattr(_request_stages, "durations", None)
+        if durations is not None:
+            durations[stage] = durations.get(stage, 0.0) + duration
+
+
+def observe_request(method, view, status, duration):
+    REQUEST_DURATION.labels(method, view, str(status)).observe(duration)
+
+
+def render_metrics():
+    """Return the metrics in the Prometheus text format, aggregated over all workers in multiprocess mode."""
+    if os.environ.get("prometheus_multiproc_dir"):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry)
@@ -0,0 +1,56 @@
+"""Middleware that measures how long requests take."""
+import logging
+import time
+
+from .metrics import finish_request, observe_request, start_request
+
+logger = logging.getLogger(__name__)
+
+
+def server_timing(stages, duration):
+    """Return the value of a Server-Timing header with the stage durations and the total, in milliseconds."""
+    metrics = [f"{stage};dur={1000 * seconds:.1f}" for stage, seconds in stages.items()]
+    metrics.append(f"total;dur={1000 * duration:.1f}")
+    return ", ".join(metrics)
+
+
+class TimingMiddleware:
+    """Record the duration of every request and its stages.
+
+    The durations are exported as histograms (see `metrics`), logged with the stages as structured fields
+    (`duration_ms` and `stage_ms`) and sent in the Server-Timing header, which nginx writes to its access log.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        start_request()
+        start = time.perf_counter()
+        response = self.get_response(request)
+        duration = time.perf_counter() - start
+        stages = finish_request()
+
+        match = getattr(request, "resolver_match", None)
+        view = match.url_name if match is not None else "unmatched"
+        observe_request(request.method, view, response.status_code, duration)
+        response["Server-Timing"] = server_timing(stages, duration)
+
+        stage_ms = {stage: round(1000 * seconds, 1) for stage, seconds in stages.items()}
+        logger.info(
+            "%s %s %s %.1f ms %s",
+            request.method,
+            request.path,
+            response.status_code,
+            1000 * duration,
+            " ".join(f"{stage}={ms}" for stage, ms in stage_ms.items()),
+            extra={
+                "method": request.method,
+                "path": request.path,
+                "view": view,
+                "status": response.status_code,
+                "duration_ms": round(1000 * duration, 1),
+                "stage_ms": stage_ms,
+            },
+        )
+        return response
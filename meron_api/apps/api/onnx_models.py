@@ -0,0 +1,162 @@
+"""Run the embedding network and the heads with onnxruntime instead of TensorFlow and scikit-learn.
+
+`python manage.py export_onnx` converts the models to ONNX files in `MERON_ONNX_DIR`. The embedding network can be
+exported in three precisions, the heads are small and always exported with 32 bit floats:
+
+- `embedder.onnx`: 32 bit floats, same results as the Keras model up to rounding
+- `embedder.fp16.onnx`: 16 bit float weights, half the size
+- `embedder.int8.onnx`: weights quantized to 8 bit integers (dynamic quantization), the fastest on CPUs
+
+`MERON_INFERENCE_RUNTIME = "onnx"` makes the registry load these files, `MERON_ONNX_PRECISION` selects the embedder.
+"""
+import os
+
+import numpy as np
+
+from .embedders import vggface_preprocess
+from .inference import NoFaceDetected, build_features, detect_face, load_pixels
+from .preprocessing import crop_array
+
+PRECISIONS = ("fp32", "fp16", "int8")
+# largest score difference to the Keras models and smallest share of equal classifications, per precision
+PARITY_TOLERANCES = {"fp32": (0.01, 1.0), "fp16": (0.25, 0.95), "int8": (0.25, 0.95)}
+SCORE_MODEL_FILE = "score_model.onnx"
+CLASSIFICATION_MODEL_FILE = "classification_model.onnx"
+
+
+def embedder_file(precision):
+    """Return the file name of the embedding network exported with `precision`."""
+    if precision not in PRECISIONS:
+        raise ValueError(f"Unknown ONNX precision {precision!r}, expected one of {', '.join(PRECISIONS)}")
+    return "embedder.onnx" if precision == "fp32" else f"embedder.{precision}.onnx"
+
+
+def create_session(path, threads=0):
+    """Return an onnxruntime session for the CPU, `threads` = 0 lets onnxruntime choose the number of threads."""
+    import onnxruntime
+
+    options = onnxruntime.SessionOptions()
+    options.intra_op_num_threads = threads
+    options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+    return onnxruntime.InferenceSession(path, sess_options=options, providers=["CPUExecutionProvider"])
+
+
+class ONNXEmbedder:
+    """Embedding network exported by `export_onnx`, with the same preprocessing as the Keras model."""
+
+    def __init__(self, path, model_name, threads=0):
+        self.model_name = model_name
+        self.session = create_session(path, threads)
+        self.input_name = self.session.get_inputs()[0].name
+
+    def embed(self, faces):
+        return self.session.run(None, {self.input_name: vggface_preprocess(faces, self.model_name)})[0]
+
+
+class ONNXHead:
+    """Score or classification model exported by `export_onnx`, with the `predict` method of scikit-learn models."""
+
+    def __init__(self, path, threads=0):
+        self.session = create_session(path, threads)
+        self.input_name = self.session.get_inputs()[0].name
+
+    def predict(self, features):
+        # regressors return a column per target, classifiers the labels first (then the probabilities)
+        prediction = self.session.run(None, {self.input_name: np.asarray(features, dtype="float32")})[0]
+        return prediction.ravel()
+
+
+def load_onnx_models(directory, model_name, precision, threads=0):
+    """Return the embedder, score model and classification model exported to `directory`."""
+    return (
+        ONNXEmbedder(os.path.join(directory, embedder_file(precision)), model_name, threads),
+        ONNXHead(os.path.join(directory, SCORE_MODEL_FILE), threads),
+        ONNXHead(os.path.join(directory, CLASSIFICATION_MODEL_FILE), threads),
+    )
+
+
+def export_embedder(embedder, face_size, path, opset):
+    """Export the network of a VGGFaceEmbedder to an ONNX file with 32 bit floats."""
+    import tensorflow as tf
+    import tf2onnx
+
+    signature = (tf.TensorSpec((None, face_size, face_size, 3), tf.float32, name="faces"),)
+    tf2onnx.convert.from_keras(embedder.network, input_signature=signature, opset=opset, output_path=path)
+
+
+def export_head(model, n_features, path, opset):
+    """Export a scikit-learn model (or pipeline) that takes `n_features` features to an ONNX file."""
+    from skl2onnx import convert_sklearn
+    from skl2onnx.common.data_types import FloatTensorType
+    from sklearn.base import is_classifier
+
+    final_step = model.steps[-1][1] if hasattr(model, "steps") else model
+    # classifiers return a list of dicts with the probabilities by default, plain arrays are faster
+    options = {id(final_step): {"zipmap": False}} if is_classifier(final_step) else None
+    onnx_model = convert_sklearn(
+        model,
+        initial_types=[("features", FloatTensorType([None, n_features]))],
+        options=options,
+        target_opset=opset,
+    )
+    with open(path, "wb") as onnx_file:
+        onnx_file.write(onnx_model.SerializeToString())
+
+
+def convert_to_fp16(path, output_path):
+    """Store the weights of an ONNX model as 16 bit floats, inputs and outputs stay 32 bit floats."""
+    import onnx
+    from onnxconverter_common import float16
+
+    onnx.save(float16.convert_float_to_float16(onnx.load(path), keep_io_types=True), output_path)
+
+
+def quantize_to_int8(path, output_path):
+    """Quantize the weights of an ONNX model to 8 bit integers, activations are quantized while running."""
+    from onnxruntime.quantization import QuantType, quantize_dynamic
+
+    quantize_dynamic(path, output_path, weight_type=QuantType.QInt8)
+
+
+def compare_models(reference, candidate, faces, age=24, gender="f"):
+    """Run face crops through two sets of models and return how well the results agree.
+
+    `reference` and `candidate` are model registries (or anything with an embedder and the two heads). Returns the
+    largest absolute difference of the scores and the share of faces that got the same classification.
+    """
+    results = []
+    for models in (reference, candidate):
+        features = build_features(models.embedder.embed(faces), age, gender)
+        results.append((
+            np.asarray(models.score_model.predict(features), dtype="float64"),
+            np.asarray(models.classification_model.predict(features)).astype(str),
+        ))
+    (reference_scores, reference_classes), (candidate_scores, candidate_classes) = results
+    return {
+        "faces": len(faces),
+        "max_score_difference": float(np.abs(reference_scores - candidate_scores).max()),
+        "classification_agreement": float((reference_classes == candidate_classes).mean()),
+    }
+
+
+def parity_faces(models, face_size, count=32, image_paths=()):
+    """Return face crops to compare runtimes on.
+
+    The crops of the faces `models` detects in the photos of `image_paths`, and `count` synthetic faces that are the
+    same on every run.
+    """
+    # imported here, the benchmark module imports the Django test client
+    from .benchmark import synthetic_face_image
+
+    faces = []
+    for path in image_paths:
+        with open(path, "rb") as image_file:
+            pixels = load_pixels(image_file)
+        try:
+            faces.append(crop_array(pixels, detect_face(models.detector, pixels), face_size))
+        except NoFaceDetected:
+            continue
+    for seed in range(count):
+        pixels = load_pixels(synthetic_face_image((face_size, face_size), "png", seed=seed))
+        faces.append(pixels.astype("float32"))
+    return np.stack(faces)
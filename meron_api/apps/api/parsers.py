@@ -0,0 +1,260 @@
+"""Parsers that keep the memory used by large uploads low and reject uploads that are too large early.
+
+The default JSONParser reads the whole body into one string, which is then base64 decoded by Base64ImageField. For a
+multi-megabyte photo that means several copies of the image per request. StreamingJSONParser reads the body in chunks
+and base64 decodes the values of `image` keys while reading, straight into a spooled file. The remaining JSON is tiny
+and parsed normally.
+
+RawImageParser accepts the image itself as the body (`Content-Type: image/jpeg` or `image/png`), with the other
+fields in the query string or in headers. That avoids the multipart framing and the 33% overhead of base64.
+"""
+import binascii
+import codecs
+import re
+import string
+from io import BytesIO
+from tempfile import SpooledTemporaryFile
+
+from django.conf import settings
+from rest_framework import parsers
+from rest_framework.exceptions import APIException, ParseError, UnsupportedMediaType
+from rest_framework.utils import json
+
+from .fields import Base64UploadedFile, RawUploadedFile
+from .metrics import stage_timer
+
+CHUNK_SIZE = 64 * 1024
+
+# A JSON string `"image"` followed by a colon and the opening quote of its value. An unescaped `"image"` can't occur
+# within a JSON string, so this only matches keys.
+IMAGE_KEY = re.compile(r'"image"\s*:\s*"')
+# the key pattern has no fixed length, but with more whitespace than this between key, colon and value it isn't found
+MAX_KEY_LENGTH = 64
+# end of the base64 string, or an escape sequence in it
+STRING_END_OR_ESCAPE = re.compile(r'["\\]')
+NON_BASE64 = "".join(sorted(set(map(chr, range(128))) - set(string.ascii_letters + string.digits + "+/")))
+BASE64_ALPHABET_ONLY = str.maketrans("", "", NON_BASE64)
+JSON_ESCAPES = {"/": "/", "\\": "\\", '"': '"'}
+# image formats accepted as raw request body
+RAW_IMAGE_TYPES = ("image/jpeg", "image/png")
+# fields of a raw image upload, read from the query string or from headers, e.g. X-Age
+RAW_IMAGE_FIELDS = ("age", "gender", "score", "classification", "all_faces", "profile")
+# fields that are enabled by their name alone, e.g. ?score
+RAW_IMAGE_FLAGS = ("score", "classification", "all_faces")
+
+
+class UploadTooLarge(APIException):
+    status_code = 413
+    default_detail = "The upload is too large."
+    default_code = "upload_too_large"
+
+
+def check_content_length(parser_context):
+    """Reject requests that announce a body larger than MERON_MAX_UPLOAD_SIZE before reading it."""
+    request = (parser_context or {}).get("request")
+    if request is None:
+        return
+    try:
+        content_length = int(request.META.get("CONTENT_LENGTH") or 0)
+    except ValueError:
+        content_length = 0
+    if content_length > settings.MERON_MAX_UPLOAD_SIZE:
+        raise UploadTooLarge()
+
+
+class Base64ImageExtractor:
+    """Cut the base64 encoded values of `image` keys out of a JSON document that is fed in chunks.
+
+    The values are decoded into spooled files while reading. In the remaining JSON they are replaced by placeholder
+    strings, which `restore` replaces with the files after the JSON was parsed.
+    """
+
+    def __init__(self, spool_size):
+        self.spool_size = spool_size
+        self.json_parts = []
+        self.files = {}
+        self._pending = ""
+        self._image = None
+        self._base64_rest = ""
+        # characters of an escape sequence in an image value, None outside of escape sequences
+        self._escape = None
+
+    def feed(self, text):
+        while text:
+            if self._image is None:
+                text = self._feed_json(text)
+            else:
+                text = self._feed_image(text)
+
+    def _feed_json(self, text):
+        text = self._pending + text
+        match = IMAGE_KEY.search(text)
+        if match is None:
+            # keep the end, it could be the beginning of a key that continues in the next chunk
+            self._pending = text[-MAX_KEY_LENGTH:]
+            self.json_parts.append(text[:-MAX_KEY_LENGTH])
+            return ""
+
+        placeholder = f"__meron_image_{len(self.files)}__"
+        self.json_parts.append(text[:match.end()] + placeholder)
+        self._pending = ""
+        self._image = SpooledTemporaryFile(max_size=self.spool_size)
+        self.files[placeholder] = self._image
+        return text[match.end():]
+
+    def _feed_image(self, text):
+        if self._escape is not None:
+            text = self._feed_escape(text)
+            if self._escape is not None:
+                return ""
+        match = STRING_END_OR_ESCAPE.search(text)
+        if match is None:
+            self._write_base64(text)
+            return ""
+
+        self._write_base64(text[:match.start()])
+        if match.group() == "\\":
+            self._escape = ""
+            return text[match.end():]
+
+        self._finish_image()
+        # the closing quote stays part of the JSON, it ends the placeholder string
+        return text[match.start():]
+
+    def _feed_escape(self, text):
+        """Consume the escape sequence that started with a backslash, it can continue in the next chunk."""
+        # \uXXXX has five characters after the backslash, all other escape sequences one
+        length = 5 if (self._escape or text)[0] == "u" else 1
+        missing = length - len(self._escape)
+        self._escape += text[:missing]
+        if len(self._escape) < length:
+            return ""
+        sequence, self._escape = self._escape, None
+        if length == 5:
+            try:
+                self._write_base64(chr(int(sequence[1:], 16)))
+            except ValueError:
+                raise ParseError("JSON parse error - invalid \\u escape in image string")
+        else:
+            # escaped slashes are allowed in JSON, escaped whitespace is ignored like other whitespace in base64
+            self._write_base64(JSON_ESCAPES.get(sequence, ""))
+        return text[missing:]
+
+    def _write_base64(self, text):
+        # like base64.b64decode, characters that aren't part of the base64 alphabet are discarded
+        text = self._base64_rest + text.translate(BASE64_ALPHABET_ONLY)
+        complete = len(text) - len(text) % 4
+        self._base64_rest = text[complete:]
+        if complete:
+            self._image.write(binascii.a2b_base64(text[:complete]))
+
+    def _finish_image(self):
+        if self._base64_rest:
+            # restore the padding, a single remaining character can't be decoded and is dropped
+            rest = self._base64_rest + "=" * (-len(self._base64_rest) % 4)
+            try:
+                self._image.write(binascii.a2b_base64(rest))
+            except binascii.Error:
+                pass
+        self._base64_rest = ""
+        self._image.seek(0)
+        self._image = None
+
+    def finish(self):
+        """Return the JSON document without the image values."""
+        if self._image is not None:
+            raise ParseError("JSON parse error - unterminated image string")
+        return "".join(self.json_parts) + self._pending
+
+    def restore(self, data):
+        """Replace the placeholders in the parsed data with uploaded files."""
+        if isinstance(data, dict):
+            return {key: self.restore(value) for key, value in data.items()}
+        if isinstance(data, list):
+            return [self.restore(value) for value in data]
+        if isinstance(data, str) and data in self.files:
+            image_file = self.files[data]
+            image_file.seek(0, 2)
+            size = image_file.tell()
+            image_file.seek(0)
+            return Base64UploadedFile(image_file, name="image", size=size)
+        return data
+
+
+class StreamingJSONParser(parsers.JSONParser):
+    """JSON parser that base64 decodes images while reading the body and limits the size of the body."""
+
+    def parse(self, stream, media_type=None, parser_context=None):
+        """Parse the JSON body, the values of `image` keys are returned as uploaded files."""
+        check_content_length(parser_context)
+        with stage_timer("parse"):
+            return self._parse(stream, parser_context)
+
+    def _parse(self, stream, parser_context):
+        parser_context = parser_context or {}
+        decoder = codecs.getincrementaldecoder(parser_context.get("encoding", settings.DEFAULT_CHARSET))()
+        extractor = Base64ImageExtractor(settings.MERON_UPLOAD_SPOOL_SIZE)
+
+        body_size = 0
+        try:
+            for chunk in iter(lambda: stream.read(CHUNK_SIZE), b""):
+                body_size += len(chunk)
+                # the Content-Length header can be missing, e.g. for chunked requests
+                if body_size > settings.MERON_MAX_UPLOAD_SIZE:
+                    raise UploadTooLarge()
+                extractor.feed(decoder.decode(chunk))
+            extractor.feed(decoder.decode(b"", final=True))
+            parse_constant = json.strict_constant if self.strict else None
+            data = json.loads(extractor.finish(), parse_constant=parse_constant)
+        except ValueError as exc:
+            raise ParseError(f"JSON parse error - {exc}")
+        return extractor.restore(data)
+
+
+class LimitedMultiPartParser(parsers.MultiPartParser):
+    """Multipart parser that rejects bodies larger than MERON_MAX_UPLOAD_SIZE before reading them."""
+
+    def parse(self, stream, media_type=None, parser_context=None):
+        check_content_length(parser_context)
+        with stage_timer("parse"):
+            return super().parse(stream, media_type, parser_context)
+
+
+class RawImageParser(parsers.BaseParser):
+    """Parser for requests whose body is the image, the other fields are read from the query string or headers.
+
+    A query parameter takes precedence over the header of the same field (`X-Age`, `X-Gender`, `X-Score`,
+    `X-Classification`, `X-All-Faces`, `X-Profile`). Lists of ages or genders are passed by repeating the query
+    parameter or as comma separated header values. The body is read into memory once and passed on without further
+    copies.
+    """
+
+    media_type = "image/*"
+
+    def parse(self, stream, media_type=None, parser_context=None):
+        """Return the fields of the request, with the body as uploaded `image` file."""
+        check_content_length(parser_context)
+        content_type = (media_type or "").split(";")[0].strip().lower()
+        if content_type not in RAW_IMAGE_TYPES:
+            raise UnsupportedMediaType(content_type)
+        with stage_timer("parse"):
+            # the Content-Length header can be missing, e.g. for chunked requests
+            body = stream.read(settings.MERON_MAX_UPLOAD_SIZE + 1)
+            if len(body) > settings.MERON_MAX_UPLOAD_SIZE:
+                raise UploadTooLarge()
+            # BytesIO shares the memory of the bytes object as long as it isn't written to
+            data = raw_image_fields(parser_context["request"])
+            data["image"] = RawUploadedFile(BytesIO(body), name="image", content_type=content_type, size=len(body))
+        return data
+
+
+def raw_image_fields(request):
+    """Return the fields of a raw image upload as QueryDict, from the query string or the headers of the request."""
+    data = request.query_params.copy()
+    for field in RAW_IMAGE_FIELDS:
+        header = request.META.get("HTTP_X_" + field.upper())
+        if field not in data and header is not None:
+            data.setlist(field, [value.strip() for value in header.split(",")])
+        if field in RAW_IMAGE_FLAGS and data.get(field) == "":
+            data[field] = "true"
+    return data
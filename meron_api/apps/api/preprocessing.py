@@ -0,0 +1,67 @@
+"""Decode images only at the resolution the models need.
+
+Phone cameras deliver photos with 12 or more megapixels, but the face detector works fine on an image of about a
+megapixel and the embedding network only needs a crop of `MERON_FACE_SIZE` pixels around the face. JPEG files can be
+decoded directly at 1/2, 1/4 or 1/8 of their size (PIL's draft mode scales in the DCT domain), which is much faster
+than decoding the full image and scaling it down afterwards.
+"""
+import numpy as np
+from PIL import Image
+
+
+class ImageTooLarge(ValueError):
+    """Raised when the image has more pixels per side than accepted, `size` is its width and height."""
+
+    def __init__(self, size, max_side):
+        super().__init__(f"The image is {size[0]}x{size[1]} pixels, at most {max_side} pixels per side are accepted.")
+        self.size = size
+        self.max_side = max_side
+
+
+def open_for_detection(image_file, max_side, max_original_side=0):
+    """Decode the image so that its longer side is at most `max_side` pixels, or at full resolution if it is 0.
+
+    Returns the decoded PIL image and its original size. Decoding the whole file also detects truncated or corrupted
+    files. Images with more than `max_original_side` pixels per side (if it isn't 0) are rejected with ImageTooLarge
+    before they are decoded.
+    """
+    image_file.seek(0)
+    img = Image.open(image_file)
+    original_size = img.size
+    if max_original_side and max(original_size) > max_original_side:
+        raise ImageTooLarge(original_size, max_original_side)
+    if max_side:
+        # thumbnail() uses draft mode for JPEG files, then resizes the rest of the way. With the default reducing_gap
+        # draft mode only reduces to twice the target size, which roughly halves the speedup.
+        img.thumbnail((max_side, max_side), Image.BILINEAR, reducing_gap=1.0)
+    # thumbnail() doesn't decode images that are small enough already
+    img.load()
+    return img, original_size
+
+
+def crop_array(pixels, box, size):
+    """Crop `box` (left, top, right, bottom) from an RGB array and resize it to `size` x `size` pixels."""
+    left, top, right, bottom = box
+    face = Image.fromarray(pixels[top:bottom, left:right])
+    face = face.resize((size, size), Image.BILINEAR)
+    return np.asarray(face, dtype="float32")
+
+
+def crop_from_file(image_file, box, detection_size, size):
+    """Crop `box`, given in coordinates of the image decoded for detection, from a higher resolution decode.
+
+    The file is decoded at the lowest resolution draft mode offers at which the box is at least `size` pixels wide and
+    high. For formats without draft mode this is the full resolution.
+    """
+    left, top, right, bottom = box
+    factor = size / max(min(right - left, bottom - top), 1)
+    image_file.seek(0)
+    with Image.open(image_file) as img:
+        target = (int(detection_size[0] * factor), int(detection_size[1] * factor))
+        img.draft("RGB", target)
+        img = img.convert("RGB")
+        scale_x = img.width / detection_size[0]
+        scale_y = img.height / detection_size[1]
+        region = (int(left * scale_x), int(top * scale_y), int(right * scale_x), int(bottom * scale_y))
+        face = img.resize((size, size), Image.BILINEAR, box=region)
+    return np.asarray(face, dtype="float32")
@@ -0,0 +1,434 @@
+"""Process-wide registry that owns the models used for inference.
+
+Building the dlib face detector, the VGGFace network and the scikit-learn score and classification models takes several
+seconds. The registry does that once per process and hands the already built objects to the inference code, so no
+request ever has to wait for a model to load. gunicorn workers fill it after they were forked, before they accept
+requests (see worker.py), TensorFlow and onnxruntime don't survive a fork.
+
+The models can be versioned: every subdirectory of `MERON_MODEL_VERSIONS_DIR` holds the models of one version (the
+score and classification models, and for the onnx runtime the embedding network as well), the version with the
+highest name is the current one. Every worker checks the directory every `MERON_MODEL_RELOAD_INTERVAL` seconds in a
+background thread. It loads a new version while it goes on serving requests with the current one, runs it once and
+only swaps it in if that worked. Clients can pin a version per request, see `ModelRegistry.get`. Only versions the
+worker has loaded anyway (the current one and those it replaced) and those in `MERON_MODEL_PINNABLE_VERSIONS` can be
+pinned, so clients can't make the workers load versions over and over.
+
+The libraries behind the models (TensorFlow, keras_vggface, dlib, scikit-learn, onnxruntime) are only imported when
+the models are loaded. Importing the API code, e.g. for management commands or the URLconf, doesn't pull them in.
+"""
+import logging
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+
+import numpy as np
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+
+logger = logging.getLogger(__name__)
+
+# name of the only version when MERON_MODEL_VERSIONS_DIR isn't set
+DEFAULT_VERSION = "default"
+
+
+class UnknownModelVersion(LookupError):
+    """Raised when a request pins a version that doesn't exist."""
+
+
+def version_key(version):
+    """Sort key that orders numbers in version names by their value, so `v10` comes after `v9`."""
+    return [(0, int(part), "") if part.isdigit() else (1, 0, part) for part in re.split(r"(\d+)", version)]
+
+
+def version_directory(version):
+    """Return the directory of the models of a version, None without `MERON_MODEL_VERSIONS_DIR`."""
+    if not settings.MERON_MODEL_VERSIONS_DIR:
+        return None
+    return os.path.join(settings.MERON_MODEL_VERSIONS_DIR, version)
+
+
+def build_detector(profile="default"):
+    """Return the face detector of a profile, without loading the other models, e.g. in processes that only detect."""
+    if settings.MERON_STUB_MODELS:
+        from .stub import StubDetector
+
+        return StubDetector()
+
+    # imported here, detectors imports the libraries of the backends when a detector is built
+    from .detectors import create_detector, profile_options
+
+    return create_detector(*profile_options(profile))
+
+
+def build_detectors():
+    """Return the face detectors of the default and the fast profile, the same one if both are configured alike."""
+    from .detectors import profile_options
+
+    detector = build_detector()
+    if profile_options("fast") == profile_options("default"):
+        return detector, detector
+    return detector, build_detector("fast")
+
+
+def build_heads(directory=None):
+    """Return the score and classification models of the configured runtime, without loading the other models.
+
+    `directory` is the directory of a model version, by default the models in `MERON_MMAP_DIR` (if it is set),
+    `MERON_MODEL_DIR` or `MERON_ONNX_DIR` are loaded. With `MERON_MMAP_DIR` the arrays of the models are
+    memory-mapped, see weights.py.
+    """
+    if settings.MERON_STUB_MODELS:
+        from .stub import StubClassificationModel, StubScoreModel
+
+        return StubScoreModel(), StubClassificationModel()
+    if settings.MERON_INFERENCE_RUNTIME == "onnx":
+        from .onnx_models import CLASSIFICATION_MODEL_FILE, SCORE_MODEL_FILE, ONNXHead
+
+        directory = directory or settings.MERON_ONNX_DIR
+        return (
+            ONNXHead(os.path.join(directory, SCORE_MODEL_FILE), settings.MERON_ONNX_THREADS),
+            ONNXHead(os.path.join(directory, CLASSIFICATION_MODEL_FILE), settings.MERON_ONNX_THREADS),
+        )
+
+    if settings.MERON_MMAP_DIR:
+        from .weights import load_head
+
+        directory = directory or settings.MERON_MMAP_DIR
+        return (
+            load_head(os.path.join(directory, settings.MERON_SCORE_MODEL)),
+            load_head(os.path.join(directory, settings.MERON_CLASSIFICATION_MODEL)),
+        )
+
+    import joblib
+
+    directory = directory or settings.MERON_MODEL_DIR
+    return (
+        joblib.load(os.path.join(directory, settings.MERON_SCORE_MODEL)),
+        joblib.load(os.path.join(directory, settings.MERON_CLASSIFICATION_MODEL)),
+    )
+
+
+class ModelSet:
+    """The models of one version: face detectors, embedding network and the score and classification heads.
+
+    `fast_detector` is the detector of requests with the fast profile, by default the same as `detector`.
+    """
+
+    def __init__(self, version, detector, embedder, score_model, classification_model, fast_detector=None):
+        self.version = version
+        self.detector = detector
+        self.fast_detector = fast_detector or detector
+        self.embedder = embedder
+        self.score_model = score_model
+        self.classification_model = classification_model
+        self.warm_up_seconds = None
+
+    def warm_up(self):
+        """Run each model once on a blank image, raise ValueError if the results are unusable.
+
+        The first prediction of the embedding network builds its graph and allocates its buffers, which takes far
+        longer than the following ones. Warming up keeps that out of the first request.
+        """
+        # imported here, inference imports this module
+        from .inference import build_features
+
+        start = time.monotonic()
+        face_size = settings.MERON_FACE_SIZE
+        blank = np.zeros((face_size, face_size, 3), dtype=np.uint8)
+        self.detector(blank)
+        if self.fast_detector is not self.detector:
+            self.fast_detector(blank)
+        embeddings = self.embedder.embed(np.zeros((1, face_size, face_size, 3), dtype="float32"))
+        features = build_features(embeddings, 0, "f")
+        scores = np.asarray(self.score_model.predict(features), dtype="float64")
+        classifications = self.classification_model.predict(features)
+        if scores.shape != (1,) or not np.isfinite(scores).all() or len(classifications) != 1:
+            raise ValueError(f"The models of version {self.version} returned unusable results")
+        self.warm_up_seconds = time.monotonic() - start
+        return self
+
+
+def _current_model(name):
+    return property(lambda self: getattr(self.current, name), doc=f"The {name} of the current version.")
+
+
+class ModelRegistry:
+    """Load the inference models once and keep them for the lifetime of the process."""
+
+    STATE_EMPTY = "empty"
+    STATE_LOADING = "loading"
+    STATE_READY = "ready"
+    STATE_FAILED = "failed"
+
+    detector = _current_model("detector")
+    fast_detector = _current_model("fast_detector")
+    embedder = _current_model("embedder")
+    score_model = _current_model("score_model")
+    classification_model = _current_model("classification_model")
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # guards `versions` and `_loading`, never held while models are loaded
+        self._versions_lock = threading.Lock()
+        self._watcher_lock = threading.Lock()
+        self.state = self.STATE_EMPTY
+        self.error = None
+        self.load_seconds = None
+        self.warm_up_seconds = None
+        # the models that serve requests that don't pin a version, replaced as a whole when a new version is loaded
+        self.current = None
+        # other versions, loaded for requests that pinned them, least recently used first
+        self.versions = OrderedDict()
+        # versions that failed to load or to warm up, with the error, they are not tried again. Only written under
+        # `_lock`, by the watcher and by the threads that load pinned versions
+        self.failed_versions = {}
+        # futures of the pinned versions that are being loaded, requests for the same version wait for the same one
+        self._loading = {}
+        self._watcher_pid = None
+
+    @property
+    def ready(self):
+        """Return True once all models are loaded."""
+        return self.state == self.STATE_READY
+
+    @property
+    def version(self):
+        """Return the current version, or None before the models are loaded."""
+        return self.current.version if self.current is not None else None
+
+    def load(self):
+        """Load all models of the latest version unless this already happened. Safe to call from several threads."""
+        with self._lock:
+            if self.ready:
+                return self
+            self.state = self.STATE_LOADING
+            start = time.monotonic()
+            try:
+                self.current = self._load_models(self.latest_version())
+            except Exception as exc:
+                self.state = self.STATE_FAILED
+                self.error = str(exc)
+                logger.exception("Loading the models failed")
+                raise
+            self.load_seconds = time.monotonic() - start
+            self.error = None
+            self.state = self.STATE_READY
+            logger.info(
+                "Models of version %s loaded in %.2f seconds (pid %s)", self.version, self.load_seconds, os.getpid()
+            )
+        return self
+
+    def warm_up(self):
+        """Load the models and run each of them once on a blank image. Safe to call from several threads."""
+        self.load()
+        with self._lock:
+            if self.warm_up_seconds is not None:
+                return self
+            self.warm_up_seconds = self.current.warm_up().warm_up_seconds
+            logger.info("Models warmed up in %.2f seconds (pid %s)", self.warm_up_seconds, os.getpid())
+        return self
+
+    def get(self, version=None):
+        """Return the models of the current version, loading them first if nobody did that yet.
+
+        `version` pins another version. Versions in `MERON_MODEL_PINNABLE_VERSIONS` are loaded on first use, other
+        versions only if this worker kept them after a reload. Raises UnknownModelVersion for all other versions.
+        """
+        if not self.ready:
+            self.load()
+        self._start_watching()
+        current = self.current
+        if version is None or version == current.version:
+            return current
+        return self._get_version(version)
+
+    def available_versions(self):
+        """Return the names of the versions in the versions directory, oldest first."""
+        directory = settings.MERON_MODEL_VERSIONS_DIR
+        if not directory:
+            return [DEFAULT_VERSION]
+        # versions are copied to a hidden directory first and renamed once complete
+        versions = [
+            entry.name for entry in os.scandir(directory) if entry.is_dir() and not entry.name.startswith((".", "_"))
+        ]
+        return sorted(versions, key=version_key)
+
+    def latest_version(self):
+        versions = self.available_versions()
+        if not versions:
+            raise ImproperlyConfigured(f"There are no model versions in {settings.MERON_MODEL_VERSIONS_DIR}")
+        return versions[-1]
+
+    def reload(self):
+        """Make the latest version the current one if it isn't already. Returns True if the version changed.
+
+        The new version is loaded and warmed up while the current one goes on serving requests, and only replaces it
+        if that succeeded. The replaced version is kept for requests that pin it.
+        """
+        latest = self.latest_version()
+        if latest == self.version or latest in self.failed_versions:
+            return False
+        logger.info("Loading model version %s (pid %s)", latest, os.getpid())
+        try:
+            models = self._load_models(latest).warm_up()
+        except Exception as exc:
+            with self._lock:
+                self.failed_versions[latest] = str(exc)
+            logger.exception("Model version %s failed to load, keeping version %s", latest, self.version)
+            return False
+        with self._lock:
+            previous, self.current = self.current, models
+            self.warm_up_seconds = models.warm_up_seconds
+        with self._versions_lock:
+            self.versions.pop(latest, None)
+            self._keep_version(previous)
+        logger.info("Switched from model version %s to %s (pid %s)", previous.version, latest, os.getpid())
+        return True
+
+    def health(self):
+        """Return a JSON serializable description of the registry state."""
+        return {
+            "status": self.state,
+            "pid": os.getpid(),
+            "version": self.version,
+            "versions": list(self.versions),
+            "failed_versions": dict(self.failed_versions),
+            "load_seconds": self.load_seconds,
+            "warm_up_seconds": self.warm_up_seconds,
+            "error": self.error,
+        }
+
+    def _get_version(self, version):
+        """Return the models of a pinned version, loading it outside of the lock if it is pinnable."""
+        with self._versions_lock:
+            models = self.versions.get(version)
+            if models is not None:
+                self.versions.move_to_end(version)
+                return models
+            future = self._loading.get(version)
+            loads = future is None
+            if loads:
+                if version in self.failed_versions:
+                    raise UnknownModelVersion(f"Model version {version!r} failed to load")
+                if version not in settings.MERON_MODEL_PINNABLE_VERSIONS:
+                    raise UnknownModelVersion(f"Unknown model version {version!r}")
+                future = self._loading[version] = Future()
+        if not loads:
+            return future.result()
+
+        try:
+            if version not in self.available_versions():
+                raise UnknownModelVersion(f"Unknown model version {version!r}")
+            models = self._load_models(version).warm_up()
+        except Exception as exc:
+            if not isinstance(exc, UnknownModelVersion):
+                with self._lock:
+                    self.failed_versions[version] = str(exc)
+                logger.exception("Pinned model version %s failed to load", version)
+            with self._versions_lock:
+                del self._loading[version]
+            future.set_exception(exc)
+            raise
+        with self._versions_lock:
+            del self._loading[version]
+            self._keep_version(models)
+        future.set_result(models)
+        return models
+
+    def _keep_version(self, models):
+        """Keep the models of a version that isn't the current one, dropping the least recently used ones.
+
+        Versions in `MERON_MODEL_PINNABLE_VERSIONS` are not dropped, they would be loaded again on the next request.
+        """
+        self.versions[models.version] = models
+        droppable = [version for version in self.versions if version not in settings.MERON_MODEL_PINNABLE_VERSIONS]
+        while len(droppable) > settings.MERON_MODEL_KEEP_VERSIONS:
+            del self.versions[droppable.pop(0)]
+
+    def _start_watching(self):
+        """Start checking for new versions in the background, once per process (threads don't survive a fork)."""
+        if not settings.MERON_MODEL_VERSIONS_DIR or not settings.MERON_MODEL_RELOAD_INTERVAL:
+            return
+        # checked without the lock first, this runs on every request
+        if self._watcher_pid == os.getpid():
+            return
+        with self._watcher_lock:
+            if self._watcher_pid == os.getpid():
+                return
+            self._watcher_pid = os.getpid()
+        threading.Thread(target=self._watch, name="meron-model-watcher", daemon=True).start()
+
+    def _watch(self):
+        while True:
+            time.sleep(settings.MERON_MODEL_RELOAD_INTERVAL)
+            try:
+                self.reload()
+            except Exception:
+                logger.exception("Checking for new model versions failed")
+
+    def _load_models(self, version):
+        """Build the face detector, the embedding network and the score and classification heads of a version.
+
+        The detectors and the Keras embedding network are the same for all versions, they are shared with the current
+        version if there is one.
+        """
+        if settings.MERON_STUB_MODELS:
+            from . import stub
+
+            detector = stub.StubDetector()
+            return ModelSet(
+                version,
+                detector,
+                stub.StubEmbedder(),
+                stub.StubScoreModel(),
+                stub.StubClassificationModel(),
+                detector,
+            )
+
+        runtime = settings.MERON_INFERENCE_RUNTIME
+        if runtime not in ("keras", "onnx"):
+            raise ImproperlyConfigured(f"Unknown MERON_INFERENCE_RUNTIME {runtime!r}, expected keras or onnx")
+
+        directory = version_directory(version)
+        if self.current is not None:
+            detector, fast_detector = self.current.detector, self.current.fast_detector
+        else:
+            detector, fast_detector = build_detectors()
+        if runtime == "onnx":
+            from .onnx_models import load_onnx_models
+
+            return ModelSet(
+                version,
+                detector,
+                *load_onnx_models(
+                    directory or settings.MERON_ONNX_DIR,
+                    settings.MERON_VGGFACE_MODEL,
+                    settings.MERON_ONNX_PRECISION,
+                    settings.MERON_ONNX_THREADS,
+                ),
+                fast_detector=fast_detector,
+            )
+
+        if self.current is not None:
+            embedder = self.current.embedder
+        else:
+            from .cpu import configure_tensorflow
+            from .embedders import VGGFaceEmbedder
+
+            if settings.MERON_INFERENCE_THREADS:
+                configure_tensorflow(settings.MERON_INFERENCE_THREADS)
+            weights = None
+            if settings.MERON_MMAP_DIR:
+                from .weights import EMBEDDER_DIR, load_weights
+
+                weights_dir = os.path.join(settings.MERON_MMAP_DIR, EMBEDDER_DIR)
+                weights = load_weights(weights_dir, settings.MERON_VGGFACE_MODEL)
+            embedder = VGGFaceEmbedder(settings.MERON_VGGFACE_MODEL, settings.MERON_FACE_SIZE, weights)
+        return ModelSet(version, detector, embedder, *build_heads(directory), fast_detector=fast_detector)
+
+
+# there is exactly one registry per process
+registry = ModelRegistry()
@@ -1,5 +1,5 @@
-"""Renderer that disable the forms in the API browser."""
-from rest_framework.renderers import BrowsableAPIRenderer
+"""Renderer that disable the forms in the API browser, and a renderer for metrics."""
+from rest_framework.renderers import BaseRenderer, BrowsableAPIRenderer
 
 
 class ReadOnlyBrowsableAPIRenderer(BrowsableAPIRenderer):
@@ -10,3 +10,14 @@ class ReadOnlyBrowsableAPIRenderer(BrowsableAPIRenderer):
         context = super().get_context(*args, **kwargs)
         context["display_edit_forms"] = False
         return context
+
+
+class PrometheusTextRenderer(BaseRenderer):
+    """Passes through metrics that are in the Prometheus text exposition format already."""
+
+    media_type = "text/plain"
+    format = "prometheus"
+    charset = "utf-8"
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        return data
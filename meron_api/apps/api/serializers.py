@@ -2,49 +2,145 @@
 
 We need to be able to accept an image either as multipart/form-data value or base64 encoded as part of a JSON object.
 """
-import os
 from rest_framework import serializers
-from meron_api.apps.meron_production.meron.meron_model import analyze_image
 
-from tempfile import TemporaryDirectory
-from .fields import Base64ImageField
+from .cache import get_result_cache, result_cache_key
+from .detectors import PROFILES
+from .fields import Base64ImageField, PerFaceField
+from .inference import AnalysisError, analyze_image, analyze_images
+from .metrics import stage_timer
 
 
 GENDER_CHOICES = (("f", "Female"), ("m", "Male"))
 
 
+def query_flag(query_params, name):
+    """Return True if the query params enable `name`, e.g. `?score`. `?score=false` doesn't."""
+    value = query_params.get(name)
+    return value is not None and value not in serializers.BooleanField.FALSE_VALUES
+
+
 class FaceDetectionInputSerializer(serializers.Serializer):
     """Serializer that uses Base64ImageField to allow POSTing of image as multipart/form-data or base64 in JSON."""
 
     image = Base64ImageField()
     score = serializers.BooleanField(required=False, default=True)
     classification = serializers.BooleanField(required=False, default=True)
-    age = serializers.IntegerField()
-    gender = serializers.ChoiceField(GENDER_CHOICES)
+    # with all_faces, age and gender can be lists with a value per face, from left to right
+    age = PerFaceField(serializers.IntegerField())
+    gender = PerFaceField(serializers.ChoiceField(GENDER_CHOICES))
+    all_faces = serializers.BooleanField(required=False, default=False)
+    # the fast profile uses a faster, less accurate face detector
+    profile = serializers.ChoiceField(PROFILES, required=False, default="default")
+
+    def validate(self, attrs):
+        """Apply the all_faces and fast query params, lists of ages and genders are only accepted with all_faces."""
+        request = self.context.get("request")
+        if request is not None and query_flag(request.query_params, "all_faces"):
+            attrs["all_faces"] = True
+        if request is not None and query_flag(request.query_params, "fast"):
+            attrs["profile"] = "fast"
+        if not attrs.get("all_faces"):
+            errors = {
+                field: ["A list is only accepted if all_faces is set."]
+                for field in ("age", "gender")
+                if isinstance(attrs.get(field), list)
+            }
+            if errors:
+                raise serializers.ValidationError(errors)
+        return attrs
+
+    def get_analysis_request(self, validated_data):
+        """Return the keyword arguments for analyze_image."""
+        # there is no request when images are scored offline, see the score_bulk management command
+        request = self.context.get("request")
+        query_params = request.query_params if request is not None else {}
+        return {
+            # Base64ImageField decoded the image already, analyze_image uses the cached pixels
+            "image": validated_data["image"],
+            # we look in data as well as GET params so users can do e.g. ?score in the URL
+            "score": query_flag(query_params, "score") or validated_data.get("score"),
+            "classification": query_flag(query_params, "classification") or validated_data.get("classification"),
+            "age": validated_data.get("age"),
+            "gender": validated_data.get("gender", ""),
+            "all_faces": validated_data.get("all_faces", False),
+            "profile": validated_data.get("profile", "default"),
+            # the models of the version the request pinned, None for the current version
+            "models": self.context.get("models"),
+        }
 
     def create(self, validated_data):
-        """Call face detection function and return results."""
-        # we need a file path that we can pass to analyze_image
-        django_content_file = validated_data["image"]
-        # using a temporary directory to make sure the file is accessible to the malnutrition detection function.
-        # The temporary directory will be deleted once the "with" context is completed
-        with TemporaryDirectory() as tmp_dir:
-            file_path = os.path.join(tmp_dir, django_content_file.name)
-            with open(file_path, "wb") as tmp_file:
-                tmp_file.write(django_content_file.read())
-            result = analyze_image(
-                file_path,
-                # we look in data as well as GET params so users can do e.g. ?score in the URL
-                "score" in self.context["request"].query_params
-                or validated_data.get("score"),
-                "classification" in self.context["request"].query_params
-                or validated_data.get("classification"),
-                validated_data.get("age"),
-                validated_data.get("gender", ""),
-            )
+        """Call face detection function and return results.
+
+        If the result cache is enabled, `cache_hit` tells whether the result was found in the cache.
+        """
+        analysis_request = self.get_analysis_request(validated_data)
+        cache = get_result_cache()
+        if cache is not None:
+            cache_key = result_cache_key(analysis_request)
+            with stage_timer("cache"):
+                result = cache.get(cache_key)
+            self.cache_hit = result is not None
+            if self.cache_hit:
+                return result
+
+        try:
+            result = analyze_image(**analysis_request)
+        except AnalysisError as exc:
+            raise serializers.ValidationError({exc.field: [str(exc)]})
+
+        if cache is not None:
+            cache.set(cache_key, result)
         return result
 
 
+def analyze_batch(items, context):
+    """Validate every item with FaceDetectionInputSerializer and analyze all valid items in one batch.
+
+    Returns a list with a `(result, errors)` tuple per item, in the order of `items`. `errors` is None for items that
+    were analyzed, `result` is None for items that failed validation or couldn't be analyzed, e.g. without a face.
+    """
+    input_serializers = [FaceDetectionInputSerializer(data=item, context=context) for item in items]
+    valid = [serializer.is_valid() for serializer in input_serializers]
+    requests = [
+        serializer.get_analysis_request(serializer.validated_data)
+        for serializer, is_valid in zip(input_serializers, valid)
+        if is_valid
+    ]
+    results = iter(analyze_images(requests, models=context.get("models")) if requests else [])
+
+    batch = []
+    for serializer, is_valid in zip(input_serializers, valid):
+        if not is_valid:
+            batch.append((None, serializer.errors))
+            continue
+        result = next(results)
+        if isinstance(result, AnalysisError):
+            batch.append((None, {result.field: [str(result)]}))
+        else:
+            batch.append((result, None))
+    return batch
+
+
+class BoundingBoxSerializer(serializers.Serializer):
+    """Render the bounding box of a face, in pixels of the uploaded image."""
+
+    left = serializers.IntegerField()
+    top = serializers.IntegerField()
+    right = serializers.IntegerField()
+    bottom = serializers.IntegerField()
+
+
+class FaceResultSerializer(serializers.Serializer):
+    """Render the results of one face of a request with all_faces."""
+
+    box = BoundingBoxSerializer()
+    score = serializers.FloatField(required=False)
+    classification = serializers.CharField(required=False)
+    age = serializers.IntegerField(required=False)
+    gender = serializers.CharField(required=False)
+
+
 class FaceDetectionOutputSerializer(serializers.Serializer):
     """Render all the values the face detection function returns."""
 
@@ -52,3 +148,5 @@ class FaceDetectionOutputSerializer(serializers.Serializer):
     classification = serializers.CharField(required=False)
     age = serializers.IntegerField(required=False)
     gender = serializers.CharField(required=False)
+    # only for requests with all_faces, which return the results of every face instead of the values above
+    faces = FaceResultSerializer(many=True, required=False)
@@ -0,0 +1,65 @@
+"""Deterministic stand-ins for the models, used when `MERON_STUB_MODELS` is set.
+
+They need neither TensorFlow, dlib nor the model files, so the API can be run, tested and benchmarked offline. The
+results only depend on the pixels of the image, the same image always gets the same score and classification. They
+are meaningless as a diagnosis.
+"""
+import time
+
+import numpy as np
+
+from .detectors import FaceRect
+
+# embeddings are the mean color of each cell of a GRID_SIZE x GRID_SIZE grid over the face
+GRID_SIZE = 4
+
+
+class StubDetector:
+    """Find a face in the center of every image that isn't (almost) black."""
+
+    # share of the shorter side of the image covered by the face
+    FACE_SHARE = 0.6
+
+    def __call__(self, pixels):
+        if pixels.max() < 16:
+            return []
+        height, width = pixels.shape[:2]
+        side = max(int(min(height, width) * self.FACE_SHARE), 1)
+        left = (width - side) // 2
+        top = (height - side) // 2
+        return [FaceRect(left, top, left + side, top + side)]
+
+
+class StubEmbedder:
+    """Embed faces as the mean colors of a grid over the face, scaled to 0-1.
+
+    `delay` is the time in seconds a batch takes, to simulate the cost of the real network in benchmarks.
+    """
+
+    def __init__(self, delay=0.0):
+        self.delay = delay
+
+    def embed(self, faces):
+        faces = np.asarray(faces, dtype="float32")
+        count, size = faces.shape[:2]
+        cell = max(size // GRID_SIZE, 1)
+        grid = faces[:, :cell * GRID_SIZE, :cell * GRID_SIZE]
+        grid = grid.reshape(count, GRID_SIZE, cell, GRID_SIZE, cell, 3).mean(axis=(2, 4))
+        if self.delay:
+            time.sleep(self.delay)
+        return grid.reshape(count, -1) / 255
+
+
+class StubScoreModel:
+    """Map the mean of the embedding (without age and gender) linearly to a z-score between -4 and 2."""
+
+    def predict(self, features):
+        return np.round(features[:, :-2].mean(axis=1) * 6 - 4, 2)
+
+
+class StubClassificationModel:
+    """Classify by the stub score with the WHO cut-offs for moderate and severe acute malnutrition."""
+
+    def predict(self, features):
+        scores = StubScoreModel().predict(features)
+        return np.where(scores < -3, "severe", np.where(scores < -2, "moderate", "normal"))
@@ -1,50 +1,166 @@
 """Run unittests that make sure API behaves as expected.
 
-The tests that are expecting a result from the API (and not an error) need to be updated as soon as the model is used
-instead of the fake function.
+The tests run with the deterministic stub models (`MERON_STUB_MODELS` in the test settings), they return a score of 2.0
+and the classification `normal` for a white image.
 """
+import asyncio
 import base64
+import csv
+import hashlib
+import importlib.util
 import json
 import logging
-from tempfile import NamedTemporaryFile
+import os
+import socket
+import subprocess
+import sys
+import threading
+import time
+from contextlib import ExitStack
+from io import BytesIO, StringIO
+from multiprocessing.pool import ThreadPool
+from tempfile import NamedTemporaryFile, TemporaryDirectory
+from types import SimpleNamespace
+from unittest import SkipTest, mock, skipUnless
 
-from django.test import Client, SimpleTestCase
-from malnutrition_detection import analyze_image
+from django.core.exceptions import ImproperlyConfigured
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.wsgi import get_wsgi_application
+from django.core.cache import caches
+from django.conf import settings
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.test import Client, SimpleTestCase, override_settings
+import numpy as np
+from PIL import Image
+from rest_framework.exceptions import ValidationError
+
+from . import bulk
+from .admission import AdmissionController, HostAdmissionController, Overloaded, get_admission_controller
+from .asgi import BufferedWSGIApplication
+from .batching import MicroBatcher, get_batcher
+from .benchmark import (
+    MODES,
+    STAGES,
+    benchmark_detectors,
+    benchmark_requests,
+    benchmark_stages,
+    summarize,
+    synthetic_face_image,
+)
+from .cpu import ASGI_WORKER_CLASS, available_cores, limit_thread_pools, topology
+from .detectors import FaceRect, create_detector, large_enough
+from .embedders import vggface_preprocess
+from .embedding_store import EmbeddingStore, get_embedding_store
+from .fields import Base64ImageField, DecodedImageFile
+from .inference import UnknownGender, analyze_image, analyze_images, crop_face, detect_face, load_pixels
+from .jobs import CLAIM_SUFFIX, IMAGE_SUFFIX, JobRunner, get_job_store
+from .log_formatters import JSONFormatter
+from .onnx_models import (
+    CLASSIFICATION_MODEL_FILE,
+    PARITY_TOLERANCES,
+    PRECISIONS,
+    SCORE_MODEL_FILE,
+    ONNXHead,
+    compare_models,
+    embedder_file,
+    export_head,
+    load_onnx_models,
+    parity_faces,
+)
+from .parsers import Base64ImageExtractor
+from .preprocessing import crop_from_file
+from .registry import (
+    DEFAULT_VERSION,
+    ModelRegistry,
+    ModelSet,
+    UnknownModelVersion,
+    build_detectors,
+    build_heads,
+    registry,
+)
+from .stub import StubDetector, StubEmbedder
+from .upstream import compare_with_upstream
+from .weights import load_head, load_weights, save_head, save_weights
+from .worker import prepare_worker
 
 # this is a base64 encoded 1x1 pixel gif
 BASE64_ENCODED_GIF = 'R0lGODdhAQABAIAAAP///////ywAAAAAAQABAAACAkQBADs='
 
 
+def encode_image(color, size=(8, 8), image_format='PNG'):
+    """Return a base64 encoded image filled with a single color."""
+    image_file = BytesIO()
+    Image.new('RGB', size, color).save(image_file, format=image_format)
+    return base64.b64encode(image_file.getvalue()).decode()
+
+
+class FakeModels:
+    """Stand-in for the model registry, so the API can be tested without TensorFlow and dlib.
+
+    The detector finds a face covering the whole image unless the image is black. The heads return the mean of the
+    features as score and a fixed classification.
+    """
+
+    def __init__(self):
+        self.version = 'fake'
+        self.detector = mock.Mock(side_effect=self.detect)
+        self.fast_detector = mock.Mock(side_effect=self.detect)
+        self.embedder = None
+        self.score_model = mock.Mock()
+        self.score_model.predict.side_effect = lambda features: features.mean(axis=1)
+        self.classification_model = mock.Mock()
+        self.classification_model.predict.side_effect = lambda features: ['normal'] * len(features)
+
+    @staticmethod
+    def detect(pixels):
+        if not pixels.any():
+            return []
+        return [FaceRect(0, 0, pixels.shape[1], pixels.shape[0])]
+
+    @staticmethod
+    def embed(embedder, faces):
+        return np.stack(faces).reshape(len(faces), -1)[:, :4]
+
+    def patch(self):
+        """Return a context manager that uses these models for all inference calls."""
+        patcher = mock.patch('meron_api.apps.api.inference.registry.get', return_value=self)
+        embed_patcher = mock.patch('meron_api.apps.api.inference.embed_faces', side_effect=self.embed)
+        stack = ExitStack()
+        stack.enter_context(patcher)
+        self.embed_faces = stack.enter_context(embed_patcher)
+        return stack
+
+
 class MalnutritionDetectionTestCase(SimpleTestCase):
     """Tests to make sure analyze_image function returns expected results.
 
-    At the moment a fake function is used until the real function is ready. So it doesn't make sense to test expected
-    results for specific inputs at the moment.
+    The stub models are used, so it doesn't make sense to test expected results for real photos.
     """
 
     def setUp(self):
         """Store objects relevant to all tests in this TestCase.
 
-        - expected return value of malnutrition_detection function
-        - image file that can be passed to malnutrition_detection function
+        - expected return value of analyze_image
+        - image file that can be passed to analyze_image
 
         """
-        # return from the malnutrition_detection function when both score and classification are calculated.
-        # This has to be adjusted to the real function once it's available
-        self.complete_return = {'width': 1, 'height': 1, 'score': 1, 'classification': 1}
-        # we need to pass a path to analyze_image so we need need a real file on the filesystem
+        # return from analyze_image when both score and classification are calculated
+        self.complete_return = {'age': 30, 'gender': 'm', 'score': 2.0, 'classification': 'normal'}
         image_file = NamedTemporaryFile()
         open(image_file.name, 'wb').write(base64.b64decode(BASE64_ENCODED_GIF))
         self.image_file = image_file
 
     def test_function_returns_expected_result(self):
         """Test a result with all available parameters."""
-        result = analyze_image(self.image_file.name, score=True, classification=True)
+        with open(self.image_file.name, 'rb') as image:
+            result = analyze_image(image, score=True, classification=True, age=30, gender='m')
         self.assertEqual(result, self.complete_return)
 
     def test_function_returns_result_without_score_if_ommited(self):
         """Test that omitting the score from the input also omits it from the output. classification works the same."""
-        result = analyze_image(self.image_file.name, classification=True)
+        with open(self.image_file.name, 'rb') as image:
+            result = analyze_image(image, score=False, classification=True, age=30, gender='m')
         self.complete_return.pop('score')
         self.assertEqual(result, self.complete_return)
 
@@ -55,12 +171,12 @@ class MERONApiTestCase(SimpleTestCase):
     def setUp(self):
         """Store objects relevant to all tests in this TestCase.
 
-        - expected return value of malnutrition_detection function
+        - expected return value of the API
         - image file that can be passed to the API as multipart/form-data
         - image file as base64 encoded string that that can be passed to the API as JSON
 
         """
-        self.complete_return = {'width': 1, 'height': 1, 'score': 1, 'classification': 1}
+        self.complete_return = {'age': 30, 'gender': 'm', 'score': 2.0, 'classification': 'normal'}
         self.base64_image_string = BASE64_ENCODED_GIF
         image_file = NamedTemporaryFile()
         with open(image_file.name, 'wb') as open_image_file:
@@ -72,22 +188,21 @@ class MERONApiTestCase(SimpleTestCase):
 
     def test_post_to_api_with_base64_in_json(self):
         """Test that a POST request with a valid image file as base64 encoded string in JSON works as expected."""
-        res = self.client.post('/', data=json.dumps({'image': self.base64_image_string}),
+        res = self.client.post('/', data=json.dumps({'image': self.base64_image_string, 'age': 30, 'gender': 'm'}),
                                content_type='application/json')
-        self.complete_return.pop('score')
-        self.complete_return.pop('classification')
+        self.assertEquals(res.status_code, 201)
         self.assertEquals(res.json(), self.complete_return)
 
     def test_post_to_api_with_formdata(self):
         """Test that a POST request with a valid image file as multipart/form-data works as expected."""
-        res = self.client.post('/', data={'image': self.image_file})
-        self.complete_return.pop('score')
-        self.complete_return.pop('classification')
+        res = self.client.post('/', data={'image': self.image_file, 'age': 30, 'gender': 'm'})
+        self.assertEquals(res.status_code, 201)
         self.assertEquals(res.json(), self.complete_return)
 
-    def test_post_json_to_api_with_score(self):
-        """Test that a POST request with valid image as JSON and `"score": true` works as expected."""
-        res = self.client.post('/', data=json.dumps({'image': self.base64_image_string, 'score': True}),
+    def test_post_json_to_api_without_classification(self):
+        """Test that a POST request with valid image as JSON and `"classification": false` omits the classification."""
+        res = self.client.post('/', data=json.dumps({'image': self.base64_image_string, 'classification': False,
+                                                     'age': 30, 'gender': 'm'}),
                                content_type='application/json')
         self.complete_return.pop('classification')
         self.assertEquals(res.json(), self.complete_return)
@@ -125,3 +240,1583 @@ class MERONApiTestCase(SimpleTestCase):
         res = self.client.post('/', data={'image': self.image_file})
         self.assertEquals(res.status_code, 400)
         self.assertEquals(res.json()['image'], ['The submitted file is empty.'])
+
+
+class ModelRegistryTestCase(SimpleTestCase):
+    """Tests for the process-wide model registry and the health endpoint."""
+
+    def test_models_are_loaded_only_once(self):
+        """Test that calling get() repeatedly doesn't load the models again."""
+        model_registry = ModelRegistry()
+        with mock.patch.object(ModelRegistry, '_load_models') as load_models:
+            model_registry.get()
+            model_registry.get()
+        load_models.assert_called_once_with(DEFAULT_VERSION)
+        self.assertTrue(model_registry.ready)
+
+    def test_failed_load_is_reported(self):
+        """Test that a failing load leaves the registry in the failed state with the error message."""
+        model_registry = ModelRegistry()
+        with mock.patch.object(ModelRegistry, '_load_models', side_effect=OSError('missing model file')):
+            with self.assertRaises(OSError):
+                model_registry.load()
+        self.assertEqual(model_registry.health()['status'], ModelRegistry.STATE_FAILED)
+        self.assertEqual(model_registry.health()['error'], 'missing model file')
+
+    def test_warm_up_runs_the_models_once(self):
+        """Test that warming up loads the models and runs them, but only the first time."""
+        model_registry = ModelRegistry().load()
+        model_registry.current.embedder = mock.Mock(wraps=model_registry.embedder)
+        model_registry.warm_up()
+        model_registry.warm_up()
+        model_registry.embedder.embed.assert_called_once()
+        self.assertIsNotNone(model_registry.health()['warm_up_seconds'])
+
+    def test_api_can_be_imported_without_model_libraries(self):
+        """Test that loading the URLconf doesn't import the libraries of the models, so commands start fast."""
+        code = (
+            'import sys, django; django.setup(); import meron_api.urls; '
+            'print(",".join(sorted({"tensorflow", "keras_vggface", "dlib", "sklearn", "cv2", "joblib"} '
+            '& set(sys.modules))))'
+        )
+        env = dict(os.environ, DJANGO_SETTINGS_MODULE='meron_api.settings.test')
+        output = subprocess.run([sys.executable, '-c', code], env=env, check=True, stdout=subprocess.PIPE)
+        self.assertEqual(output.stdout.decode().strip(), '')
+
+    def test_models_are_loaded_after_the_fork(self):
+        """Test that gunicorn doesn't load the application in the master and each worker warms up its own models."""
+        code = 'import meron_api.gunicorn_config as config; print(config.preload_app)'
+        output = subprocess.run([sys.executable, '-c', code], check=True, stdout=subprocess.PIPE)
+        self.assertEqual(output.stdout.decode().strip(), 'False')
+        with mock.patch.object(registry, 'warm_up', side_effect=OSError('missing model file')) as warm_up, \
+                mock.patch('meron_api.apps.api.jobs.get_job_runner') as get_job_runner:
+            logging.disable(logging.CRITICAL)
+            prepare_worker()
+        warm_up.assert_called_once()
+        get_job_runner.assert_called_once()
+
+    @override_settings(MERON_STUB_MODELS=False, MERON_INFERENCE_RUNTIME='tflite')
+    def test_unknown_runtime_fails(self):
+        """Test that a misspelled runtime is reported instead of silently using another one."""
+        with self.assertRaises(ImproperlyConfigured):
+            ModelRegistry().load()
+
+    def test_health_endpoint_returns_503_until_ready(self):
+        """Test that the health endpoint only reports success once the models are loaded."""
+        with mock.patch.object(registry, 'state', ModelRegistry.STATE_EMPTY):
+            res = Client().get('/health/')
+        self.assertEqual(res.status_code, 503)
+        with mock.patch.object(registry, 'state', ModelRegistry.STATE_READY):
+            res = Client().get('/health/')
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.json()['status'], 'ready')
+
+
+class LoadPixelsTestCase(SimpleTestCase):
+    """Tests that images are decoded in memory, from whatever the serializer passes on."""
+
+    def setUp(self):
+        """Store the decoded bytes of the test image."""
+        self.image_bytes = base64.b64decode(BASE64_ENCODED_GIF)
+
+    def test_bytes_are_decoded_to_rgb_array(self):
+        """Test that encoded bytes are decoded to an array with three channels."""
+        self.assertEqual(load_pixels(self.image_bytes).shape, (1, 1, 3))
+
+    def test_file_object_is_rewound_before_decoding(self):
+        """Test that a file object that was read during validation is decoded from the start."""
+        image_file = BytesIO(self.image_bytes)
+        image_file.read()
+        self.assertEqual(load_pixels(image_file).shape, (1, 1, 3))
+
+    def test_decoded_array_is_passed_through(self):
+        """Test that an array that was decoded already isn't decoded again."""
+        pixels = load_pixels(self.image_bytes)
+        self.assertIs(load_pixels(pixels), pixels)
+
+
+class Base64ImageFieldTestCase(SimpleTestCase):
+    """Tests that the image field decodes each upload once and caches the result on the validated value."""
+
+    def setUp(self):
+        """Store the field and the decoded bytes of the test image."""
+        self.field = Base64ImageField()
+        self.image_bytes = base64.b64decode(BASE64_ENCODED_GIF)
+        logging.disable(logging.CRITICAL)
+
+    def assert_decoded(self, value):
+        """Check the cached format, dimensions and pixels of a validated value."""
+        self.assertIsInstance(value, DecodedImageFile)
+        self.assertEqual(value.image_format, 'gif')
+        self.assertEqual((value.width, value.height), (1, 1))
+        self.assertEqual(value.pixels.shape, (1, 1, 3))
+        self.assertIs(load_pixels(value), value.pixels)
+
+    def test_base64_string_is_decoded_once(self):
+        """Test that a base64 encoded image is opened by PIL only once."""
+        with mock.patch('meron_api.apps.api.preprocessing.Image.open', wraps=Image.open) as image_open:
+            value = self.field.to_internal_value(BASE64_ENCODED_GIF)
+        image_open.assert_called_once()
+        self.assert_decoded(value)
+        self.assertTrue(value.name.endswith('.gif'))
+
+    def test_uploaded_file_is_decoded_once(self):
+        """Test that a multipart upload is opened by PIL only once and keeps its name."""
+        upload = SimpleUploadedFile('face.gif', self.image_bytes)
+        with mock.patch('meron_api.apps.api.preprocessing.Image.open', wraps=Image.open) as image_open:
+            value = self.field.to_internal_value(upload)
+        image_open.assert_called_once()
+        self.assert_decoded(value)
+        self.assertEqual(value.name, 'face.gif')
+
+    def test_truncated_image_fails(self):
+        """Test that an image that can't be decoded completely is rejected."""
+        png = BytesIO()
+        Image.new('RGB', (64, 64)).save(png, format='PNG')
+        with self.assertRaises(ValidationError):
+            self.field.to_internal_value(base64.b64encode(png.getvalue()[:-40]).decode())
+
+
+class BatchApiTestCase(SimpleTestCase):
+    """Tests for the batch endpoint."""
+
+    def setUp(self):
+        """Store the client and fake models."""
+        self.client = Client()
+        self.models = FakeModels()
+        logging.disable(logging.CRITICAL)
+
+    def post(self, items):
+        with self.models.patch():
+            return self.client.post('/batch/', data=json.dumps(items), content_type='application/json')
+
+    def test_batch_returns_results_and_errors_per_item(self):
+        """Test that valid items get results and invalid items or images without face get errors, in order."""
+        res = self.post([
+            {'image': encode_image('white'), 'age': 20, 'gender': 'f'},
+            {'image': encode_image('black'), 'age': 20, 'gender': 'f'},
+            {'image': encode_image('white'), 'gender': 'm'},
+            {'image': encode_image('white'), 'age': 30, 'gender': 'm', 'score': False},
+        ])
+        self.assertEqual(res.status_code, 201)
+        results = res.json()
+        self.assertEqual(len(results), 4)
+        self.assertEqual(results[0]['classification'], 'normal')
+        self.assertIn('score', results[0])
+        self.assertEqual(results[1], {'errors': {'image': ['No face could be detected in the image.']}})
+        self.assertEqual(results[2], {'errors': {'age': ['This field is required.']}})
+        self.assertNotIn('score', results[3])
+        self.assertEqual(results[3]['age'], 30)
+
+    def test_faces_are_embedded_in_one_forward_pass(self):
+        """Test that all faces of a batch are passed to the embedding network together."""
+        self.post([{'image': encode_image('white'), 'age': 20, 'gender': 'f'}] * 3)
+        self.models.embed_faces.assert_called_once()
+        self.assertEqual(len(self.models.embed_faces.call_args[0][1]), 3)
+
+    def test_batch_must_be_a_list(self):
+        """Test that a single object is rejected."""
+        res = self.post({'image': encode_image('white'), 'age': 20, 'gender': 'f'})
+        self.assertEqual(res.status_code, 400)
+
+
+class MicroBatcherTestCase(SimpleTestCase):
+    """Tests that concurrent requests are embedded together."""
+
+    def run_concurrently(self, batcher, faces_per_request):
+        results = [None] * len(faces_per_request)
+
+        def submit(index, faces):
+            try:
+                results[index] = batcher.submit('embedder', faces)
+            except ValueError as exc:
+                results[index] = exc
+
+        threads = [threading.Thread(target=submit, args=item) for item in enumerate(faces_per_request)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results
+
+    def test_concurrent_requests_are_embedded_in_one_batch(self):
+        """Test that requests arriving within the wait time share one forward pass and get their own embeddings."""
+        embed = mock.Mock(side_effect=lambda embedder, faces: np.array(faces)[:, None] * 2)
+        batcher = MicroBatcher(embed, max_batch_size=4, max_wait=5)
+        results = self.run_concurrently(batcher, [[1], [2, 3], [4]])
+        embed.assert_called_once()
+        self.assertEqual(sorted(embed.call_args[0][1]), [1, 2, 3, 4])
+        self.assertEqual([result.ravel().tolist() for result in results], [[2], [4, 6], [8]])
+        self.assertEqual(batcher.stats()['batch_sizes'], {4: 1})
+        metrics = Client().get('/metrics/').content.decode()
+        self.assertIn('meron_micro_batch_size_bucket{le="4.0"}', metrics)
+        self.assertIn('meron_micro_batch_wait_seconds_count', metrics)
+
+    def test_errors_are_passed_to_every_waiting_request(self):
+        """Test that a failing forward pass raises the error in the requests of the batch."""
+        batcher = MicroBatcher(mock.Mock(side_effect=ValueError('boom')), max_batch_size=2, max_wait=5)
+        logging.disable(logging.CRITICAL)
+        results = self.run_concurrently(batcher, [[1], [2]])
+        self.assertTrue(all(isinstance(result, ValueError) for result in results))
+
+    @override_settings(MERON_MICRO_BATCHING=True)
+    def test_single_threaded_workers_dont_batch(self):
+        """Test that workers that handle one request at a time don't wait for a batch."""
+        with self.settings(MERON_REQUEST_THREADS=1):
+            self.assertIsNone(get_batcher())
+        with self.settings(MERON_REQUEST_THREADS=4):
+            self.assertIsInstance(get_batcher(), MicroBatcher)
+
+
+@override_settings(MERON_RESULT_CACHE=True)
+class ResultCacheTestCase(SimpleTestCase):
+    """Tests that repeated uploads of the same image are answered from the cache."""
+
+    def setUp(self):
+        """Store the client and fake models and start with an empty cache."""
+        self.client = Client()
+        self.models = FakeModels()
+        caches['results'].clear()
+
+    def post(self, **data):
+        data = {'image': encode_image('white'), 'age': 20, 'gender': 'f', **data}
+        return self.client.post('/', data=json.dumps(data), content_type='application/json')
+
+    def test_repeated_upload_is_a_cache_hit(self):
+        """Test that the second identical request doesn't run the model and returns the same result."""
+        with self.models.patch():
+            first, second = self.post(), self.post()
+        self.assertEqual(first['X-Cache'], 'MISS')
+        self.assertEqual(second['X-Cache'], 'HIT')
+        self.assertEqual(first.json(), second.json())
+        self.models.embed_faces.assert_called_once()
+
+    def test_different_parameters_are_cached_separately(self):
+        """Test that the same image with a different age isn't served from the cache."""
+        with self.models.patch():
+            self.post()
+            self.assertEqual(self.post(age=21)['X-Cache'], 'MISS')
+            self.assertEqual(self.post(image=encode_image('gray'))['X-Cache'], 'MISS')
+
+
+class JobApiTestCase(SimpleTestCase):
+    """Tests for asynchronous jobs."""
+
+    def setUp(self):
+        """Use a temporary job directory and the fake models."""
+        job_dir = TemporaryDirectory()
+        self.addCleanup(job_dir.cleanup)
+        # the jobs are run by the test instead of job threads
+        settings_override = override_settings(MERON_JOB_DIR=job_dir.name, MERON_JOB_WORKERS=0)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        self.client = Client()
+        self.models = FakeModels()
+        self.runner = JobRunner(get_job_store(), threads=0, poll_interval=1)
+
+    def submit(self, data, **extra):
+        return self.client.post('/jobs/', data=json.dumps(data), content_type='application/json', **extra)
+
+    def submit_and_wait(self, data):
+        """Submit a job, run the queued jobs and return the submit response and the job."""
+        with self.models.patch():
+            res = self.submit(data)
+            self.runner.run_pending()
+        return res, self.client.get(res['Location']).json()
+
+    def test_job_returns_202_and_result_can_be_polled(self):
+        """Test that the job is accepted right away and its result is available at the job URL."""
+        res, job = self.submit_and_wait({'image': encode_image('white'), 'age': 20, 'gender': 'f'})
+        self.assertEqual(res.status_code, 202)
+        self.assertEqual(res.json()['status'], 'queued')
+        self.assertEqual(job['status'], 'done')
+        self.assertEqual(job['result']['classification'], 'normal')
+
+    def test_job_without_face_fails(self):
+        """Test that errors raised during the analysis are stored in the job."""
+        res, job = self.submit_and_wait({'image': encode_image('black'), 'age': 20, 'gender': 'f'})
+        self.assertEqual(job['status'], 'failed')
+        self.assertEqual(job['errors'], {'image': ['No face could be detected in the image.']})
+
+    def test_invalid_request_is_rejected_immediately(self):
+        """Test that validation happens before the job is created."""
+        res = self.client.post('/jobs/', data=json.dumps({'age': 20}), content_type='application/json')
+        self.assertEqual(res.status_code, 400)
+
+    def test_unknown_job_returns_404(self):
+        """Test that polling a job that doesn't exist fails."""
+        self.assertEqual(self.client.get('/jobs/{}/'.format('0' * 32)).status_code, 404)
+
+    def test_jobs_of_dead_workers_are_run_again(self):
+        """Test that a running job whose worker is gone is requeued and run by another worker."""
+        data = {'image': encode_image('white'), 'age': 20, 'gender': 'f'}
+        job_id = self.submit(data).json()['id']
+        store = self.runner.store
+        self.assertEqual(store.claim_next(), job_id)
+        self.assertIsNone(store.claim_next())
+        # the claim of a process that doesn't exist
+        with open(store.path(job_id, CLAIM_SUFFIX), 'w') as claim_file:
+            json.dump({'host': socket.gethostname(), 'pid': 2 ** 22 + 1, 'claimed': time.time()}, claim_file)
+        self.assertEqual(self.runner.recover(), [job_id])
+        with self.models.patch():
+            self.assertEqual(self.runner.run_pending(), 1)
+        job = self.client.get(f'/jobs/{job_id}/').json()
+        self.assertEqual((job['status'], job['attempts']), ('done', 1))
+        self.assertEqual(store.unfinished(), [])
+
+    @override_settings(MERON_JOB_MAX_ATTEMPTS=1, MERON_JOB_STALE_AFTER=60)
+    def test_repeatedly_interrupted_jobs_fail(self):
+        """Test that a job whose claim on another host wasn't touched in time fails after the last attempt."""
+        job_id = self.submit({'image': encode_image('white'), 'age': 20, 'gender': 'f'}).json()['id']
+        store = self.runner.store
+        store.claim_next()
+        self.assertEqual(self.runner.recover(), [])
+        claim_path = store.path(job_id, CLAIM_SUFFIX)
+        with open(claim_path, 'w') as claim_file:
+            json.dump({'host': 'other-host', 'pid': os.getpid(), 'claimed': time.time() - 61}, claim_file)
+        os.utime(claim_path, (time.time() - 61, time.time() - 61))
+        self.assertEqual(self.runner.recover(), [job_id])
+        self.assertEqual(self.client.get(f'/jobs/{job_id}/').json()['status'], 'failed')
+
+    @override_settings(MERON_JOB_STALE_AFTER=60)
+    def test_slow_jobs_of_live_workers_are_not_run_again(self):
+        """Test that old claims are kept while their worker is alive or touches them."""
+        job_id = self.submit({'image': encode_image('white'), 'age': 20, 'gender': 'f'}).json()['id']
+        store = self.runner.store
+        store.claim_next()
+        claim_path = store.path(job_id, CLAIM_SUFFIX)
+        os.utime(claim_path, (time.time() - 61, time.time() - 61))
+        self.assertEqual(self.runner.recover(), [])
+        with open(claim_path, 'w') as claim_file:
+            json.dump({'host': 'other-host', 'pid': os.getpid(), 'claimed': time.time() - 61}, claim_file)
+        store.touch_claim(job_id)
+        self.assertEqual(self.runner.recover(), [])
+        self.assertTrue(os.path.exists(claim_path))
+
+    def test_only_finished_jobs_are_purged(self):
+        """Test that old queued jobs are kept while old finished jobs and leftover files are deleted."""
+        data = {'image': encode_image('white'), 'age': 20, 'gender': 'f'}
+        store = self.runner.store
+        res, job = self.submit_and_wait(data)
+        queued_id = self.submit(data).json()['id']
+        orphan_path = store.path('0' * 32, IMAGE_SUFFIX)
+        with open(orphan_path, 'wb') as orphan_file:
+            orphan_file.write(b'image')
+        for entry in os.scandir(store.directory):
+            os.utime(entry.path, (time.time() - 3600, time.time() - 3600))
+        store.purge(60)
+        self.assertEqual(store.unfinished(), [queued_id])
+        self.assertTrue(os.path.exists(store.path(queued_id, IMAGE_SUFFIX)))
+        self.assertIsNone(store.get(job['id']))
+        self.assertFalse(os.path.exists(orphan_path))
+
+    @override_settings(MERON_JOB_QUEUE_SIZE=1)
+    def test_full_queue_returns_503(self):
+        """Test that submissions are rejected while the queue is full."""
+        data = {'image': encode_image('white'), 'age': 20, 'gender': 'f'}
+        self.assertEqual(self.submit(data).status_code, 202)
+        res = self.submit(data)
+        self.assertEqual(res.status_code, 503)
+        self.assertIn('Retry-After', res)
+        store = self.runner.store
+        self.assertEqual(len([name for name in os.listdir(store.directory) if name.endswith(IMAGE_SUFFIX)]), 1)
+
+    def test_submission_goes_through_admission_control(self):
+        """Test that stale submissions are shed like requests to the other endpoints."""
+        res = self.submit({'image': encode_image('white'), 'age': 20, 'gender': 'f'},
+                          HTTP_X_REQUEST_START=f't={time.time() - 3600}')
+        self.assertEqual(res.status_code, 503)
+
+
+class StreamingJSONParserTestCase(SimpleTestCase):
+    """Tests that base64 encoded images are decoded while the JSON body is read."""
+
+    def extract(self, document, chunk_size):
+        extractor = Base64ImageExtractor(spool_size=1024)
+        for start in range(0, len(document), chunk_size):
+            extractor.feed(document[start:start + chunk_size])
+        return extractor.restore(json.loads(extractor.finish()))
+
+    def test_images_are_decoded_independent_of_chunk_boundaries(self):
+        """Test that images and the other values are parsed correctly, no matter where the body is split."""
+        image = encode_image('white', size=(32, 32))
+        # JSON allows escaping slashes, which some encoders do
+        document = json.dumps([{'age': 3, 'image': image}, {'image': image, 'gender': 'm'}]).replace('/', '\\/')
+        for chunk_size in (1, 3, 7, 64, len(document)):
+            data = self.extract(document, chunk_size)
+            self.assertEqual(data[0]['age'], 3)
+            self.assertEqual(data[1]['gender'], 'm')
+            for item in data:
+                self.assertEqual(item['image'].read(), base64.b64decode(image))
+
+    def test_api_accepts_streamed_image(self):
+        """Test that an image decoded by the parser passes validation and reaches the model."""
+        models = FakeModels()
+        data = {'image': encode_image('white', image_format='JPEG'), 'age': 20, 'gender': 'f'}
+        with models.patch():
+            res = Client().post('/', data=json.dumps(data), content_type='application/json')
+        self.assertEqual(res.status_code, 201)
+        self.assertEqual(models.embed_faces.call_args[0][1][0].shape, (224, 224, 3))
+
+    @override_settings(MERON_MAX_UPLOAD_SIZE=100)
+    def test_large_upload_is_rejected(self):
+        """Test that a body larger than MERON_MAX_UPLOAD_SIZE is rejected with status 413."""
+        data = {'image': encode_image('white', size=(64, 64)), 'age': 20, 'gender': 'f'}
+        res = Client().post('/', data=json.dumps(data), content_type='application/json')
+        self.assertEqual(res.status_code, 413)
+
+
+class DownscalingTestCase(SimpleTestCase):
+    """Tests that decoding large photos at reduced resolution gives the same face crops as full resolution."""
+
+    @staticmethod
+    def detect_bright_region(pixels):
+        """Fake detector that returns the bounding box of the bright pixels."""
+        rows, cols = np.nonzero(pixels.mean(axis=2) > 100)
+        return [FaceRect(cols.min(), rows.min(), cols.max() + 1, rows.max() + 1)]
+
+    def make_photo(self, face_box, size=(3000, 2000)):
+        """Return a JPEG photo with a dark background and a bright, smoothly shaded "face" in `face_box`."""
+        left, top, right, bottom = face_box
+        y, x = np.mgrid[top:bottom, left:right]
+        pixels = np.zeros((size[1], size[0], 3), dtype='uint8')
+        pixels[top:bottom, left:right, 0] = 150 + 100 * (x - left) / (right - left)
+        pixels[top:bottom, left:right, 1] = 150 + 100 * (y - top) / (bottom - top)
+        pixels[top:bottom, left:right, 2] = 200
+        photo = BytesIO()
+        Image.fromarray(pixels).save(photo, format='JPEG', quality=95)
+        return base64.b64encode(photo.getvalue()).decode()
+
+    def crop(self, photo, max_side):
+        with override_settings(MERON_DETECTION_MAX_SIDE=max_side):
+            image = Base64ImageField().to_internal_value(photo)
+            box = detect_face(self.detect_bright_region, image.pixels)
+            return image, crop_face(image, image.pixels, box)
+
+    def assert_same_crop(self, face_box):
+        photo = self.make_photo(face_box)
+        image, downscaled_crop = self.crop(photo, 800)
+        self.assertLessEqual(max(image.pixels.shape), 800)
+        self.assertEqual((image.width, image.height), (3000, 2000))
+        full_image, full_crop = self.crop(photo, 0)
+        self.assertEqual(full_image.pixels.shape, (2000, 3000, 3))
+        self.assertEqual(downscaled_crop.shape, full_crop.shape)
+        self.assertLess(np.abs(downscaled_crop - full_crop).mean(), 8)
+
+    def test_small_face_is_cropped_from_higher_resolution(self):
+        """Test a face that is smaller than the network input in the image decoded for detection."""
+        with mock.patch('meron_api.apps.api.fields.crop_from_file', wraps=crop_from_file) as crop:
+            self.assert_same_crop((1200, 800, 1500, 1100))
+        crop.assert_called_once()
+
+    def test_small_face_needs_the_open_upload(self):
+        """Test that a closed upload fails instead of falling back to the lower resolution."""
+        image = Base64ImageField().to_internal_value(self.make_photo((1200, 800, 1500, 1100)))
+        box = detect_face(self.detect_bright_region, image.pixels)
+        image.file.close()
+        with self.assertRaises(ValueError):
+            crop_face(image, image.pixels, box)
+
+    @override_settings(MERON_JOB_WORKERS=0)
+    def test_jobs_get_the_same_crop_as_requests(self):
+        """Test that a small face gets the same score whether it is analyzed right away or as a job."""
+        models = FakeModels()
+        models.detector.side_effect = self.detect_bright_region
+        data = json.dumps({'image': self.make_photo((1200, 800, 1500, 1100)), 'age': 20, 'gender': 'f'})
+        with TemporaryDirectory() as job_dir, self.settings(MERON_JOB_DIR=job_dir), models.patch():
+            result = Client().post('/', data=data, content_type='application/json').json()
+            job_id = Client().post('/jobs/', data=data, content_type='application/json').json()['id']
+            JobRunner(get_job_store(), threads=0, poll_interval=1).run_pending()
+            job = Client().get(f'/jobs/{job_id}/').json()
+        self.assertEqual(job['result'], result)
+
+    def test_large_face_is_cropped_from_detection_image(self):
+        """Test a face that is large enough in the image decoded for detection."""
+        with mock.patch('meron_api.apps.api.fields.crop_from_file', wraps=crop_from_file) as crop:
+            self.assert_same_crop((600, 200, 2400, 1900))
+        crop.assert_not_called()
+
+
+class BenchmarkTestCase(SimpleTestCase):
+    """Smoke tests for the benchmark harness, with tiny images and few requests so they run fast."""
+
+    def setUp(self):
+        """Create a small synthetic image."""
+        self.image_bytes = synthetic_face_image((64, 48), 'png')
+
+    def test_synthetic_image_contains_a_face(self):
+        """Test that the stub models find a face in the synthetic image."""
+        result = analyze_image(self.image_bytes, age=30, gender='m')
+        self.assertEqual(set(result), {'age', 'gender', 'score', 'classification'})
+
+    def test_summarize_returns_percentiles_in_milliseconds(self):
+        """Test the percentiles of 1 to 100 milliseconds."""
+        summary = summarize([i / 1000 for i in range(1, 101)])
+        self.assertAlmostEqual(summary['p50_ms'], 50.5)
+        self.assertAlmostEqual(summary['p99_ms'], 99.01)
+
+    def test_request_benchmark_uploads_in_all_modes(self):
+        """Test that multipart and base64 uploads are analyzed successfully by concurrent clients."""
+        for mode in MODES:
+            row = benchmark_requests(self.image_bytes, 'png', mode, requests=4, concurrency=2)
+            self.assertEqual(row['requests'], 4)
+            self.assertEqual(row['errors'], 0)
+            self.assertLessEqual(row['p50_ms'], row['p99_ms'])
+
+    def test_stage_benchmark_reports_every_stage(self):
+        """Test that the stage benchmark times all stages."""
+        stages = benchmark_stages(self.image_bytes, 'png', repeat=2)
+        self.assertEqual(list(stages), list(STAGES))
+        self.assertGreater(stages['decode']['p50_ms'], 0)
+
+    def test_command_writes_json_report(self):
+        """Test that the management command reports a row per mode and the stages per image."""
+        out = StringIO()
+        call_command('benchmark_api', '--stub', '--sizes', '64x48', '--formats', 'jpeg', '--requests', '2',
+                     '--stage-repeat', '1', '--json', stdout=out)
+        report = json.loads(out.getvalue())
+        self.assertEqual([row['mode'] for row in report['requests']], list(MODES))
+        self.assertEqual(len(report['stages']), 1)
+
+
+class MetricsTestCase(SimpleTestCase):
+    """Tests for the timing middleware, the stage timers and the metrics endpoint."""
+
+    def post_image(self):
+        return Client().post('/', data=json.dumps({'image': encode_image('white'), 'age': 30, 'gender': 'm'}),
+                             content_type='application/json')
+
+    def test_response_reports_stage_durations(self):
+        """Test that the Server-Timing header contains the stages of the analysis and the total."""
+        res = self.post_image()
+        self.assertEqual(res.status_code, 201)
+        stages = [metric.split(';')[0] for metric in res['Server-Timing'].split(', ')]
+        self.assertEqual(stages,
+                         ['parse', 'decode', 'hash', 'detect', 'align', 'embed', 'score', 'classification', 'total'])
+
+    def test_request_is_logged_with_stage_fields(self):
+        """Test that the request log line carries the durations as structured fields."""
+        previous = logging.root.manager.disable
+        logging.disable(logging.NOTSET)
+        self.addCleanup(logging.disable, previous)
+        with self.assertLogs('meron_api.apps.api.middleware', 'INFO') as logs:
+            self.post_image()
+        record = logs.records[0]
+        self.assertEqual(record.view, 'api_root')
+        self.assertEqual(record.status, 201)
+        self.assertIn('detect', record.stage_ms)
+        entry = json.loads(JSONFormatter().format(record))
+        self.assertEqual(entry['logger'], 'meron_api.apps.api.middleware')
+        self.assertEqual(entry['status'], 201)
+        self.assertEqual(set(entry['stage_ms']), set(record.stage_ms))
+        self.assertIn('duration_ms', entry)
+
+    def test_metrics_endpoint_exports_histograms(self):
+        """Test that the stage and request histograms are exported in the Prometheus text format."""
+        self.post_image()
+        res = Client().get('/metrics')
+        self.assertEqual(res.status_code, 200)
+        self.assertTrue(res['Content-Type'].startswith('text/plain'))
+        content = res.content.decode()
+        self.assertIn('meron_stage_duration_seconds_count{stage="embed"}', content)
+        self.assertIn('meron_request_duration_seconds_count{method="POST",status="201",view="api_root"}', content)
+
+
+def installed(*modules):
+    return all(importlib.util.find_spec(module) is not None for module in modules)
+
+
+class ONNXRuntimeTestCase(SimpleTestCase):
+    """Tests for running the models with onnxruntime."""
+
+    def test_preprocessing_matches_keras_vggface(self):
+        """Test that the faces are converted to BGR and the means of keras_vggface version 2 are subtracted."""
+        faces = np.tile(np.array([10, 20, 30], dtype='float32'), (1, 2, 2, 1))
+        preprocessed = vggface_preprocess(faces, 'resnet50')
+        np.testing.assert_allclose(preprocessed[0, 0, 0], [30 - 91.4953, 20 - 103.8827, 10 - 131.0912], rtol=1e-6)
+
+    def test_embedder_file_names(self):
+        """Test that every precision has its own file and unknown precisions fail."""
+        self.assertEqual([embedder_file(precision) for precision in PRECISIONS],
+                         ['embedder.onnx', 'embedder.fp16.onnx', 'embedder.int8.onnx'])
+        with self.assertRaises(ValueError):
+            embedder_file('int4')
+
+    def export(self, output_dir, parities):
+        """Run export_onnx with stand-ins for the exporters, `parities` are the comparison results per precision."""
+        command = 'meron_api.apps.api.management.commands.export_onnx'
+        reference = ModelRegistry().load().current
+
+        def write(path):
+            with open(path, 'w') as model_file:
+                model_file.write('exported')
+
+        with ExitStack() as stack:
+            stack.enter_context(mock.patch(f'{command}.ModelRegistry', return_value=mock.Mock(load=lambda: reference)))
+            stack.enter_context(mock.patch(f'{command}.export_embedder', side_effect=lambda *args: write(args[2])))
+            stack.enter_context(mock.patch(f'{command}.export_head', side_effect=lambda *args: write(args[2])))
+            stack.enter_context(mock.patch(f'{command}.convert_to_fp16', side_effect=lambda *args: write(args[1])))
+            stack.enter_context(mock.patch(f'{command}.quantize_to_int8', side_effect=lambda *args: write(args[1])))
+            stack.enter_context(mock.patch(f'{command}.load_onnx_models', return_value=(None, None, None)))
+            stack.enter_context(mock.patch(f'{command}.compare_models', side_effect=[
+                {'faces': 2, 'max_score_difference': difference, 'classification_agreement': agreement}
+                for difference, agreement in parities
+            ]))
+            call_command('export_onnx', '--output-dir', output_dir, '--parity-faces', '2', stdout=StringIO())
+
+    def test_export_fails_if_a_model_diverges(self):
+        """Test that a diverging model fails the export and leaves the output directory as it was."""
+        with TemporaryDirectory() as output_dir:
+            with self.assertRaises(CommandError) as raised:
+                self.export(output_dir, [(0.001, 1.0), (0.1, 1.0), (0.3, 0.99)])
+            self.assertIn('int8', str(raised.exception))
+            self.assertEqual(os.listdir(output_dir), [])
+            self.export(output_dir, [(0.001, 1.0), (0.1, 1.0), (0.2, 0.99)])
+            self.assertEqual(sorted(os.listdir(output_dir)), sorted(
+                [embedder_file(precision) for precision in PRECISIONS] + [SCORE_MODEL_FILE, CLASSIFICATION_MODEL_FILE]
+            ))
+
+    @skipUnless(installed('sklearn', 'skl2onnx', 'onnxruntime'), 'scikit-learn, skl2onnx or onnxruntime missing')
+    def test_exported_heads_agree_with_scikit_learn(self):
+        """Test that exported heads return the same score and classification as the scikit-learn models."""
+        from sklearn.linear_model import LinearRegression, LogisticRegression
+
+        rng = np.random.RandomState(0)
+        features = rng.rand(200, StubEmbedder().embed(np.zeros((1, 8, 8, 3))).shape[1] + 2)
+        targets = features[:, :-2].mean(axis=1)
+        reference = SimpleNamespace(
+            embedder=StubEmbedder(),
+            score_model=LinearRegression().fit(features, targets),
+            classification_model=LogisticRegression().fit(features, np.where(targets < 0.5, 'moderate', 'normal')),
+        )
+        with TemporaryDirectory() as directory:
+            export_head(reference.score_model, features.shape[1], f'{directory}/score.onnx', opset=13)
+            export_head(reference.classification_model, features.shape[1], f'{directory}/classification.onnx',
+                        opset=13)
+            candidate = SimpleNamespace(
+                embedder=StubEmbedder(),
+                score_model=ONNXHead(f'{directory}/score.onnx'),
+                classification_model=ONNXHead(f'{directory}/classification.onnx'),
+            )
+            faces = parity_faces(reference, face_size=32, count=16)
+            parity = compare_models(reference, candidate, faces)
+        self.assertEqual(parity['faces'], 16)
+        self.assertLess(parity['max_score_difference'], 1e-4)
+        self.assertEqual(parity['classification_agreement'], 1.0)
+
+
+@skipUnless(installed('keras_vggface', 'dlib', 'onnxruntime'), 'keras_vggface, dlib or onnxruntime missing')
+@override_settings(MERON_STUB_MODELS=False, MERON_INFERENCE_RUNTIME='keras')
+class ONNXParityTestCase(SimpleTestCase):
+    """Compare the models exported by `export_onnx` with the Keras models on a fixed set of faces.
+
+    Needs the model files and the exported models, run `python manage.py export_onnx` first.
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        if not os.path.exists(os.path.join(settings.MERON_ONNX_DIR, embedder_file('fp32'))):
+            raise SkipTest('No exported models in MERON_ONNX_DIR')
+        cls.reference = ModelRegistry().load()
+        cls.faces = parity_faces(cls.reference, settings.MERON_FACE_SIZE, count=32)
+
+    def compare(self, precision):
+        embedder, score_model, classification_model = load_onnx_models(
+            settings.MERON_ONNX_DIR, settings.MERON_VGGFACE_MODEL, precision
+        )
+        candidate = SimpleNamespace(
+            embedder=embedder, score_model=score_model, classification_model=classification_model
+        )
+        return compare_models(self.reference, candidate, self.faces)
+
+    def test_fp32_model_agrees_with_keras(self):
+        """Test that the exported model only differs by rounding."""
+        parity = self.compare('fp32')
+        max_score_difference, min_agreement = PARITY_TOLERANCES['fp32']
+        self.assertLess(parity['max_score_difference'], max_score_difference)
+        self.assertGreaterEqual(parity['classification_agreement'], min_agreement)
+
+    def test_reduced_precision_models_mostly_agree_with_keras(self):
+        """Test that 16 bit float and 8 bit integer weights hardly change the results."""
+        for precision in ('fp16', 'int8'):
+            if not os.path.exists(os.path.join(settings.MERON_ONNX_DIR, embedder_file(precision))):
+                continue
+            with self.subTest(precision=precision):
+                parity = self.compare(precision)
+                max_score_difference, min_agreement = PARITY_TOLERANCES[precision]
+                self.assertLess(parity['max_score_difference'], max_score_difference)
+                self.assertGreaterEqual(parity['classification_agreement'], min_agreement)
+
+
+class TopologyTestCase(SimpleTestCase):
+    """Tests for dividing the cores between gunicorn workers and the thread pools of the inference libraries."""
+
+    def test_per_core_topology_runs_a_single_threaded_worker_per_core(self):
+        """Test the defaults of the per-core topology."""
+        self.assertEqual(topology('per-core', 8),
+                         {'workers': 8, 'worker_class': 'sync', 'threads': 1, 'inference_threads': 1})
+
+    def test_threaded_topology_gives_all_cores_to_one_worker(self):
+        """Test the defaults of the threaded topology."""
+        self.assertEqual(topology('threaded', 8),
+                         {'workers': 1, 'worker_class': 'gthread', 'threads': 4, 'inference_threads': 8})
+
+    def test_async_topology_runs_an_asgi_worker(self):
+        """Test that the async topology uses the uvicorn worker with the threads of the threaded topology."""
+        self.assertEqual(topology('async', 8),
+                         {'workers': 1, 'worker_class': ASGI_WORKER_CLASS, 'threads': 4, 'inference_threads': 8})
+
+    def test_overrides_divide_the_remaining_cores(self):
+        """Test that explicit worker counts share the cores and explicit values win."""
+        self.assertEqual(topology('threaded', 8, workers=2)['inference_threads'], 4)
+        self.assertEqual(topology('per-core', 8, workers=3)['inference_threads'], 2)
+        self.assertEqual(topology('per-core', 8, inference_threads=2)['inference_threads'], 2)
+        with self.assertRaises(ValueError):
+            topology('hybrid', 8)
+
+    def test_limits_set_in_the_environment_are_kept(self):
+        """Test that the thread pools are limited unless the environment limits them already."""
+        with mock.patch.dict(os.environ, {'OMP_NUM_THREADS': '3'}):
+            limit_thread_pools(2)
+            self.assertEqual(os.environ['OMP_NUM_THREADS'], '3')
+            self.assertEqual(os.environ['MKL_NUM_THREADS'], '2')
+
+    def test_cpu_quota_limits_available_cores(self):
+        """Test that a container limited to 2.5 cores gets 2 workers, no matter how many cores the host has."""
+        with mock.patch('meron_api.apps.api.cpu.cgroup_cpu_quota', return_value=2.5), \
+                mock.patch('os.sched_getaffinity', return_value=set(range(16))):
+            self.assertEqual(available_cores(), 2)
+
+
+class AnalysisStagesTestCase(SimpleTestCase):
+    """Tests that every stage runs once per image and only the requested heads run."""
+
+    def setUp(self):
+        """Use fake models and create a white test image."""
+        self.models = FakeModels()
+        self.image = base64.b64decode(encode_image('white'))
+
+    def analyze(self, **kwargs):
+        with self.models.patch():
+            return analyze_image(self.image, age=30, gender='f', **kwargs)
+
+    def test_both_heads_share_detection_and_embedding(self):
+        """Test that the face is detected and embedded once for both heads."""
+        result = self.analyze()
+        self.assertEqual(set(result), {'age', 'gender', 'score', 'classification'})
+        self.assertEqual(self.models.detector.call_count, 1)
+        self.models.embed_faces.assert_called_once()
+
+    def test_only_requested_head_runs(self):
+        """Test that a classification-only request doesn't run the score model."""
+        result = self.analyze(score=False)
+        self.assertEqual(result, {'age': 30, 'gender': 'f', 'classification': 'normal'})
+        self.models.score_model.predict.assert_not_called()
+        self.models.classification_model.predict.assert_called_once()
+
+    def test_no_embedding_without_heads(self):
+        """Test that only the face detection runs if no head was requested."""
+        result = self.analyze(score=False, classification=False)
+        self.assertEqual(result, {'age': 30, 'gender': 'f'})
+        self.models.detector.assert_called_once()
+        self.models.embed_faces.assert_not_called()
+
+    def test_batch_runs_each_head_over_the_images_that_requested_it(self):
+        """Test that a batch embeds the faces together and runs each head once over its images."""
+        requests = [
+            {'image': self.image, 'score': True, 'classification': False, 'age': 30, 'gender': 'f'},
+            {'image': self.image, 'score': False, 'classification': True, 'age': 30, 'gender': 'f'},
+            {'image': self.image, 'score': False, 'classification': False, 'age': 30, 'gender': 'f'},
+        ]
+        with self.models.patch():
+            results = analyze_images(requests)
+        self.assertEqual([set(result) - {'age', 'gender'} for result in results],
+                         [{'score'}, {'classification'}, set()])
+        self.assertEqual(len(self.models.embed_faces.call_args[0][1]), 2)
+        self.assertEqual(len(self.models.score_model.predict.call_args[0][0]), 1)
+        self.assertEqual(len(self.models.classification_model.predict.call_args[0][0]), 1)
+
+
+class AdmissionControlTestCase(SimpleTestCase):
+    """Tests that requests beyond the capacity of a worker are rejected right away."""
+
+    def post_image(self, **extra):
+        return Client().post('/', data=json.dumps({'image': encode_image('white'), 'age': 30, 'gender': 'm'}),
+                             content_type='application/json', **extra)
+
+    @override_settings(MERON_ADMISSION_SLOTS=1, MERON_ADMISSION_QUEUE_SIZE=0)
+    def test_request_is_shed_with_retry_after_when_queue_is_full(self):
+        """Test that a request that finds all slots taken and no room in the queue gets a 503 with Retry-After."""
+        with get_admission_controller().admit():
+            res = self.post_image()
+        self.assertEqual(res.status_code, 503)
+        self.assertGreaterEqual(int(res['Retry-After']), 1)
+        self.assertEqual(self.post_image().status_code, 201)
+        content = Client().get('/metrics').content.decode()
+        self.assertIn('meron_admission_requests_total{outcome="shed"}', content)
+
+    def test_queued_request_gets_the_next_free_slot(self):
+        """Test that a waiting request is admitted as soon as the request ahead of it is done."""
+        controller = AdmissionController(slots=1, queue_size=1, max_wait=5)
+        admitted = threading.Event()
+
+        def wait_for_slot():
+            with controller.admit():
+                admitted.set()
+
+        with controller.admit():
+            thread = threading.Thread(target=wait_for_slot)
+            thread.start()
+            while not controller.queued:
+                time.sleep(0.001)
+            with self.assertRaises(Overloaded):
+                with controller.admit():
+                    pass
+            self.assertFalse(admitted.is_set())
+        thread.join(5)
+        self.assertTrue(admitted.is_set())
+        self.assertEqual(controller.stats()['in_flight'], 0)
+
+    def test_request_times_out_in_the_queue(self):
+        """Test that a request that doesn't get a slot within the maximum wait is rejected."""
+        controller = AdmissionController(slots=1, queue_size=1, max_wait=0.01)
+        with controller.admit():
+            with self.assertRaises(Overloaded):
+                with controller.admit():
+                    pass
+        self.assertEqual(controller.queued, 0)
+
+    def test_stale_request_is_shed(self):
+        """Test that a request that waited too long behind nginx is rejected without analyzing it."""
+        res = self.post_image(HTTP_X_REQUEST_START=f't={time.time() - 2 * settings.MERON_ADMISSION_MAX_REQUEST_AGE}')
+        self.assertEqual(res.status_code, 503)
+        self.assertEqual(self.post_image(HTTP_X_REQUEST_START=f't={time.time()}').status_code, 201)
+
+    def test_workers_share_the_slots_of_the_host(self):
+        """Test that a slot taken by one worker isn't available to another one and is released afterwards."""
+        directory = TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        first, second = (HostAdmissionController(directory.name, slots=1, queue_size=0, max_wait=1) for _ in range(2))
+        with first.admit():
+            with self.assertRaises(Overloaded):
+                with second.admit():
+                    pass
+        with second.admit():
+            self.assertEqual(second.stats()['in_flight'], 1)
+
+    def test_queued_request_gets_the_slot_another_worker_releases(self):
+        """Test that a request waits in the queue of the host until another worker is done."""
+        directory = TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        first, second = (HostAdmissionController(directory.name, slots=1, queue_size=1, max_wait=5) for _ in range(2))
+        admitted = threading.Event()
+
+        def wait_for_slot():
+            with second.admit():
+                admitted.set()
+
+        with first.admit():
+            thread = threading.Thread(target=wait_for_slot)
+            thread.start()
+            while not second.queued:
+                time.sleep(0.001)
+            with self.assertRaises(Overloaded):
+                with first.admit():
+                    pass
+            self.assertFalse(admitted.is_set())
+        thread.join(5)
+        self.assertTrue(admitted.is_set())
+
+    @override_settings(MERON_ADMISSION_SLOTS=1, MERON_ADMISSION_QUEUE_SIZE=0)
+    def test_request_is_validated_before_it_takes_a_slot(self):
+        """Test that a request for an unknown model version is rejected without waiting for a slot."""
+        with get_admission_controller().admit():
+            res = self.post_image(HTTP_X_MODEL_VERSION='unknown')
+        self.assertEqual(res.status_code, 400)
+
+
+class BulkScoringTestCase(SimpleTestCase):
+    """Tests for scoring photos offline with the score_bulk management command."""
+
+    def setUp(self):
+        """Write photos and a manifest with a valid row, a photo without face, a missing age and a missing file."""
+        directory = TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+        for name, color in (('white.png', 'white'), ('black.png', 'black')):
+            with open(os.path.join(self.directory, name), 'wb') as image_file:
+                image_file.write(base64.b64decode(encode_image(color)))
+        self.manifest = os.path.join(self.directory, 'manifest.csv')
+        with open(self.manifest, 'w') as manifest:
+            manifest.write('image,age,gender\nwhite.png,30,m\nblack.png,30,m\nwhite.png,,f\nmissing.png,30,m\n')
+
+    def score(self, *args):
+        call_command('score_bulk', *args, stdout=StringIO())
+
+    def read_jsonl(self, path):
+        with open(path) as output:
+            return [json.loads(line) for line in output]
+
+    def test_results_match_the_api(self):
+        """Test that the rows are scored and rejected in parallel processes exactly like the API does it."""
+        output = os.path.join(self.directory, 'results.jsonl')
+        self.score(self.manifest, output, '--workers', '2', '--batch-size', '1')
+        results = self.read_jsonl(output)
+
+        with open(os.path.join(self.directory, 'white.png'), 'rb') as image_file:
+            response = Client().post('/', data={'image': image_file, 'age': 30, 'gender': 'm'}).json()
+        self.assertEqual(results[0], {'id': '1', 'image': 'white.png', **response})
+        self.assertEqual(results[1]['errors'], {'image': ['No face could be detected in the image.']})
+        self.assertEqual(results[2]['errors'], {'age': ['This field is required.']})
+        self.assertEqual(list(results[3]['errors']), ['image'])
+
+    def test_interrupted_run_is_resumed(self):
+        """Test that rows in the output are skipped and a line that was cut off is replaced."""
+        output = os.path.join(self.directory, 'results.jsonl')
+        self.score(self.manifest, output, '--workers', '0')
+        with open(output) as output_file:
+            lines = output_file.readlines()
+        with open(output, 'w') as output_file:
+            output_file.write(lines[0] + lines[1][:10])
+
+        with mock.patch('meron_api.apps.api.bulk.prepare_row', wraps=bulk.prepare_row) as prepare_row:
+            self.score(self.manifest, output, '--workers', '0')
+        self.assertEqual(len(prepare_row.call_args_list), 3)
+        with open(output) as output_file:
+            self.assertEqual(output_file.readlines(), lines)
+
+    def test_workers_prepare_a_bounded_number_of_rows_ahead(self):
+        """Test that rows are only submitted to the pool as the prepared ones are consumed, in order."""
+        consumed = []
+
+        def items():
+            for number in range(10):
+                consumed.append(number)
+                yield number
+
+        pool = ThreadPool(2)
+        self.addCleanup(pool.terminate)
+        with mock.patch('meron_api.apps.api.bulk.prepare_row', side_effect=lambda item: item * 2):
+            prepared_rows = bulk.prepare_rows(pool, items(), window=3)
+            self.assertEqual(next(prepared_rows), 0)
+            self.assertEqual(len(consumed), 4)
+            self.assertEqual(list(prepared_rows), list(range(2, 20, 2)))
+
+    def test_directory_is_scored_to_csv(self):
+        """Test that all photos of a directory are scored with the age and gender of the options."""
+        output = os.path.join(self.directory, 'results.csv')
+        self.score(self.directory, output, '--workers', '0', '--age', '30', '--gender', 'm')
+        with open(output, newline='') as output_file:
+            rows = list(csv.DictReader(output_file))
+        self.assertEqual([row['image'] for row in rows], ['black.png', 'white.png'])
+        self.assertEqual(rows[1]['score'], '2.0')
+        self.assertEqual(json.loads(rows[0]['errors']), {'image': ['No face could be detected in the image.']})
+
+
+class EmbeddingStoreTestCase(SimpleTestCase):
+    """Tests for storing the embeddings and re-running the heads over them."""
+
+    def setUp(self):
+        """Enable the store in a temporary directory."""
+        directory = TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+        store_settings = override_settings(MERON_EMBEDDING_STORE=True, MERON_EMBEDDING_STORE_DIR=self.directory)
+        store_settings.enable()
+        self.addCleanup(store_settings.disable)
+
+    def post_image(self, color, age=30, profile='default'):
+        data = {'image': encode_image(color), 'age': age, 'gender': 'm', 'profile': profile}
+        return Client().post('/', data=json.dumps(data), content_type='application/json')
+
+    def test_analyzed_uploads_are_stored_once(self):
+        """Test that every image is stored once per age, gender and profile, with the hash of its content."""
+        self.post_image('white')
+        self.post_image('white')
+        self.post_image('white', age=40)
+        self.post_image('red')
+        self.post_image('white', profile='fast')
+        index, embeddings = get_embedding_store().load()
+        self.assertEqual(embeddings.shape, (4, 48))
+        self.assertEqual(list(index['age']), [30, 40, 30, 30])
+        self.assertEqual(list(index['profile']), [b'default', b'default', b'default', b'fast'])
+        self.assertEqual(set(index['version']), {registry.version.encode()})
+        digest = hashlib.sha256(base64.b64decode(encode_image('white'))).digest()
+        self.assertEqual(index['hash'][0].tobytes(), digest)
+
+    def test_writes_of_other_processes_are_seen(self):
+        """Test that a record another process appended isn't stored a second time."""
+        embedding = np.ones((1, 4), dtype='float32')
+        first = EmbeddingStore(self.directory, 'resnet50')
+        self.assertEqual(first.add(['00' * 32], embedding, [30], ['m'], ['default'], 'v1'), 1)
+        store = EmbeddingStore(self.directory, 'resnet50')
+        embeddings = np.vstack([embedding, embedding])
+        self.assertEqual(store.add(['00' * 32, 'ff' * 32], embeddings, [30, 30], ['m', 'm'], ['default'] * 2, 'v1'), 1)
+        self.assertEqual(store.add(['00' * 32], embedding, [30], ['m'], ['default'], 'v2'), 1)
+        with self.assertRaises(ValueError):
+            store.add(['11' * 32], np.ones((1, 8)), [30], ['m'], ['default'], 'v1')
+        self.assertEqual(store.load()[0]['hash'][0].tobytes(), bytes(32))
+
+    def test_only_recent_keys_are_kept_in_memory(self):
+        """Test that the keys in memory are bounded, an image seen before the last ones is stored again."""
+        store = EmbeddingStore(self.directory, 'resnet50', max_keys=2)
+        embedding = np.ones((1, 4), dtype='float32')
+        for content_hash in ('00' * 32, '11' * 32, '22' * 32, '00' * 32):
+            store.add([content_hash], embedding, [30], ['m'], ['default'], 'v1')
+        self.assertEqual(len(store._keys), 2)
+        self.assertEqual(len(store), 4)
+        self.assertEqual(len(EmbeddingStore(self.directory, 'resnet50', max_keys=2)._keys), 0)
+
+    def test_stores_of_an_older_format_are_rejected(self):
+        """Test that a store without the model version and profile in its index isn't misread."""
+        with open(os.path.join(self.directory, 'meta.json'), 'w') as meta_file:
+            json.dump({'dim': 4, 'model': 'resnet50'}, meta_file)
+        with self.assertRaises(CommandError):
+            call_command('rescore_embeddings', os.path.join(self.directory, 'rescored.csv'), stdout=StringIO())
+
+    def test_rescoring_matches_the_api(self):
+        """Test that running the heads over the stored embeddings gives the results of the API."""
+        response = self.post_image('white').json()
+        output = os.path.join(self.directory, 'rescored.csv')
+        call_command('rescore_embeddings', output, stdout=StringIO())
+        with open(output, newline='') as output_file:
+            rows = list(csv.DictReader(output_file))
+        self.assertEqual(len(rows), 1)
+        self.assertEqual(float(rows[0]['score']), response['score'])
+        self.assertEqual(rows[0]['classification'], response['classification'])
+        self.assertEqual(rows[0]['model_version'], registry.version)
+
+    def test_rescoring_uses_the_models_of_the_versions_dir(self):
+        """Test that the models are loaded from the directory of the version, like the registry does."""
+        self.post_image('white')
+        os.mkdir(os.path.join(self.directory, 'v3'))
+        output = os.path.join(self.directory, 'rescored.csv')
+        with override_settings(MERON_MODEL_VERSIONS_DIR=self.directory), \
+                mock.patch('meron_api.apps.api.management.commands.rescore_embeddings.build_heads',
+                           side_effect=build_heads) as heads:
+            call_command('rescore_embeddings', output, stdout=StringIO())
+            with self.assertRaises(CommandError):
+                call_command('rescore_embeddings', output, '--model-version', 'v1', stdout=StringIO())
+        heads.assert_called_once_with(os.path.join(self.directory, 'v3'))
+
+    def test_bulk_scoring_stores_embeddings(self):
+        """Test that the faces embedded by score_bulk are stored as well."""
+        with open(os.path.join(self.directory, 'white.png'), 'wb') as image_file:
+            image_file.write(base64.b64decode(encode_image('white')))
+        call_command('score_bulk', self.directory, os.path.join(self.directory, 'results.csv'), '--workers', '0',
+                     '--age', '30', '--gender', 'f', stdout=StringIO())
+        self.assertEqual(len(get_embedding_store()), 1)
+
+
+class ModelVersionTestCase(SimpleTestCase):
+    """Tests for versioned models, reloading them and pinning a version per request."""
+
+    def setUp(self):
+        """Create a versions directory with two versions and one that is still being copied."""
+        directory = TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+        for version in ('v2', 'v9', '.v11'):
+            os.mkdir(os.path.join(self.directory, version))
+        version_settings = override_settings(MERON_MODEL_VERSIONS_DIR=self.directory, MERON_MODEL_RELOAD_INTERVAL=0)
+        version_settings.enable()
+        self.addCleanup(version_settings.disable)
+        self.registry = ModelRegistry().load()
+
+    def test_highest_version_is_loaded(self):
+        """Test that versions are ordered by their numbers and hidden directories are ignored."""
+        os.mkdir(os.path.join(self.directory, 'v10'))
+        self.assertEqual(self.registry.available_versions(), ['v2', 'v9', 'v10'])
+        self.assertEqual(self.registry.version, 'v9')
+
+    def test_new_version_is_swapped_in_after_warm_up(self):
+        """Test that a new version replaces the current one and the previous one is kept for pinned requests."""
+        previous = self.registry.get()
+        self.assertFalse(self.registry.reload())
+        os.rename(os.path.join(self.directory, '.v11'), os.path.join(self.directory, 'v11'))
+        with mock.patch.object(ModelSet, 'warm_up', autospec=True, side_effect=lambda models: models) as warm_up:
+            self.assertTrue(self.registry.reload())
+        warm_up.assert_called_once()
+        self.assertEqual(self.registry.get().version, 'v11')
+        self.assertIs(self.registry.get('v9'), previous)
+
+    def test_failing_version_is_not_swapped_in(self):
+        """Test that a version that fails the warm-up is not used and not tried again."""
+        os.mkdir(os.path.join(self.directory, 'v10'))
+        with mock.patch.object(ModelSet, 'warm_up', side_effect=ValueError('NaN score')) as warm_up:
+            self.assertFalse(self.registry.reload())
+            self.assertFalse(self.registry.reload())
+        warm_up.assert_called_once()
+        self.assertEqual(self.registry.version, 'v9')
+        health = self.registry.health()
+        self.assertEqual(health['failed_versions'], {'v10': 'NaN score'})
+        # a copy, the watcher may add failed versions while the health check is serialized
+        self.assertIsNot(health['failed_versions'], self.registry.failed_versions)
+
+    @override_settings(MERON_MODEL_PINNABLE_VERSIONS=['v2'])
+    def test_requests_can_pin_a_version(self):
+        """Test that the response names the version that served it and that requests can pin another one."""
+        data = json.dumps({'image': encode_image('white'), 'age': 30, 'gender': 'm'})
+        with mock.patch('meron_api.apps.api.views.registry', self.registry):
+            current = Client().post('/', data=data, content_type='application/json')
+            pinned = Client().post('/?model_version=v2', data=data, content_type='application/json')
+            header = Client().post('/batch/', data=f'[{data}]', content_type='application/json',
+                                   HTTP_X_MODEL_VERSION='v2')
+            unknown = Client().post('/', data=data, content_type='application/json', HTTP_X_MODEL_VERSION='v1')
+        self.assertEqual(current['X-Model-Version'], 'v9')
+        self.assertEqual(pinned['X-Model-Version'], 'v2')
+        self.assertEqual(header['X-Model-Version'], 'v2')
+        self.assertEqual(unknown.status_code, 400)
+        self.assertIn('model_version', unknown.json())
+
+    def test_only_loaded_or_pinnable_versions_can_be_pinned(self):
+        """Test that a request can't make the worker load a version that isn't pinnable."""
+        with mock.patch.object(ModelRegistry, '_load_models') as load_models:
+            with self.assertRaises(UnknownModelVersion):
+                self.registry.get('v2')
+        load_models.assert_not_called()
+
+    @override_settings(MERON_MODEL_PINNABLE_VERSIONS=['v2'])
+    def test_pinned_version_is_loaded_once_outside_the_lock(self):
+        """Test that concurrent requests for a version wait for one load, while other requests are served."""
+        loading, release = threading.Event(), threading.Event()
+        load_models = self.registry._load_models
+        results = []
+
+        def slow_load(version):
+            loading.set()
+            release.wait(5)
+            return load_models(version)
+
+        with mock.patch.object(self.registry, '_load_models', side_effect=slow_load) as load:
+            threads = [threading.Thread(target=lambda: results.append(self.registry.get('v2'))) for _ in range(2)]
+            for thread in threads:
+                thread.start()
+            self.assertTrue(loading.wait(5))
+            self.assertEqual(self.registry.get().version, 'v9')
+            self.assertIn('v2', self.registry._loading)
+            release.set()
+            for thread in threads:
+                thread.join(5)
+        load.assert_called_once_with('v2')
+        self.assertEqual([models.version for models in results], ['v2', 'v2'])
+        self.assertIs(results[0], results[1])
+
+
+class AllFacesTestCase(SimpleTestCase):
+    """Tests for requests that analyze every face in the image."""
+
+    def setUp(self):
+        """Use fake models that find a face in each half of the image."""
+        self.client = Client()
+        self.models = FakeModels()
+        self.models.detector.side_effect = lambda pixels: [
+            FaceRect(8, 0, 16, 8), FaceRect(0, 0, 8, 8)
+        ]
+        logging.disable(logging.CRITICAL)
+
+    def post(self, data, path='/'):
+        with self.models.patch():
+            return self.client.post(path, data=json.dumps(data), content_type='application/json')
+
+    def test_faces_are_returned_from_left_to_right_with_boxes(self):
+        """Test that every face gets its own result and box and that all faces are embedded together."""
+        res = self.post({'image': encode_image('white', size=(16, 8)), 'age': [30, 12], 'gender': ['m', 'f'],
+                         'all_faces': True})
+        self.assertEqual(res.status_code, 201)
+        faces = res.json()['faces']
+        self.assertEqual([face['box'] for face in faces], [
+            {'left': 0, 'top': 0, 'right': 8, 'bottom': 8},
+            {'left': 8, 'top': 0, 'right': 16, 'bottom': 8},
+        ])
+        self.assertEqual([(face['age'], face['gender']) for face in faces], [(30, 'm'), (12, 'f')])
+        self.assertEqual({face['classification'] for face in faces}, {'normal'})
+        self.models.embed_faces.assert_called_once()
+        self.assertEqual(len(self.models.embed_faces.call_args[0][1]), 2)
+
+    def test_single_values_apply_to_all_faces(self):
+        """Test that a single age and gender are used for every face and the query param enables the mode."""
+        with self.models.patch():
+            res = self.client.post('/?all_faces', data={'image': BytesIO(base64.b64decode(encode_image('white'))),
+                                                        'age': 30, 'gender': 'f'})
+        self.assertEqual(res.status_code, 201)
+        self.assertEqual([(face['age'], face['gender']) for face in res.json()['faces']], [(30, 'f'), (30, 'f')])
+
+    def test_list_must_match_the_faces(self):
+        """Test that a list of ages with a value for each face is required."""
+        res = self.post({'image': encode_image('white'), 'age': [30], 'gender': 'f', 'all_faces': True})
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(res.json(), {'age': ['Got 1 values for the 2 faces detected in the image.']})
+
+    def test_lists_require_all_faces(self):
+        """Test that lists are rejected without all_faces and single face requests return the largest face."""
+        res = self.post({'image': encode_image('white'), 'age': [30, 12], 'gender': 'f'})
+        self.assertEqual(res.status_code, 400)
+        self.assertIn('age', res.json())
+        res = self.post([{'image': encode_image('white'), 'age': 30, 'gender': 'f'}], path='/batch/')
+        self.assertNotIn('faces', res.json()[0])
+        self.assertEqual(res.json()[0]['age'], 30)
+
+
+class CapabilitiesTestCase(SimpleTestCase):
+    """Tests that the API advertises its upload limits and enforces them."""
+
+    def setUp(self):
+        logging.disable(logging.CRITICAL)
+
+    @override_settings(MERON_MAX_IMAGE_SIDE=64, MERON_CLIENT_IMAGE_SIDE=1024)
+    def test_capabilities_are_advertised(self):
+        """Test that the recommended size never exceeds the accepted one."""
+        res = Client().get('/capabilities/')
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.json()['max_image_side'], 64)
+        self.assertEqual(res.json()['image_side'], 64)
+
+    @override_settings(MERON_MAX_IMAGE_SIDE=64)
+    def test_larger_images_are_rejected_before_decoding(self):
+        """Test that an image with more pixels per side than advertised is rejected without decoding it."""
+        with mock.patch('meron_api.apps.api.preprocessing.Image.Image.thumbnail') as thumbnail:
+            res = Client().post('/', data=json.dumps({'image': encode_image('white', size=(80, 40)), 'age': 30,
+                                                      'gender': 'm'}), content_type='application/json')
+        self.assertEqual(res.status_code, 400)
+        self.assertIn('80x40 pixels', res.json()['image'][0])
+        thumbnail.assert_not_called()
+
+
+class RawImageUploadTestCase(SimpleTestCase):
+    """Tests for requests whose body is the image."""
+
+    def setUp(self):
+        """Use fake models and store a white PNG image."""
+        self.client = Client()
+        self.models = FakeModels()
+        self.image = base64.b64decode(encode_image('white'))
+        logging.disable(logging.CRITICAL)
+
+    def post(self, path, content_type='image/png', **extra):
+        with self.models.patch():
+            return self.client.post(path, data=self.image, content_type=content_type, **extra)
+
+    def test_fields_from_query_string(self):
+        """Test that the fields are read from the query string and explicit false values are respected."""
+        res = self.post('/?age=30&gender=m&score=false')
+        self.assertEqual(res.status_code, 201)
+        self.assertEqual(res.json(), {'age': 30, 'gender': 'm', 'classification': 'normal'})
+
+    def test_fields_from_headers(self):
+        """Test that the fields can be passed as headers, with lists as comma separated values."""
+        res = self.post('/?all_faces', HTTP_X_AGE='30, 12', HTTP_X_GENDER='f')
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(res.json(), {'age': ['Got 2 values for the 1 faces detected in the image.']})
+        res = self.post('/', HTTP_X_AGE='30', HTTP_X_GENDER='f', HTTP_X_CLASSIFICATION='false')
+        self.assertEqual(res.status_code, 201)
+        self.assertEqual(set(res.json()), {'age', 'gender', 'score'})
+
+    def test_missing_fields_and_other_formats_are_rejected(self):
+        """Test that the fields are validated like other requests and only JPEG and PNG are accepted."""
+        res = self.post('/?age=30')
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(res.json(), {'gender': ['This field is required.']})
+        res = self.post('/?age=30&gender=m', content_type='image/gif')
+        self.assertEqual(res.status_code, 415)
+
+    @override_settings(MERON_MAX_UPLOAD_SIZE=16)
+    def test_large_body_is_rejected(self):
+        """Test that a body larger than MERON_MAX_UPLOAD_SIZE gets status 413."""
+        res = self.post('/?age=30&gender=m')
+        self.assertEqual(res.status_code, 413)
+
+
+class ASGIApplicationTestCase(SimpleTestCase):
+    """Tests for the ASGI application that receives the body before it runs Django in a thread."""
+
+    def setUp(self):
+        """Use fake models and wrap the Django application."""
+        self.models = FakeModels()
+        self.application = BufferedWSGIApplication(get_wsgi_application(), threads=2, max_body_size=1024 * 1024)
+        self.addCleanup(self.application.executor.shutdown)
+        logging.disable(logging.CRITICAL)
+
+    def request(self, body, chunk_size=100, path='/', query_string=b'age=30&gender=m',
+                content_type=b'image/png', headers=(), complete=True):
+        """Send the body in chunks through the ASGI interface and return the status, headers and body.
+
+        Without `complete` the client disconnects before the last chunk.
+        """
+        scope = {
+            'type': 'http', 'method': 'POST', 'path': path, 'query_string': query_string, 'http_version': '1.1',
+            'headers': [(b'content-type', content_type), *headers], 'server': ('testserver', 80),
+        }
+        chunks = [body[start:start + chunk_size] for start in range(0, len(body), chunk_size)] or [b'']
+        messages = [
+            {'type': 'http.request', 'body': chunk, 'more_body': index < len(chunks) - 1}
+            for index, chunk in enumerate(chunks)
+        ]
+        if not complete:
+            messages[-1]['more_body'] = True
+        sent = []
+
+        async def receive():
+            # the chunks arrive one by one, like from a slow client
+            await asyncio.sleep(0)
+            return messages.pop(0) if messages else {'type': 'http.disconnect'}
+
+        async def send(message):
+            sent.append(message)
+
+        loop = asyncio.new_event_loop()
+        try:
+            with self.models.patch():
+                loop.run_until_complete(self.application(scope, receive, send))
+        finally:
+            loop.close()
+        if not sent:
+            return None
+        return sent[0]['status'], dict(sent[0]['headers']), b''.join(message.get('body', b'') for message in sent[1:])
+
+    def test_body_received_in_chunks_is_analyzed(self):
+        """Test that Django sees the whole body once all chunks arrived."""
+        status, headers, body = self.request(base64.b64decode(encode_image('white', size=(64, 64))))
+        self.assertEqual(status, 201)
+        self.assertEqual(headers[b'X-Model-Version'], b'fake')
+        self.assertEqual(json.loads(body)['classification'], 'normal')
+
+    def test_large_body_is_rejected_while_it_is_received(self):
+        """Test that a body over the limit gets status 413 without running Django."""
+        self.application.max_body_size = 150
+        with mock.patch('meron_api.apps.api.asgi.run_wsgi') as run_wsgi:
+            status, _, _ = self.request(b'x' * 300)
+            self.assertEqual(status, 413)
+            status, _, _ = self.request(b'x', headers=[(b'content-length', b'300')])
+            self.assertEqual(status, 413)
+        run_wsgi.assert_not_called()
+
+    def test_disconnected_client_is_not_analyzed(self):
+        """Test that a request whose client went away before the body was complete isn't run."""
+        with mock.patch('meron_api.apps.api.asgi.run_wsgi') as run_wsgi:
+            self.assertIsNone(self.request(base64.b64decode(encode_image('white')), complete=False))
+        run_wsgi.assert_not_called()
+
+
+class DetectorProfileTestCase(SimpleTestCase):
+    """Tests for the face detector backends and the profiles that select them."""
+
+    def setUp(self):
+        """Use fake models with separate detectors for the profiles."""
+        self.models = FakeModels()
+        logging.disable(logging.CRITICAL)
+
+    def post(self, path='/', **data):
+        data = {'image': encode_image('white'), 'age': 30, 'gender': 'm', **data}
+        with self.models.patch():
+            return Client().post(path, data=json.dumps(data), content_type='application/json')
+
+    def test_requests_select_the_fast_profile(self):
+        """Test that the fast profile is selected by the body or the query string and the default otherwise."""
+        self.assertEqual(self.post().status_code, 201)
+        self.assertEqual(self.post(profile='fast').status_code, 201)
+        self.assertEqual(self.post('/?fast').status_code, 201)
+        self.assertEqual(self.models.detector.call_count, 1)
+        self.assertEqual(self.models.fast_detector.call_count, 2)
+        self.assertEqual(self.post(profile='fastest').status_code, 400)
+
+    @override_settings(MERON_STUB_MODELS=False, MERON_DETECTOR='dlib-hog', MERON_FAST_DETECTOR='dlib-hog',
+                       MERON_DETECTOR_UPSAMPLE=1, MERON_DETECTOR_MIN_FACE_SIZE=0, MERON_FAST_DETECTOR_MIN_FACE_SIZE=0)
+    def test_profiles_configured_alike_share_the_detector(self):
+        """Test that the fast profile gets its own detector only if it is configured differently."""
+        with mock.patch('meron_api.apps.api.detectors.create_detector', side_effect=lambda *args: object()) as create:
+            with self.settings(MERON_FAST_DETECTOR_UPSAMPLE=1):
+                detector, fast_detector = build_detectors()
+            self.assertIs(detector, fast_detector)
+            with self.settings(MERON_FAST_DETECTOR_UPSAMPLE=0):
+                detector, fast_detector = build_detectors()
+            self.assertIsNot(detector, fast_detector)
+        self.assertEqual(create.call_args_list[-1], mock.call('dlib-hog', 0, 0))
+
+    def test_small_faces_are_ignored(self):
+        """Test that faces whose shorter side is below the minimum face size are dropped."""
+        rects = [FaceRect(0, 0, 100, 40), FaceRect(0, 0, 50, 60)]
+        self.assertEqual(large_enough(rects, 50), [rects[1]])
+        self.assertEqual(large_enough(rects, 0), rects)
+
+    def test_missing_model_files_are_reported(self):
+        """Test that a detector whose model files aren't there isn't built and the error says where to get them."""
+        with self.settings(MERON_OPENCV_DNN_CONFIG='/nonexistent/deploy.prototxt'):
+            with self.assertRaisesRegex(ImproperlyConfigured, 'MERON_OPENCV_DNN_CONFIG.*github'):
+                create_detector('opencv-dnn')
+        with self.settings(MERON_DLIB_CNN_MODEL='/nonexistent/mmod_human_face_detector.dat'):
+            with self.assertRaisesRegex(ImproperlyConfigured, 'dlib.net'):
+                create_detector('dlib-cnn')
+
+    def test_benchmark_reports_latency_and_detection_rate(self):
+        """Test that the benchmark counts the photos with a face per backend."""
+        images = [np.full((32, 32, 3), 255, dtype=np.uint8), np.zeros((32, 32, 3), dtype=np.uint8)]
+        results = benchmark_detectors(images, {'stub': StubDetector()}, repeat=2)
+        self.assertEqual(results['stub']['detection_rate'], 0.5)
+        self.assertEqual(results['stub']['faces'], 1)
+        with TemporaryDirectory() as directory:
+            for name, color in (('a.png', 'white'), ('b.png', 'black')):
+                Image.new('RGB', (32, 32), color).save(os.path.join(directory, name))
+            out = StringIO()
+            with mock.patch('meron_api.apps.api.management.commands.benchmark_detectors.create_detector',
+                            side_effect=lambda *args: StubDetector()):
+                call_command('benchmark_detectors', directory, '--backends', 'dlib-hog,opencv-dnn', '--json',
+                             stdout=out)
+        report = json.loads(out.getvalue())
+        self.assertEqual(set(report), {'dlib-hog', 'opencv-dnn'})
+        self.assertEqual(report['opencv-dnn']['detection_rate'], 0.5)
+
+
+class MemoryMappedModelsTestCase(SimpleTestCase):
+    """Tests for the model files that the workers memory-map."""
+
+    def setUp(self):
+        """Create a directory for the converted models."""
+        directory = TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+
+    def test_weights_are_memory_mapped(self):
+        """Test that the weights are loaded in their order as read-only memory maps of the right architecture."""
+        arrays = [np.arange(6, dtype='float32').reshape(2, 3), np.ones(4, dtype='float32')]
+        save_weights(arrays, self.directory, 'senet50')
+        loaded = load_weights(self.directory, 'senet50')
+        self.assertEqual(len(loaded), 2)
+        for array, mapped in zip(arrays, loaded):
+            self.assertIsInstance(mapped, np.memmap)
+            self.assertFalse(mapped.flags.writeable)
+            np.testing.assert_array_equal(mapped, array)
+        with self.assertRaises(ValueError):
+            load_weights(self.directory, 'resnet50')
+
+    def test_heads_are_loaded_from_the_mmap_directory(self):
+        """Test that the score and classification models are loaded with their arrays memory-mapped."""
+        from sklearn.linear_model import LinearRegression, LogisticRegression
+
+        features = np.random.RandomState(0).rand(20, 4)
+        score_model = LinearRegression().fit(features, features.sum(axis=1))
+        classification_model = LogisticRegression().fit(features, features[:, 0] > 0.5)
+        save_head(score_model, os.path.join(self.directory, settings.MERON_SCORE_MODEL))
+        save_head(classification_model, os.path.join(self.directory, settings.MERON_CLASSIFICATION_MODEL))
+        self.assertIsInstance(load_head(os.path.join(self.directory, settings.MERON_SCORE_MODEL)).coef_, np.memmap)
+
+        with override_settings(MERON_STUB_MODELS=False, MERON_INFERENCE_RUNTIME='keras',
+                               MERON_MMAP_DIR=self.directory):
+            loaded_score, loaded_classification = build_heads()
+        np.testing.assert_allclose(loaded_score.predict(features), score_model.predict(features))
+        np.testing.assert_array_equal(loaded_classification.predict(features), classification_model.predict(features))
+
+    def convert_version(self, parity):
+        """Convert the models of version v3 with fake models, the comparison returns `parity`."""
+        self.version_dir = os.path.join(self.directory, 'versions', 'v3')
+        os.makedirs(self.version_dir)
+        for file_name in (settings.MERON_SCORE_MODEL, settings.MERON_CLASSIFICATION_MODEL):
+            with open(os.path.join(self.version_dir, file_name), 'w') as head_file:
+                head_file.write('original')
+        self.output_dir = os.path.join(self.directory, 'mmap')
+        models = SimpleNamespace(
+            version='v3',
+            embedder=SimpleNamespace(network=SimpleNamespace(get_weights=lambda: [np.ones(2, dtype='float32')])),
+            score_model={'coef': np.ones(3)},
+            classification_model={'coef': np.zeros(3)},
+        )
+        command = 'meron_api.apps.api.management.commands.convert_models_mmap'
+        with ExitStack() as stack:
+            stack.enter_context(override_settings(MERON_MODEL_VERSIONS_DIR=os.path.dirname(self.version_dir)))
+            model_registry = stack.enter_context(mock.patch(f'{command}.ModelRegistry'))
+            model_registry.return_value.load.return_value = models
+            stack.enter_context(mock.patch(f'{command}.VGGFaceEmbedder'))
+            stack.enter_context(mock.patch(f'{command}.parity_faces'))
+            stack.enter_context(mock.patch(f'{command}.compare_models', return_value=parity))
+            call_command('convert_models_mmap', '--output-dir', self.output_dir, stdout=StringIO())
+
+    def read_heads(self):
+        return sorted(os.listdir(self.version_dir))
+
+    def test_conversion_uses_the_directory_of_the_current_version(self):
+        """Test that the heads of a version are converted where the registry loads them from."""
+        self.convert_version({'faces': 8, 'max_score_difference': 0.0, 'classification_agreement': 1.0})
+        self.assertEqual(self.read_heads(), sorted([settings.MERON_CLASSIFICATION_MODEL, settings.MERON_SCORE_MODEL]))
+        self.assertEqual(os.listdir(self.output_dir), ['embedder'])
+        np.testing.assert_array_equal(load_head(os.path.join(self.version_dir, settings.MERON_SCORE_MODEL))['coef'],
+                                      np.ones(3))
+
+    def test_failed_conversion_leaves_the_models_unchanged(self):
+        """Test that converted models that diverge from the original ones replace nothing."""
+        with self.assertRaises(CommandError):
+            self.convert_version({'faces': 8, 'max_score_difference': 0.5, 'classification_agreement': 0.5})
+        self.assertEqual(self.read_heads(), sorted([settings.MERON_CLASSIFICATION_MODEL, settings.MERON_SCORE_MODEL]))
+        for file_name in self.read_heads():
+            with open(os.path.join(self.version_dir, file_name)) as head_file:
+                self.assertEqual(head_file.read(), 'original')
+        self.assertEqual(os.listdir(self.output_dir), [])
+
+
+class UpstreamParityTestCase(SimpleTestCase):
+    """Tests for comparing the results of the API with those of the upstream pipeline."""
+
+    def setUp(self):
+        """Write photos to compare on, a black one has no face."""
+        self.models = FakeModels()
+        directory = TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.paths = []
+        for name, color in (('a.png', 'white'), ('b.png', 'gray'), ('c.png', 'black')):
+            self.paths.append(os.path.join(directory.name, name))
+            Image.new('RGB', (16, 16), color).save(self.paths[-1])
+        self.directory = directory.name
+
+    def upstream(self, offset=0.0):
+        """Return a stand-in for the upstream analyze_image that runs the fake models, shifting the scores."""
+        def analyze(path, score, classification, age, gender):
+            with open(path, 'rb') as image_file:
+                result = analyze_image(image_file, age=age, gender=gender, models=self.models)
+            return dict(result, score=result['score'] + offset)
+        return analyze
+
+    def test_identical_pipelines_agree(self):
+        """Test that photos without a face are skipped and the others compared."""
+        with self.models.patch():
+            parity = compare_with_upstream(self.paths, self.models, 24, 'f', upstream=self.upstream())
+        self.assertEqual(parity, {'images': 2, 'max_score_difference': 0.0, 'classification_agreement': 1.0,
+                                  'mismatches': []})
+
+    @override_settings(MERON_DETECTION_MAX_SIDE=32)
+    def test_photos_are_analyzed_like_uploads(self):
+        """Test that the faces are detected at the reduced resolution of uploads."""
+        path = os.path.join(self.directory, 'large.png')
+        Image.new('RGB', (128, 128), 'white').save(path)
+        with self.models.patch():
+            parity = compare_with_upstream([path], self.models, 24, 'f', upstream=self.upstream())
+        self.assertEqual(parity['images'], 1)
+        # the API's pipeline runs first, the stand-in for the upstream one decodes the file at full resolution
+        self.assertEqual(self.models.detector.call_args_list[0][0][0].shape, (32, 32, 3))
+
+    def test_command_fails_if_the_results_diverge(self):
+        """Test that the command exits with an error if the scores differ by more than the tolerance."""
+        with self.models.patch(), override_settings(MERON_PARITY_IMAGES_DIR=self.directory):
+            with mock.patch('meron_api.apps.api.upstream.upstream_analyze_image', return_value=self.upstream()):
+                call_command('check_upstream_parity', stdout=StringIO())
+            with mock.patch('meron_api.apps.api.upstream.upstream_analyze_image',
+                            return_value=self.upstream(offset=0.01)):
+                with self.assertRaises(CommandError):
+                    call_command('check_upstream_parity', stdout=StringIO())
+
+    def test_unknown_gender_is_not_guessed(self):
+        """Test that the heads don't run for a face without a known gender."""
+        with self.models.patch():
+            with self.assertRaises(UnknownGender):
+                analyze_image(self.paths[0], age=24, gender='')
+            self.assertEqual(analyze_image(self.paths[0], score=False, classification=False, age=24, gender=''),
+                             {'age': 24, 'gender': ''})
+
+    @skipUnless(installed('meron_api.apps.meron_production', 'keras_vggface', 'dlib'),
+                'meron_production submodule, keras_vggface or dlib missing')
+    @override_settings(MERON_STUB_MODELS=False, MERON_INFERENCE_RUNTIME='keras')
+    def test_api_agrees_with_upstream(self):
+        """Test the API against the upstream pipeline on the photos in MERON_PARITY_IMAGES_DIR."""
+        if not settings.MERON_PARITY_IMAGES_DIR:
+            raise SkipTest('MERON_PARITY_IMAGES_DIR is not set')
+        with mock.patch('meron_api.apps.api.management.commands.check_upstream_parity.registry', ModelRegistry()):
+            call_command('check_upstream_parity', stdout=StringIO())
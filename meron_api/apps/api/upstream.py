@@ -0,0 +1,69 @@
+"""Compare the results of the API with those of the upstream pipeline in the meron_production submodule.
+
+The API runs the steps of the upstream `analyze_image` (detect, crop, embed, append age and gender, run the heads) in
+inference.py, with the models owned by the registry, because the upstream function loads its own models on every call.
+The feature layout, the face crop, the VGGFace architecture and the model files must therefore stay those the heads
+were trained with. `python manage.py check_upstream_parity` runs both pipelines on photos of faces and fails if their
+results differ, so a divergence is noticed before it is deployed. The photos go through the API the way uploads do:
+validated by `FaceDetectionInputSerializer`, decoded at reduced resolution for the detection and the face cropped
+from the full resolution image.
+"""
+import os
+from importlib import import_module
+
+from django.core.files import File
+
+from .inference import AnalysisError, analyze_image
+from .serializers import FaceDetectionInputSerializer
+
+UPSTREAM_MODULE = "meron_api.apps.meron_production.meron.meron_model"
+
+
+def upstream_analyze_image():
+    """Return the `analyze_image` function of the meron_production submodule, raises ImportError without it."""
+    return import_module(UPSTREAM_MODULE).analyze_image
+
+
+def analyze_as_upload(path, models, age, gender):
+    """Analyze a photo like a request to the root endpoint with it, return None if the request would fail."""
+    with open(path, "rb") as image_file:
+        serializer = FaceDetectionInputSerializer(
+            data={"image": File(image_file, name=os.path.basename(path)), "age": age, "gender": gender},
+            context={"models": models},
+        )
+        if not serializer.is_valid():
+            return None
+        try:
+            # analyzed while the file is open, small faces are cropped from it at full resolution
+            return analyze_image(**serializer.get_analysis_request(serializer.validated_data))
+        except AnalysisError:
+            return None
+
+
+def compare_with_upstream(image_paths, models, age, gender, upstream=None):
+    """Analyze photos with the API and with the upstream pipeline and return how well the results agree.
+
+    `upstream` defaults to the function of the submodule. Photos only one of the pipelines finds a face in are listed
+    in `mismatches`, photos neither finds a face in are skipped.
+    """
+    upstream = upstream or upstream_analyze_image()
+    score_differences, agreements, mismatches = [], [], []
+    for path in image_paths:
+        result = analyze_as_upload(path, models, age, gender)
+        try:
+            expected = upstream(path, True, True, age, gender)
+        except ValueError:
+            expected = None
+        if result is None and expected is None:
+            continue
+        if result is None or expected is None:
+            mismatches.append(path)
+            continue
+        score_differences.append(abs(result["score"] - float(expected["score"])))
+        agreements.append(result["classification"] == str(expected["classification"]))
+    return {
+        "images": len(score_differences),
+        "max_score_difference": max(score_differences, default=0.0),
+        "classification_agreement": sum(agreements) / len(agreements) if agreements else 1.0,
+        "mismatches": mismatches,
+    }
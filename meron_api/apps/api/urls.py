@@ -1,8 +1,22 @@
 from rest_framework.urls import url
 
-from meron_api.apps.api.views import FaceDetectionResultView
+from meron_api.apps.api.views import (
+    CapabilitiesView,
+    FaceDetectionBatchView,
+    FaceDetectionResultView,
+    HealthView,
+    JobListView,
+    JobView,
+    MetricsView,
+)
 
 
 app_name = "api"
 urlpatterns = [url(r'^$', FaceDetectionResultView.as_view(), name='api_root'),
+               url(r'^batch/$', FaceDetectionBatchView.as_view(), name='batch'),
+               url(r'^jobs/$', JobListView.as_view(), name='jobs'),
+               url(r'^jobs/(?P<job_id>[0-9a-f]{32})/$', JobView.as_view(), name='job'),
+               url(r'^capabilities/$', CapabilitiesView.as_view(), name='capabilities'),
+               url(r'^health/$', HealthView.as_view(), name='health'),
+               url(r'^metrics/?$', MetricsView.as_view(), name='metrics'),
                ]
@@ -1,15 +1,46 @@
 """Accept request with image file and return response of face detection function."""
 import markdown
+from django.conf import settings
 
 from meron_api.apps.api.serializers import (
     FaceDetectionInputSerializer,
     FaceDetectionOutputSerializer,
+    analyze_batch,
 )
+from rest_framework.exceptions import NotFound, ValidationError
 from rest_framework.renderers import JSONRenderer, StaticHTMLRenderer
 from rest_framework.response import Response
-from rest_framework.status import HTTP_201_CREATED, HTTP_400_BAD_REQUEST
+from rest_framework.reverse import reverse
+from rest_framework.status import (
+    HTTP_200_OK,
+    HTTP_201_CREATED,
+    HTTP_202_ACCEPTED,
+    HTTP_400_BAD_REQUEST,
+    HTTP_503_SERVICE_UNAVAILABLE,
+)
 from rest_framework.views import APIView
 
+from .admission import admit, get_admission_controller, reject_stale
+from .batching import get_batcher
+from .jobs import get_job_store, submit_job
+from .metrics import render_metrics
+from .registry import UnknownModelVersion, registry
+from .renderers import PrometheusTextRenderer
+
+
+def requested_version(request):
+    """Return the version the `model_version` query parameter or the `X-Model-Version` header pins, or None."""
+    return request.query_params.get("model_version") or request.META.get("HTTP_X_MODEL_VERSION") or None
+
+
+def get_models(request):
+    """Return the models of the version the request pins, by default those of the current version."""
+    version = requested_version(request)
+    try:
+        return registry.get(version)
+    except UnknownModelVersion as exc:
+        raise ValidationError({"model_version": [str(exc)]})
+
 
 class FaceDetectionResultView(APIView):
     """Accept POST requests with image, call face detection function and return rendered results."""
@@ -27,16 +58,27 @@ class FaceDetectionResultView(APIView):
         return [renderer() for renderer in self.renderer_classes]
 
     def post(self, request):
-        """Accept POST request with image either as multipart/form-data or base64 encoded file in JSON."""
-        # passing the request to the context so we can access the query_params
-        input_serializer = FaceDetectionInputSerializer(
-            data=request.data, context={"request": request}
-        )
-        if input_serializer.is_valid():
-            result = input_serializer.save()
+        """Accept POST request with image either as multipart/form-data or base64 encoded file in JSON.
+
+        Returns status 503 with a Retry-After header if the worker is too busy to analyze the image in time. The
+        `X-Model-Version` response header names the version of the models that analyzed the image.
+        """
+        reject_stale(request)
+        models = get_models(request)
+        # the body is read before the request takes a slot, so slow uploads don't hold one
+        data = request.data
+        with admit():
+            # passing the request to the context so we can access the query_params
+            input_serializer = FaceDetectionInputSerializer(data=data, context={"request": request, "models": models})
+            if input_serializer.is_valid():
+                result = input_serializer.save()
 
-            output_serializer = FaceDetectionOutputSerializer(result)
-            return Response(output_serializer.data, status=HTTP_201_CREATED)
+                output_serializer = FaceDetectionOutputSerializer(result)
+                response = Response(output_serializer.data, status=HTTP_201_CREATED)
+                response["X-Model-Version"] = models.version
+                if hasattr(input_serializer, "cache_hit"):
+                    response["X-Cache"] = "HIT" if input_serializer.cache_hit else "MISS"
+                return response
 
         return Response(input_serializer.errors, status=HTTP_400_BAD_REQUEST)
 
@@ -70,3 +112,117 @@ class FaceDetectionResultView(APIView):
             ", 'm' or 'f')"
         )
         return Response({"message": msg})
+
+
+class FaceDetectionBatchView(APIView):
+    """Accept a list of images with their parameters and analyze them with one batched forward pass."""
+
+    def post(self, request):
+        """Accept a JSON list of objects that each have the fields of a request to the root endpoint.
+
+        The response is a list in the same order, with the result or `{"errors": ...}` for each item. A batch takes
+        one admission slot, like a single image.
+        """
+        reject_stale(request)
+        items = request.data
+        if not isinstance(items, list):
+            return Response({"non_field_errors": ["Expected a list of items."]}, status=HTTP_400_BAD_REQUEST)
+        if len(items) > settings.MERON_MAX_BATCH_SIZE:
+            return Response(
+                {"non_field_errors": [f"A batch can contain at most {settings.MERON_MAX_BATCH_SIZE} items."]},
+                status=HTTP_400_BAD_REQUEST,
+            )
+
+        models = get_models(request)
+        with admit():
+            response = [
+                FaceDetectionOutputSerializer(result).data if errors is None else {"errors": errors}
+                for result, errors in analyze_batch(items, context={"request": request, "models": models})
+            ]
+        return Response(response, status=HTTP_201_CREATED, headers={"X-Model-Version": models.version})
+
+
+class JobListView(APIView):
+    """Accept the same requests as the root endpoint, but run the analysis in the background."""
+
+    def post(self, request):
+        """Validate the request and return the id of the job with status 202. Poll the job URL for the result.
+
+        Returns status 503 with a Retry-After header if the worker is too busy to validate the image or too many jobs
+        are waiting.
+        """
+        reject_stale(request)
+        context = {"request": request, "models": get_models(request)}
+        data = request.data
+        with admit():
+            input_serializer = FaceDetectionInputSerializer(data=data, context=context)
+            if not input_serializer.is_valid():
+                return Response(input_serializer.errors, status=HTTP_400_BAD_REQUEST)
+
+            job = submit_job(input_serializer, requested_version(request))
+        url = reverse("api:job", kwargs={"job_id": job["id"]}, request=request)
+        return Response({**job, "url": url}, status=HTTP_202_ACCEPTED, headers={"Location": url})
+
+
+class JobView(APIView):
+    """Return the status of a job and its result once it is done."""
+
+    renderer_classes = [JSONRenderer]
+
+    def get(self, request, job_id):
+        """Return the job. `status` is one of queued, running, done (with `result`) or failed (with `errors`)."""
+        job = get_job_store().get(job_id)
+        if job is None:
+            raise NotFound("Unknown or expired job.")
+        return Response(job)
+
+
+class CapabilitiesView(APIView):
+    """Advertise the limits of the API, so clients can prepare their uploads accordingly."""
+
+    renderer_classes = [JSONRenderer]
+
+    def get(self, request):
+        """Return the upload limits and the size and JPEG quality clients should downscale and recompress photos to.
+
+        Uploads larger than `max_image_side` or `max_upload_size` are rejected. Photos downscaled to `image_side` are
+        much smaller to upload and faster to decode, without changing the results.
+        """
+        capabilities = {
+            "formats": ["image/jpeg", "image/png"],
+            "max_upload_size": settings.MERON_MAX_UPLOAD_SIZE,
+            "max_image_side": settings.MERON_MAX_IMAGE_SIDE,
+            "image_side": min(settings.MERON_CLIENT_IMAGE_SIDE, settings.MERON_MAX_IMAGE_SIDE or float("inf")),
+            "jpeg_quality": settings.MERON_CLIENT_JPEG_QUALITY,
+            "max_batch_size": settings.MERON_MAX_BATCH_SIZE,
+        }
+        # the limits only change when the settings do
+        return Response(capabilities, headers={"Cache-Control": "max-age=3600"})
+
+
+class HealthView(APIView):
+    """Report whether the models of this worker are loaded, so load balancers only route to ready workers."""
+
+    renderer_classes = [JSONRenderer]
+
+    def get(self, request):
+        """Return the registry state, with status 503 until the models are loaded."""
+        status = HTTP_200_OK if registry.ready else HTTP_503_SERVICE_UNAVAILABLE
+        health = registry.health()
+        batcher = get_batcher()
+        if batcher is not None:
+            # batch sizes and queue wait times are needed to tune the micro-batching settings
+            health["micro_batching"] = batcher.stats()
+        controller = get_admission_controller()
+        if controller is not None:
+            health["admission"] = controller.stats()
+        return Response(health, status=status)
+
+
+class MetricsView(APIView):
+    """Export the request and stage latency histograms of all workers for Prometheus."""
+
+    renderer_classes = [PrometheusTextRenderer]
+
+    def get(self, request):
+        return Response(render_metrics())
@@ -0,0 +1,61 @@
+"""Model files that the workers of a host memory-map instead of each reading them into memory.
+
+`python manage.py convert_models_mmap` writes them to `MERON_MMAP_DIR`:
+
+- `embedder/`: the weights of the VGGFace network as one `.npy` file per array, with `manifest.json` naming the
+  architecture and the arrays in the order of `Model.get_weights()`
+- the score and classification models as uncompressed joblib files, whose numpy arrays joblib can memory-map
+
+Memory-mapped arrays are read-only pages of the page cache, all workers on the host share one copy of the arrays of
+the score and classification models. Mapping the files is also much faster than parsing the HDF5 weights of
+keras_vggface or unpickling the models, which matters because every worker loads its models after the fork.
+
+The weights of the embedding network are not shared: Keras' `set_weights` copies them into the TensorFlow variables
+of each worker, about 90 MB per worker for resnet50. For the embedding network the gain is the startup time only.
+"""
+import json
+import os
+
+import numpy as np
+
+EMBEDDER_DIR = "embedder"
+MANIFEST_FILE = "manifest.json"
+
+
+def save_weights(arrays, directory, model_name):
+    """Write the weight arrays of a network, e.g. from `Model.get_weights()`, as `.npy` files with a manifest."""
+    os.makedirs(directory, exist_ok=True)
+    files = []
+    for index, array in enumerate(arrays):
+        file_name = f"{index:04d}.npy"
+        np.save(os.path.join(directory, file_name), np.ascontiguousarray(array))
+        files.append({"file": file_name, "shape": list(array.shape), "dtype": str(array.dtype)})
+    # the manifest is written last, a directory without one is incomplete
+    with open(os.path.join(directory, MANIFEST_FILE), "w") as manifest_file:
+        json.dump({"model": model_name, "weights": files}, manifest_file)
+
+
+def load_weights(directory, model_name):
+    """Return the weight arrays written by save_weights, memory-mapped read-only.
+
+    Raises ValueError if they belong to another architecture than `model_name`.
+    """
+    with open(os.path.join(directory, MANIFEST_FILE)) as manifest_file:
+        manifest = json.load(manifest_file)
+    if manifest["model"] != model_name:
+        raise ValueError(f"The weights in {directory} are those of {manifest['model']}, not {model_name}")
+    return [np.load(os.path.join(directory, weights["file"]), mmap_mode="r") for weights in manifest["weights"]]
+
+
+def save_head(model, path):
+    """Write a scikit-learn model as uncompressed joblib file, so its arrays can be memory-mapped."""
+    import joblib
+
+    joblib.dump(model, path, compress=0)
+
+
+def load_head(path):
+    """Load a model written by save_head with its numpy arrays memory-mapped read-only."""
+    import joblib
+
+    return joblib.load(path, mmap_mode="r")
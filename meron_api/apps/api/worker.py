@@ -0,0 +1,29 @@
+"""Set up a server worker process before it accepts requests, see `post_worker_init` in meron_api/gunicorn_config.py.
+
+TensorFlow and onnxruntime start thread pools when they load and run a model, and neither library is fork-safe: a
+worker forked from a process that used them can deadlock on its first prediction. So the models are never loaded in
+the gunicorn master, every worker loads and warms up its own after it was forked.
+"""
+import logging
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+
+def prepare_worker():
+    """Load and warm up the models (unless `MERON_PRELOAD_MODELS` is off) and start the job threads.
+
+    A worker whose models fail to load starts anyway: the health check reports the error and the next request tries
+    to load them again.
+    """
+    # imported here, gunicorn imports its configuration before Django is set up
+    from .jobs import get_job_runner
+    from .registry import registry
+
+    if settings.MERON_PRELOAD_MODELS:
+        try:
+            registry.warm_up()
+        except Exception:
+            logger.exception("The models of the worker could not be loaded")
+    get_job_runner()
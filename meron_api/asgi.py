@@ -0,0 +1,17 @@
+import os
+
+from django.core.wsgi import get_wsgi_application
+
+
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "meron_api.settings.production")
+
+# Django 2.2 has no ASGI support of its own, the Django application runs in a thread pool once the body is received
+from django.conf import settings  # noqa: E402
+from meron_api.apps.api.asgi import BufferedWSGIApplication  # noqa: E402
+
+application = BufferedWSGIApplication(
+    get_wsgi_application(), settings.MERON_ASGI_THREADS, settings.MERON_MAX_UPLOAD_SIZE
+)
+
+# gunicorn loads and warms up the models of each worker in post_worker_init (see meron_api/gunicorn_config.py), after
+# the worker was forked. Other servers load them on the first request.
@@ -0,0 +1,70 @@
+"""Gunicorn configuration, run gunicorn with `-c python:meron_api.gunicorn_config meron_api.wsgi`.
+
+The `async` topology runs the ASGI application instead: `-c python:meron_api.gunicorn_config meron_api.asgi`.
+
+The number of workers, their class and threads and the threads of the inference libraries are derived from the cores
+available to the container and the topology in `MERON_TOPOLOGY` (`per-core` or `threaded`, see
+meron_api/apps/api/cpu.py). `MERON_WORKERS`, `MERON_THREADS` and `MERON_INFERENCE_THREADS` override single values.
+"""
+import os
+
+from meron_api.apps.api.cpu import available_cores, limit_thread_pools, topology
+
+MODE = os.environ.get("MERON_TOPOLOGY", "per-core")
+CORES = available_cores()
+TOPOLOGY = topology(
+    MODE,
+    CORES,
+    workers=int(os.environ.get("MERON_WORKERS", 0)),
+    threads=int(os.environ.get("MERON_THREADS", 0)),
+    inference_threads=int(os.environ.get("MERON_INFERENCE_THREADS", 0)),
+)
+
+bind = os.environ.get("MERON_BIND", "0.0.0.0:5000")
+workers = TOPOLOGY["workers"]
+worker_class = TOPOLOGY["worker_class"]
+threads = TOPOLOGY["threads"]
+# must match proxy_read_timeout in the nginx configuration
+timeout = int(os.environ.get("MERON_TIMEOUT", 300))
+# TensorFlow and onnxruntime aren't fork-safe, the application and its models are loaded in every worker after the
+# fork (see post_worker_init), never in the master process
+preload_app = False
+
+# The libraries read these when they are imported in the workers, which inherit the environment. The Django settings
+# read MERON_INFERENCE_THREADS.
+limit_thread_pools(TOPOLOGY["inference_threads"])
+os.environ["MERON_INFERENCE_THREADS"] = str(TOPOLOGY["inference_threads"])
+# the threads of the ASGI application take the place of the threads of a gthread worker
+os.environ["MERON_ASGI_THREADS"] = str(TOPOLOGY["threads"])
+# micro-batching is disabled for workers that handle one request at a time
+os.environ["MERON_REQUEST_THREADS"] = str(TOPOLOGY["threads"])
+# the admission limits apply to all workers, with lock files in this directory (see meron_api/apps/api/admission.py)
+os.environ.setdefault("MERON_ADMISSION_DIR", "/tmp/meron-admission")
+os.environ.setdefault("MERON_ADMISSION_SLOTS", str(workers * min(threads, 2)))
+
+
+def when_ready(server):
+    server.log.info(
+        "Topology %s on %s cores: %s %s workers with %s threads, %s inference threads per worker",
+        MODE,
+        CORES,
+        workers,
+        worker_class,
+        threads,
+        TOPOLOGY["inference_threads"],
+    )
+
+
+def post_worker_init(worker):
+    # load and warm up the models of this worker and start its job threads, see meron_api/apps/api/worker.py
+    from meron_api.apps.api.worker import prepare_worker
+
+    prepare_worker()
+
+
+def child_exit(server, worker):
+    # prometheus_client has to forget the gauges of dead workers, see meron_api/apps/api/metrics.py
+    if os.environ.get("prometheus_multiproc_dir"):
+        from prometheus_client import multiprocess
+
+        multiprocess.mark_process_dead(worker.pid)
@@ -49,6 +49,8 @@ ROOT_URLCONF = "meron_api.urls"
 
 
 MIDDLEWARE = [
+    # first, so the measured duration includes all other middleware
+    "meron_api.apps.api.middleware.TimingMiddleware",
     "django.middleware.security.SecurityMiddleware",
     "django.contrib.sessions.middleware.SessionMiddleware",
     "django.middleware.common.CommonMiddleware",
@@ -130,7 +132,26 @@ REST_FRAMEWORK = {
     "DEFAULT_RENDERER_CLASSES": (
         "rest_framework.renderers.JSONRenderer",
         "meron_api.apps.api.renderers.ReadOnlyBrowsableAPIRenderer",
-    )
+    ),
+    "DEFAULT_PARSER_CLASSES": (
+        "meron_api.apps.api.parsers.StreamingJSONParser",
+        "rest_framework.parsers.FormParser",
+        "meron_api.apps.api.parsers.LimitedMultiPartParser",
+        "meron_api.apps.api.parsers.RawImageParser",
+    ),
+}
+
+
+# CACHE CONFIGURATION
+# ------------------------------------------------------------------------------
+# See: https://docs.djangoproject.com/en/dev/ref/settings/#caches
+CACHES = {
+    "default": env.cache("DJANGO_CACHE_URL", default="locmemcache://"),
+    # Results of the model for repeated uploads. The default is an LRU cache per worker, use e.g.
+    # filecache:///tmp/meron-results to share the cache between the workers on one host.
+    "results": env.cache(
+        "MERON_RESULT_CACHE_URL", default="locmemcache://meron-results?timeout=3600&max_entries=10000"
+    ),
 }
 
 
@@ -139,3 +160,151 @@ WSGI_APPLICATION = "meron_api.wsgi.application"
 
 # Set backend for Keras
 KERAS_BACKEND = "theano"
+
+
+# MODEL CONFIGURATION
+# ------------------------------------------------------------------------------
+# Directory that contains the joblib files of the score and classification models
+MERON_MODEL_DIR = env("MERON_MODEL_DIR", default=str(ROOT_DIR.path("apps/meron_production/models")))
+MERON_SCORE_MODEL = env("MERON_SCORE_MODEL", default="score_model.joblib")
+MERON_CLASSIFICATION_MODEL = env("MERON_CLASSIFICATION_MODEL", default="classification_model.joblib")
+# Directory with the models converted by `python manage.py convert_models_mmap`. If it is set, the keras runtime
+# memory-maps the weights of the embedding network and the arrays of the score and classification models from it
+# instead of loading MERON_MODEL_DIR. The workers of a host share one copy of the score and classification models in
+# the page cache, the weights of the embedding network are copied into TensorFlow's variables in every worker.
+MERON_MMAP_DIR = env("MERON_MMAP_DIR", default="")
+# Directory with one subdirectory of models per version, the version with the highest name is used unless a request
+# pins another one. Used instead of MERON_MODEL_DIR (and MERON_ONNX_DIR for the onnx runtime) if it is set.
+MERON_MODEL_VERSIONS_DIR = env("MERON_MODEL_VERSIONS_DIR", default="")
+# Seconds between two checks for a new version in MERON_MODEL_VERSIONS_DIR, 0 disables the checks
+MERON_MODEL_RELOAD_INTERVAL = env.float("MERON_MODEL_RELOAD_INTERVAL", default=30)
+# Number of versions besides the current one a worker keeps loaded for requests that pin them
+MERON_MODEL_KEEP_VERSIONS = env.int("MERON_MODEL_KEEP_VERSIONS", default=2)
+# Versions requests can pin even if the worker hasn't loaded them, they are loaded on first use and kept loaded. Other
+# versions can only be pinned while the worker keeps them after a reload.
+MERON_MODEL_PINNABLE_VERSIONS = env.list("MERON_MODEL_PINNABLE_VERSIONS", default=[])
+# keras_vggface architecture used for the face embeddings: vgg16, resnet50 or senet50
+MERON_VGGFACE_MODEL = env("MERON_VGGFACE_MODEL", default="resnet50")
+# Directory with photos of faces that `python manage.py check_upstream_parity` analyzes with the API and with the
+# pipeline of the meron_production submodule, the parity test runs on them as well
+MERON_PARITY_IMAGES_DIR = env("MERON_PARITY_IMAGES_DIR", default="")
+# Threads the inference libraries (TensorFlow, onnxruntime, OpenMP and BLAS) of one worker may use, 0 keeps the
+# defaults of the libraries (one per core). meron_api/gunicorn_config.py sets it according to MERON_TOPOLOGY.
+MERON_INFERENCE_THREADS = env.int("MERON_INFERENCE_THREADS", default=0)
+# Requests the ASGI application (meron_api/asgi.py) runs in Django at the same time, the others wait for a thread once
+# their body is received. meron_api/gunicorn_config.py sets it according to MERON_TOPOLOGY.
+MERON_ASGI_THREADS = env.int("MERON_ASGI_THREADS", default=4)
+# Runtime of the embedding network and the score and classification models: keras (TensorFlow and scikit-learn) or onnx
+# (onnxruntime, with the models exported by `python manage.py export_onnx`)
+MERON_INFERENCE_RUNTIME = env("MERON_INFERENCE_RUNTIME", default="keras")
+# Directory of the models exported to ONNX
+MERON_ONNX_DIR = env("MERON_ONNX_DIR", default=str(ROOT_DIR.path("apps/meron_production/models/onnx")))
+# Precision of the embedding network used by the onnx runtime: fp32, fp16 or int8
+MERON_ONNX_PRECISION = env("MERON_ONNX_PRECISION", default="fp32")
+# Threads onnxruntime uses for one prediction, 0 lets onnxruntime decide (one per core)
+MERON_ONNX_THREADS = env.int("MERON_ONNX_THREADS", default=MERON_INFERENCE_THREADS)
+# Use deterministic stand-ins for all models (see meron_api/apps/api/stub.py), e.g. to run or benchmark the API without
+# TensorFlow, dlib and the model files. The results are meaningless.
+MERON_STUB_MODELS = env.bool("MERON_STUB_MODELS", default=False)
+# Width and height in pixels of the face crops passed to the embedding network
+MERON_FACE_SIZE = env.int("MERON_FACE_SIZE", default=224)
+# Uploads are decoded so that their longer side is at most this many pixels for face detection (JPEG files directly at
+# reduced resolution). The face is then cropped at the resolution the embedding network needs. 0 disables this.
+MERON_DETECTION_MAX_SIDE = env.int("MERON_DETECTION_MAX_SIDE", default=800)
+# Uploads whose longer side has more pixels than this are rejected, clients should downscale larger photos. Advertised
+# by the capabilities endpoint. 0 accepts any size.
+MERON_MAX_IMAGE_SIDE = env.int("MERON_MAX_IMAGE_SIDE", default=4096)
+# Longer side in pixels and JPEG quality (0 to 1) the capabilities endpoint recommends to clients, which downscale and
+# recompress photos to that before uploading them (see the frontend)
+MERON_CLIENT_IMAGE_SIDE = env.int("MERON_CLIENT_IMAGE_SIDE", default=1024)
+MERON_CLIENT_JPEG_QUALITY = env.float("MERON_CLIENT_JPEG_QUALITY", default=0.85)
+# Face detector of requests with the default profile: dlib-hog, dlib-cnn or opencv-dnn (see
+# meron_api/apps/api/detectors.py), the number of times the image is upsampled before looking for faces and the
+# minimum size in pixels of the faces it reports (0 reports all)
+MERON_DETECTOR = env("MERON_DETECTOR", default="dlib-hog")
+MERON_DETECTOR_UPSAMPLE = env.int("MERON_DETECTOR_UPSAMPLE", default=1)
+MERON_DETECTOR_MIN_FACE_SIZE = env.int("MERON_DETECTOR_MIN_FACE_SIZE", default=0)
+# Face detector of requests with the fast profile, e.g. when traffic spikes. Without upsampling dlib-hog is about four
+# times faster, but misses faces smaller than 80 pixels.
+MERON_FAST_DETECTOR = env("MERON_FAST_DETECTOR", default="dlib-hog")
+MERON_FAST_DETECTOR_UPSAMPLE = env.int("MERON_FAST_DETECTOR_UPSAMPLE", default=0)
+MERON_FAST_DETECTOR_MIN_FACE_SIZE = env.int("MERON_FAST_DETECTOR_MIN_FACE_SIZE", default=0)
+# Model files of the dlib-cnn and opencv-dnn detectors, and the confidence above which opencv-dnn reports a face
+MERON_DLIB_CNN_MODEL = env(
+    "MERON_DLIB_CNN_MODEL", default=str(ROOT_DIR.path("apps/meron_production/models/mmod_human_face_detector.dat"))
+)
+MERON_OPENCV_DNN_CONFIG = env(
+    "MERON_OPENCV_DNN_CONFIG", default=str(ROOT_DIR.path("apps/meron_production/models/deploy.prototxt"))
+)
+MERON_OPENCV_DNN_MODEL = env(
+    "MERON_OPENCV_DNN_MODEL",
+    default=str(ROOT_DIR.path("apps/meron_production/models/res10_300x300_ssd_iter_140000.caffemodel")),
+)
+MERON_OPENCV_DNN_CONFIDENCE = env.float("MERON_OPENCV_DNN_CONFIDENCE", default=0.5)
+# Maximum size of a request body in bytes, larger uploads are rejected with status 413 before they are read. This
+# should match client_max_body_size in the nginx configuration.
+MERON_MAX_UPLOAD_SIZE = env.int("MERON_MAX_UPLOAD_SIZE", default=30 * 1024 * 1024)
+# Base64 encoded images are decoded into memory while the JSON body is read, images larger than this many bytes are
+# moved to a temporary file
+MERON_UPLOAD_SPOOL_SIZE = env.int("MERON_UPLOAD_SPOOL_SIZE", default=10 * 1024 * 1024)
+# Maximum number of images that can be submitted in one request to the batch endpoint
+MERON_MAX_BATCH_SIZE = env.int("MERON_MAX_BATCH_SIZE", default=64)
+# Collect the faces of concurrent requests and embed them in one batched forward pass. This only has an effect when a
+# worker handles several requests at the same time (the threaded and async topologies), it is ignored when
+# MERON_REQUEST_THREADS is 1.
+MERON_MICRO_BATCHING = env.bool("MERON_MICRO_BATCHING", default=False)
+# Requests a worker handles at the same time, 0 if unknown. meron_api/gunicorn_config.py sets it according to
+# MERON_TOPOLOGY.
+MERON_REQUEST_THREADS = env.int("MERON_REQUEST_THREADS", default=0)
+# A batch is run as soon as it contains this many faces ...
+MERON_MICRO_BATCH_MAX_SIZE = env.int("MERON_MICRO_BATCH_MAX_SIZE", default=16)
+# ... or the first request in it waited this many milliseconds
+MERON_MICRO_BATCH_MAX_WAIT_MS = env.float("MERON_MICRO_BATCH_MAX_WAIT_MS", default=10)
+# Admission control of the analysis endpoints (see meron_api/apps/api/admission.py), requests beyond these limits get
+# status 503 with a Retry-After header instead of waiting for a free worker
+MERON_ADMISSION_CONTROL = env.bool("MERON_ADMISSION_CONTROL", default=True)
+# Directory of the lock files that make the limits below apply to all workers of the host, without it they apply to
+# each process. meron_api/gunicorn_config.py sets it.
+MERON_ADMISSION_DIR = env.str("MERON_ADMISSION_DIR", default="")
+# Requests analyzed at the same time. meron_api/gunicorn_config.py defaults it to one per sync worker and two per
+# thread pool of the other workers (micro-batching).
+MERON_ADMISSION_SLOTS = env.int("MERON_ADMISSION_SLOTS", default=2)
+# Requests that wait for a slot, further requests are rejected right away. Only requests a worker is already handling
+# can wait, so the queue only fills up if the workers have more threads than there are slots. With sync workers the
+# other requests wait in the listen socket, where MERON_ADMISSION_MAX_REQUEST_AGE applies.
+MERON_ADMISSION_QUEUE_SIZE = env.int("MERON_ADMISSION_QUEUE_SIZE", default=4)
+# Seconds a request waits in the queue before it is rejected
+MERON_ADMISSION_MAX_WAIT = env.float("MERON_ADMISSION_MAX_WAIT", default=10)
+# Requests that reach the worker more than this many seconds after nginx received them (X-Request-Start header) are
+# rejected, their clients have likely given up. 0 disables this.
+MERON_ADMISSION_MAX_REQUEST_AGE = env.float("MERON_ADMISSION_MAX_REQUEST_AGE", default=30)
+# Return cached results for images that were analyzed before with the same parameters
+MERON_RESULT_CACHE = env.bool("MERON_RESULT_CACHE", default=True)
+MERON_RESULT_CACHE_ALIAS = "results"
+# Directory that holds the state of the asynchronous jobs, it has to be shared by all workers of a host
+MERON_JOB_DIR = env("MERON_JOB_DIR", default=str((ROOT_DIR - 1).path("media", "jobs")))
+# Number of threads per worker that run asynchronous jobs, 0 runs no jobs in this process
+MERON_JOB_WORKERS = env.int("MERON_JOB_WORKERS", default=1)
+# Jobs that wait or run at the same time on the host, further submissions get status 503
+MERON_JOB_QUEUE_SIZE = env.int("MERON_JOB_QUEUE_SIZE", default=100)
+# Seconds between two looks of an idle job thread for queued jobs and jobs of dead workers
+MERON_JOB_POLL_INTERVAL = env.float("MERON_JOB_POLL_INTERVAL", default=1)
+# A job claimed by a worker on another host sharing MERON_JOB_DIR is considered interrupted and run again when the
+# worker didn't touch its claim for this many seconds (workers touch them every poll interval). Jobs of workers on
+# this host are run again as soon as the worker process is gone.
+MERON_JOB_STALE_AFTER = env.float("MERON_JOB_STALE_AFTER", default=600)
+# A job that was interrupted this many times fails
+MERON_JOB_MAX_ATTEMPTS = env.int("MERON_JOB_MAX_ATTEMPTS", default=3)
+# Finished jobs are deleted this many seconds after their last update by the idle job threads
+MERON_JOB_TTL = env.int("MERON_JOB_TTL", default=24 * 60 * 60)
+# Store the embeddings calculated by the API and by bulk scoring, so new versions of the score and classification
+# models can be run over them with the rescore_embeddings management command (see
+# meron_api/apps/api/embedding_store.py)
+MERON_EMBEDDING_STORE = env.bool("MERON_EMBEDDING_STORE", default=False)
+# Directory of the embedding store, it has to be shared by all workers of a host
+MERON_EMBEDDING_STORE_DIR = env("MERON_EMBEDDING_STORE_DIR", default=str((ROOT_DIR - 1).path("media", "embeddings")))
+# Keys of recently stored embeddings each process keeps in memory to skip images that are stored already
+MERON_EMBEDDING_STORE_MAX_KEYS = env.int("MERON_EMBEDDING_STORE_MAX_KEYS", default=100000)
+# Load the models and run them once before a gunicorn worker accepts requests (in post_worker_init, after the worker
+# was forked), instead of on the first request
+MERON_PRELOAD_MODELS = env.bool("MERON_PRELOAD_MODELS", default=True)
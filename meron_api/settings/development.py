@@ -82,6 +82,10 @@ LOGGING = {
         "verbose": {
             "format": "%(asctime)s - %(filename)s - %(funcName)s:%(lineno)s - %(levelname)s - %(message)s"
         },
+        # one JSON object per line, with the fields passed in `extra` (e.g. the stage durations of the request log)
+        "json": {
+            "()": "meron_api.apps.api.log_formatters.JSONFormatter",
+        },
     },
     "handlers": {
         "console": {
@@ -89,11 +93,16 @@ LOGGING = {
             "class": "logging.StreamHandler",
             "formatter": "verbose",
         },
+        "json_console": {
+            "level": "DEBUG",
+            "class": "logging.StreamHandler",
+            "formatter": "json",
+        },
     },
     "loggers": {
         "meron_api": {
             "handlers": [
-                "console",
+                "json_console",
             ],
             "level": "DEBUG",
         },
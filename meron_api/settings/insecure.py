@@ -29,6 +29,10 @@ LOGGING = {
             'format': '%(levelname)s %(asctime)s %(module)s '
                       '%(process)d %(thread)d %(message)s'
         },
+        # one JSON object per line, with the fields passed in `extra` (e.g. the stage durations of the request log)
+        'json': {
+            '()': 'meron_api.apps.api.log_formatters.JSONFormatter',
+        },
     },
     'handlers': {
         'mail_admins': {
@@ -41,6 +45,11 @@ LOGGING = {
             'class': 'logging.StreamHandler',
             'formatter': 'verbose',
         },
+        'json_console': {
+            'level': 'DEBUG',
+            'class': 'logging.StreamHandler',
+            'formatter': 'json',
+        },
     },
     'loggers': {
         'django.request': {
@@ -52,6 +61,12 @@ LOGGING = {
             'level': 'ERROR',
             'handlers': ['console', 'mail_admins', ],
             'propagate': True
-        }
+        },
+        # includes one line per request with the durations of its stages
+        'meron_api': {
+            'level': 'INFO',
+            'handlers': ['json_console', ],
+            'propagate': False
+        },
     }
 }
@@ -28,6 +28,13 @@ EMAIL_PORT = 1025
 EMAIL_BACKEND = 'django.core.mail.backends.locmem.EmailBackend'
 
 
+# Results would otherwise be cached across tests
+MERON_RESULT_CACHE = False
+
+# The tests run without TensorFlow, dlib and the model files
+MERON_STUB_MODELS = True
+
+
 # TESTING
 # ------------------------------------------------------------------------------
 # TEST_RUNNER = 'django.test.runner.DiscoverRunner'
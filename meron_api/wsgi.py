@@ -6,3 +6,6 @@ from django.core.wsgi import get_wsgi_application
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "meron_api.settings.production")
 
 application = get_wsgi_application()
+
+# gunicorn loads and warms up the models of each worker in post_worker_init (see meron_api/gunicorn_config.py), after
+# the worker was forked. Other servers load them on the first request.